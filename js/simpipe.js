@@ -1,23 +1,148 @@
 // 標準入出力によるプロセス間通信によりシミュレータを公開
 // chunk単位をjsonシリアライズして1行で送受信
+// --multiplex を指定すると、1プロセスで複数のバトルを並行して扱う
+// 入力・出力とも [battle_id, chunk] のjson配列を1行で送受信し、battle_idごとに別のBattleStreamへ振り分ける
+// 入力のchunkがnullの場合、そのバトルを破棄する
+// --binary を指定すると、jsonの代わりに長さを前置したUTF-8バイト列で送受信する(pokeai/sim/framing.py 参照)
+// [ペイロード長 uint32BE]([battle_id uint32BE] 多重化時のみ)[ペイロード]
+// 多重化時、ペイロード長0の入力はnullと同じくバトルの破棄
+// --split を指定すると、updateのchunkを各プレイヤー向けに分割し、"playerupdate\np1\n..." と "playerupdate\np2\n..." の2つで送る
+// --omniscient を併せて指定すると、全情報を含む "playerupdate\nomniscient\n..." も送る
 
 const bs = require('../Pokemon-Showdown/dist/sim/battle-stream');
 const BattleStream = bs.BattleStream;
 
-// keepAlive: 複数回バトルを行えるようにする(デフォルトではバトルが終了するとストリームが閉じられる)
-const stream = new BattleStream({ debug: false, keepAlive: true });
+const args = process.argv.slice(2);
+const multiplex = args.includes('--multiplex');
+const binary = args.includes('--binary');
+const split = args.includes('--split');
+const splitSides = args.includes('--omniscient') ? ['p1', 'p2', 'omniscient'] : ['p1', 'p2'];
 
-const reader = require('readline').createInterface({
-    input: process.stdin,
-    output: process.stdout
-});
-reader.on('line', function (line) {
-    stream.write(JSON.parse(line));
-});
+// updateの内容から、sideに見える行だけを取り出す(Pokemon-Showdown/sim/battle.ts の|split|の扱いと同じ)
+// "|split|p1" の次の行はp1向けの秘密情報、その次の行は他のプレイヤー向けの公開情報
+const extractUpdateForSide = (lines, side) => {
+    const out = [];
+    for (let i = 0; i < lines.length; i++) {
+        const line = lines[i];
+        if (!line.startsWith('|split|')) {
+            out.push(line);
+            continue;
+        }
+        const owner = line.substring(7);
+        if (side === 'omniscient' || side === owner) {
+            out.push(lines[i + 1]);
+        } else if (lines[i + 2] !== '') {
+            out.push(lines[i + 2]);
+        }
+        i += 2;
+    }
+    return out.join('\n');
+};
+
+// 入力を読み、chunkごとにonChunk(battleId, chunk)を呼ぶ。多重化しない場合battleIdはnull
+const readInput = (onChunk) => {
+    if (binary) {
+        const headerSize = multiplex ? 8 : 4;
+        let buf = Buffer.alloc(0);
+        process.stdin.on('data', (data) => {
+            buf = buf.length > 0 ? Buffer.concat([buf, data]) : data;
+            while (buf.length >= headerSize) {
+                const length = buf.readUInt32BE(0);
+                if (buf.length < headerSize + length) {
+                    break;
+                }
+                const battleId = multiplex ? buf.readUInt32BE(4) : null;
+                const chunk = buf.toString('utf8', headerSize, headerSize + length);
+                buf = buf.subarray(headerSize + length);
+                onChunk(battleId, (multiplex && length === 0) ? null : chunk);
+            }
+        });
+    } else {
+        const reader = require('readline').createInterface({
+            input: process.stdin,
+            output: process.stdout
+        });
+        reader.on('line', function (line) {
+            if (multiplex) {
+                const [battleId, chunk] = JSON.parse(line);
+                onChunk(battleId, chunk);
+            } else {
+                onChunk(null, JSON.parse(line));
+            }
+        });
+    }
+};
 
-(async () => {
-    let chunk;
-    while (chunk = await stream.read()) {
+const writeChunk = (battleId, chunk) => {
+    if (binary) {
+        const payload = Buffer.from(chunk, 'utf8');
+        const header = Buffer.alloc(multiplex ? 8 : 4);
+        header.writeUInt32BE(payload.length, 0);
+        if (multiplex) {
+            header.writeUInt32BE(battleId, 4);
+        }
+        process.stdout.write(Buffer.concat([header, payload]));
+    } else if (multiplex) {
+        process.stdout.write(JSON.stringify([battleId, chunk]) + '\n');
+    } else {
         process.stdout.write(JSON.stringify(chunk) + '\n');
     }
-})();
+};
+
+const writeOutput = (battleId, chunk) => {
+    if (split && chunk.startsWith('update\n')) {
+        const lines = chunk.substring(7).split('\n');
+        for (const side of splitSides) {
+            writeChunk(battleId, `playerupdate\n${side}\n${extractUpdateForSide(lines, side)}`);
+        }
+    } else {
+        writeChunk(battleId, chunk);
+    }
+};
+
+if (multiplex) {
+    const streams = new Map();
+
+    const openStream = (battleId) => {
+        // バトルごとのストリームはバトル終了で閉じる(keepAliveしない)
+        const stream = new BattleStream({ debug: false });
+        streams.set(battleId, stream);
+        (async () => {
+            let chunk;
+            while (chunk = await stream.read()) {
+                writeOutput(battleId, chunk);
+            }
+            streams.delete(battleId);
+        })();
+        return stream;
+    };
+
+    readInput((battleId, chunk) => {
+        let stream = streams.get(battleId);
+        if (chunk === null) {
+            if (stream) {
+                streams.delete(battleId);
+                stream.writeEnd();
+            }
+            return;
+        }
+        if (!stream) {
+            stream = openStream(battleId);
+        }
+        stream.write(chunk);
+    });
+} else {
+    // keepAlive: 複数回バトルを行えるようにする(デフォルトではバトルが終了するとストリームが閉じられる)
+    const stream = new BattleStream({ debug: false, keepAlive: true });
+
+    readInput((battleId, chunk) => {
+        stream.write(chunk);
+    });
+
+    (async () => {
+        let chunk;
+        while (chunk = await stream.read()) {
+            writeOutput(null, chunk);
+        }
+    })();
+}
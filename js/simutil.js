@@ -1,5 +1,5 @@
 // シミュレータの付属機能を呼び出しpythonと仲介するユーティリティ
-// jsonシリアライズして送受信
+// jsonシリアライズして送受信(--binary を指定すると長さを前置したフレームで送受信)
 
 const sim = require('../Pokemon-Showdown/dist/sim');
 const Dex = sim.Dex;
@@ -44,12 +44,7 @@ methods['packTeam'] = (() => {
     };
 })();
 
-const reader = require('readline').createInterface({
-    input: process.stdin,
-    output: process.stdout
-});
-reader.on('line', async function (line) {
-    const request = JSON.parse(line);
+const handleRequest = async (request) => {
     const method = methods[request['method']];
     let result = null;
     let error = null;
@@ -62,5 +57,39 @@ reader.on('line', async function (line) {
     } else {
         error = { 'message': `No method named ${request['method']}` };
     }
-    process.stdout.write(JSON.stringify({ result, error }) + '\n');
-});
+    return { result, error };
+};
+
+if (process.argv.slice(2).includes('--binary')) {
+    // 長さを前置したフレームで送受信: [ペイロード長 uint32BE][jsonのUTF-8バイト列]
+    // 行区切りのためのエスケープや行の探索が不要
+    let buf = Buffer.alloc(0);
+    let queue = Promise.resolve();
+    process.stdin.on('data', (data) => {
+        buf = buf.length > 0 ? Buffer.concat([buf, data]) : data;
+        while (buf.length >= 4) {
+            const length = buf.readUInt32BE(0);
+            if (buf.length < 4 + length) {
+                break;
+            }
+            const request = JSON.parse(buf.toString('utf8', 4, 4 + length));
+            buf = buf.subarray(4 + length);
+            // 応答の順序を要求の順序と一致させる
+            queue = queue.then(async () => {
+                const payload = Buffer.from(JSON.stringify(await handleRequest(request)), 'utf8');
+                const header = Buffer.alloc(4);
+                header.writeUInt32BE(payload.length, 0);
+                process.stdout.write(Buffer.concat([header, payload]));
+            });
+        }
+    });
+} else {
+    const reader = require('readline').createInterface({
+        input: process.stdin,
+        output: process.stdout
+    });
+    reader.on('line', async function (line) {
+        const request = JSON.parse(line);
+        process.stdout.write(JSON.stringify(await handleRequest(request)) + '\n');
+    });
+}
@@ -1,7 +1,10 @@
 """
 行動選択AIのベースクラス
 """
+from typing import List, Optional
+
 from pokeai.ai.battle_status import BattleStatus
+from pokeai.sim.trace_recorder import BattleTrace
 
 
 class ActionPolicy:
@@ -17,6 +20,34 @@ class ActionPolicy:
         """
         pass
 
+    def set_battle_seed(self, seed: List[int], side: str):
+        """
+        バトルの乱数シードが指定された場合に、game_startの後で呼び出される
+        乱数を用いる方策は、これをもとに乱数を初期化することでバトルを再現可能にする
+        (同時に進行する複数のバトルで同じインスタンスを共有した場合は再現しない)
+        :param seed: シミュレータの乱数シード
+        :param side: p1 or p2
+        :return:
+        """
+        pass
+
+    def set_trace(self, trace: Optional[BattleTrace]):
+        """
+        バトルの経過を記録するトレースが、game_startの後で設定される
+        行動選択の根拠(選択肢の評価値など)を記録する方策はこれをオーバーライドする
+        :param trace: Noneなら記録しない
+        :return:
+        """
+        pass
+
+    def cache_key(self) -> Optional[str]:
+        """
+        バトル結果のキャッシュにおける方策の識別子
+        同じ識別子の方策は、同じバトル状態・乱数シードに対して同じ行動をとらなければならない
+        :return: 識別子。キャッシュできない方策ではNone
+        """
+        return None
+
     def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
         """
         ターン開始時の行動選択
@@ -35,6 +66,25 @@ class ActionPolicy:
         """
         raise NotImplementedError
 
+    async def choice_turn_start_async(self, battle_status: BattleStatus, request: dict) -> str:
+        """
+        ターン開始時の行動選択(非同期版)
+        非同期に判断できる方策はこれをオーバーライドする。デフォルトでは同期版を呼ぶ。
+        :param battle_status:
+        :param request:
+        :return: 行動。"move [1-4]|switch [1-6]"
+        """
+        return self.choice_turn_start(battle_status, request)
+
+    async def choice_force_switch_async(self, battle_status: BattleStatus, request: dict) -> str:
+        """
+        強制交換時の行動選択(非同期版)
+        :param battle_status:
+        :param request:
+        :return: 行動。"switch [1-6]"
+        """
+        return self.choice_force_switch(battle_status, request)
+
     def game_end(self, reward: float):
         """
         ゲーム終了時に呼び出される
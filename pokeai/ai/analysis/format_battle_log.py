@@ -2,6 +2,8 @@ import argparse
 import json
 import re
 
+from pokeai.ai.battle_status import apply_json_delta
+from pokeai.sim.trace_recorder import read_traces
 from pokeai.util import compress_open
 
 prefix_match_start = "DEBUG:__main__:match start: "
@@ -116,11 +118,38 @@ def parse_one_battle(f):
             return {"agents": agents_info, "events": events, "end": end}
 
 
+def convert_trace(record):
+    """
+    TraceRecorderのレコードを、DEBUGログから抽出した場合と同じ形式に変換する
+    updateはプレイヤーごとに記録されているので、sideが付加されている
+    行動選択時の状態は、前回からの差分(battle_status_delta)と、差分の導入前の形式(battle_status_json)のいずれも読める
+    """
+    last_battle_status = {}
+    for event in record["events"]:
+        if event["type"] == "choice":
+            choice_info = event["choice"]
+            player = choice_info["player"]
+            if "battle_status_delta" in choice_info:
+                battle_status = apply_json_delta(last_battle_status.get(player, {}),
+                                                 choice_info.pop("battle_status_delta"))
+            else:
+                battle_status = json.loads(choice_info.pop("battle_status_json"))
+            choice_info["battle_status"] = battle_status
+            last_battle_status[player] = battle_status
+    return record
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("src")
     parser.add_argument("dst")
+    parser.add_argument("--trace", action="store_true", help="srcがDEBUGログではなく、TraceRecorderの出力")
     args = parser.parse_args()
+    if args.trace:
+        with compress_open(args.dst, "wt") as wf:
+            for record in read_traces(args.src):
+                wf.write(json.dumps(convert_trace(record)) + "\n")
+        return
     with compress_open(args.src, "rt") as rf:
         with compress_open(args.dst, "wt") as wf:
             while True:
@@ -2,29 +2,17 @@
 
 import argparse
 import json
-import re
 import numpy as np
 from pokeai.util import json_load, pickle_load, ROOT_DIR, DATASET_DIR, json_dump
 from collections import defaultdict
 from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.sim import extract_update_for_side
 from pokeai.ai.action_policy import ActionPolicy
 from pokeai.ai.common import get_possible_actions
 
 players = ["p1", "p2"]
 
 
-def _extractUpdateForSide(side: str, chunk_data: str):
-    # Pokemon-Showdown/sim/battle.ts の移植
-    if side == 'omniscient':
-        # 全データ取得
-        return re.sub('\n\\|split\\|p[1234]\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-    # 各プレイヤーごとの秘密情報を、他のプレイヤー向けには削除する
-    # '|split|p1'の次の行は、p1にのみ送る（他のプレイヤーの場合削除）
-    if side.startswith('p'):
-        chunk_data = re.sub('\n\\|split\\|' + side + '\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-    return re.sub('\n\\|split\\|(?:[^\n]*)\n(?:[^\n]*)\n\n?', '\n', chunk_data)  # 対象でない秘密データ削除
-
-
 def process_one_battle(orig_log):
     bsps = {k: BattleStreamProcessor() for k in players}
     for k, bsp in bsps.items():
@@ -33,7 +21,7 @@ def process_one_battle(orig_log):
     for entry in orig_log["events"]:
         if entry["type"] == "choice":
             player = entry["choice"]["player"]
-            pas = get_possible_actions(bsps[player], entry["choice"]["request"])
+            pas = get_possible_actions(bsps[player].battle_status, entry["choice"]["request"])
             entry["choice"]["battle_status"] = json.loads(bsps[player].battle_status.json_dumps())
             entry["choice"]["possible_actions"] = [pa._asdict() for pa in pas]
             slog = entry["choice"].get("searchLog")
@@ -48,7 +36,7 @@ def process_one_battle(orig_log):
             entry["choice"]["q_func"] = q_func
         elif entry["type"] == "update":
             for k, bsp in bsps.items():
-                bsp.process_chunk("update", _extractUpdateForSide(k, "\n".join(entry["update"])))
+                bsp.process_chunk("update", extract_update_for_side(k, "\n".join(entry["update"])))
     return orig_log
 
 
@@ -4,44 +4,95 @@
 """
 import json
 import re
-from typing import Dict, Set, Optional, Tuple
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, NamedTuple, Set, Optional, Tuple
 
 from pokeai.sim.party_generator import Party
 
 
-def parse_hp_condition(hp_condition: str) -> Tuple[int, int, str]:
-    """
-    HPと状態異常を表す文字列のパース
-    :param hp_condition: '50/200' (現在HP=50, 最大HP=200, 状態異常なし) or '50/200 psn' (状態異常の時)
-    :return: 現在HP, 最大HP, 状態異常('', 'psn'(毒), 'tox'(猛毒), 'par', 'brn', 'slp', 'frz', 'fnt'(瀕死))
-    """
+_hp_condition_re = re.compile('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$')
+# 例外的な種族名 'Nidoran-F', 'Porygon2', 'Mr. Mime', "Farfetch’d"
+_details_re = re.compile('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch’d), L(\\d+)(?:, (M|F|N))?$')
+# パース結果のキャッシュの大きさ
+# 文字列の種類は、HPは(最大HP*状態異常)程度、ポケモンの情報は(種族*レベル*性別)程度で、多数のバトルで共通
+PARSE_CACHE_SIZE = 65536
+
+
+def _parse_hp_condition_uncached(hp_condition: str) -> Tuple[int, int, str]:
     if hp_condition == '0 fnt':
         # 瀕死の時は0という表示になっている
         # 便宜上最大HP100として返している
         return 0, 100, 'fnt'
-    m = re.match('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$', hp_condition)
+    m = _hp_condition_re.match(hp_condition)
     assert m is not None, f"HP_CONDITION '{hp_condition}' cannot be parsed."
     # m[3]は状態異常がないときNoneとなる
     return int(m[1]), int(m[2]), m[3] or ''
 
 
+def _parse_details_uncached(details: str) -> Tuple[str, int, str]:
+    m = _details_re.match(details)
+    assert m is not None, f"DETAILS '{details}' cannot be parsed."
+    # 性別不明だとm[3]はNone
+    return m[1], int(m[2]), m[3] or 'N'
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_hp_condition(hp_condition: str) -> Tuple[int, int, str]:
+    """
+    HPと状態異常を表す文字列のパース
+    同じ文字列が繰り返し現れるため、結果をキャッシュする
+    :param hp_condition: '50/200' (現在HP=50, 最大HP=200, 状態異常なし) or '50/200 psn' (状態異常の時)
+    :return: 現在HP, 最大HP, 状態異常('', 'psn'(毒), 'tox'(猛毒), 'par', 'brn', 'slp', 'frz', 'fnt'(瀕死))
+    """
+    return _parse_hp_condition_uncached(hp_condition)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
 def _parse_details(details: str) -> Tuple[str, int, str]:
     """
     ポケモンの情報をパース
+    同じ文字列が繰り返し現れるため、結果をキャッシュする
     :param details: 種族名・レベル・性別情報　例:'Ninetales, L50, M'
     :return:
     """
-    # 例外的な種族名 'Nidoran-F', 'Porygon2', 'Mr. Mime', "Farfetch’d"
-    m = re.match('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch’d), L(\\d+)(?:, (M|F|N))?$', details)
-    assert m is not None, f"DETAILS '{details}' cannot be parsed."
-    # 性別不明だとm[3]はNone
-    return m[1], int(m[2]), m[3] or 'N'
+    return _parse_details_uncached(details)
+
+
+# SideStatus.valuesの要素のインデックス
+SIDE_REMAINING_POKES = 0
+SIDE_TOTAL_POKES = 1
+SIDE_VALUES_LEN = 2
+# ActivePokeStatus.valuesの要素のインデックス
+POKE_HP_CURRENT = 0
+POKE_HP_MAX = 1
+POKE_STATUS = 2  # 状態異常(STATUS_CODESのインデックス)
+POKE_RANK = 3  # ランク補正(RANK_NAMESの順に7要素)
+RANK_NAMES = ['atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion']
+POKE_VALUES_LEN = POKE_RANK + len(RANK_NAMES)
+STATUS_CODES = ['', 'psn', 'tox', 'par', 'brn', 'slp', 'frz', 'fnt']
+STATUS2CODE = {status: i for i, status in enumerate(STATUS_CODES)}
+RANK2IDX = {stat: POKE_RANK + i for i, stat in enumerate(RANK_NAMES)}
+_RANK_ZEROS = [0] * len(RANK_NAMES)
+
+
+class PokeSnapshot(NamedTuple):
+    """
+    ActivePokeStatusの不変なコピー
+    """
+    pokemon: str
+    species: str
+    level: int
+    gender: str
+    values: Tuple[int, ...]
+    volatile_statuses: FrozenSet[str]
 
 
 class ActivePokeStatus:
     """
     場に出ているポケモンの状態
+    数値で表せる状態(HP, 状態異常, ランク補正)は、特徴量への変換で一括して読み出せるようvaluesに格納する
     """
+    __slots__ = ('pokemon', 'species', 'level', 'gender', 'volatile_statuses', 'values')
     RANK_INITIAL = {'atk': 0, 'def': 0, 'spa': 0, 'spd': 0, 'spe': 0, 'accuracy': 0, 'evasion': 0}
     RANK_MAX = 6
     RANK_MIN = -6
@@ -50,11 +101,8 @@ class ActivePokeStatus:
     species: str  # 種族　例：'Ninetales'
     level: int
     gender: str
-    hp_current: int
-    hp_max: int
-    status: str  # 状態異常 (異常がない時は'')
-    ranks: Dict[str, int]
     volatile_statuses: Set[str]  # 状態変化
+    values: List[int]  # 数値で表せる状態。POKE_*をインデックスとする
 
     def __init__(self, pokemon: str, species: str, level: int, gender: str, hp_current: int, hp_max: int, status: str):
         """
@@ -69,43 +117,119 @@ class ActivePokeStatus:
         self.species = species
         self.level = level
         self.gender = gender
-        self.hp_current = hp_current
-        self.hp_max = hp_max
-        self.status = status
-        self.ranks = ActivePokeStatus.RANK_INITIAL.copy()
         self.volatile_statuses = set()
+        self.values = [hp_current, hp_max, STATUS2CODE[status]] + _RANK_ZEROS
+
+    @property
+    def hp_current(self) -> int:
+        return self.values[POKE_HP_CURRENT]
+
+    @hp_current.setter
+    def hp_current(self, hp_current: int):
+        self.values[POKE_HP_CURRENT] = hp_current
+
+    @property
+    def hp_max(self) -> int:
+        return self.values[POKE_HP_MAX]
+
+    @hp_max.setter
+    def hp_max(self, hp_max: int):
+        self.values[POKE_HP_MAX] = hp_max
+
+    @property
+    def status(self) -> str:
+        """
+        状態異常 (異常がない時は'')
+        """
+        return STATUS_CODES[self.values[POKE_STATUS]]
+
+    @status.setter
+    def status(self, status: str):
+        self.values[POKE_STATUS] = STATUS2CODE[status]
+
+    @property
+    def ranks(self) -> Dict[str, int]:
+        """
+        ランク補正のコピー。変更はrank_*メソッドで行う
+        """
+        return dict(zip(RANK_NAMES, self.values[POKE_RANK:]))
+
+    @ranks.setter
+    def ranks(self, ranks: Dict[str, int]):
+        for stat, value in ranks.items():
+            self.values[RANK2IDX[stat]] = value
 
     def rank_boost(self, stat: str, amount: int):
-        self._rank_set_clip(stat, self.ranks[stat] + amount)
+        self._rank_set_clip(stat, self.values[RANK2IDX[stat]] + amount)
 
     def rank_unboost(self, stat: str, amount: int):
-        self._rank_set_clip(stat, self.ranks[stat] - amount)
+        self._rank_set_clip(stat, self.values[RANK2IDX[stat]] - amount)
 
     def rank_setboost(self, stat: str, amount: int):
         self._rank_set_clip(stat, amount)
 
     def _rank_set_clip(self, stat: str, value: int):
-        assert stat in self.ranks
-        self.ranks[stat] = min(max(value, ActivePokeStatus.RANK_MIN), ActivePokeStatus.RANK_MAX)
+        assert stat in RANK2IDX
+        self.values[RANK2IDX[stat]] = min(max(value, ActivePokeStatus.RANK_MIN), ActivePokeStatus.RANK_MAX)
+
+    def rank_copy(self, source: "ActivePokeStatus"):
+        self.values[POKE_RANK:] = source.values[POKE_RANK:]
 
     def rank_clearallboost(self):
-        for stat in self.ranks.keys():
-            self.ranks[stat] = ActivePokeStatus.RANK_ZERO
+        self.values[POKE_RANK:] = _RANK_ZEROS
 
     @property
     def hp_ratio(self) -> float:
-        return self.hp_current / self.hp_max
+        return self.values[POKE_HP_CURRENT] / self.values[POKE_HP_MAX]
+
+    def snapshot(self) -> PokeSnapshot:
+        return PokeSnapshot(self.pokemon, self.species, self.level, self.gender, tuple(self.values),
+                            frozenset(self.volatile_statuses))
+
+    @classmethod
+    def from_snapshot(cls, snapshot: PokeSnapshot) -> "ActivePokeStatus":
+        poke = cls.__new__(cls)
+        poke.pokemon = snapshot.pokemon
+        poke.species = snapshot.species
+        poke.level = snapshot.level
+        poke.gender = snapshot.gender
+        poke.values = list(snapshot.values)
+        poke.volatile_statuses = set(snapshot.volatile_statuses)
+        return poke
+
+    def __getstate__(self) -> dict:
+        # pickle, json_dumpsの形式は、__slots__を用いる前の__dict__と同じ
+        return {'pokemon': self.pokemon, 'species': self.species, 'level': self.level, 'gender': self.gender,
+                'hp_current': self.hp_current, 'hp_max': self.hp_max, 'status': self.status, 'ranks': self.ranks,
+                'volatile_statuses': self.volatile_statuses}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['pokemon'], state['species'], state['level'], state['gender'], state['hp_current'],
+                      state['hp_max'], state['status'])
+        self.ranks = state['ranks']
+        self.volatile_statuses = state['volatile_statuses']
+
+
+class SideSnapshot(NamedTuple):
+    """
+    SideStatusの不変なコピー
+    控えのポケモンは交代後に変更されることがないため、複製せずActivePokeStatusを共有する
+    """
+    values: Tuple[int, ...]
+    side_statuses: FrozenSet[str]
+    active: Optional[PokeSnapshot]
+    reserve_pokes: Tuple[Tuple[str, ActivePokeStatus], ...]
 
 
 class SideStatus:
     """
     一方のプレイヤーの状態
     """
+    __slots__ = ('active', 'reserve_pokes', 'side_statuses', 'values')
     active: Optional[ActivePokeStatus]
     reserve_pokes: Dict[str, ActivePokeStatus]  # 控えのポケモンの交代直前の状態(瀕死状態のポケモンも含む)
     side_statuses: Set[str]  # プレイヤーの場の状態
-    total_pokes: int  # 全手持ちポケモン数
-    remaining_pokes: int  # 残っているポケモン数
+    values: List[int]  # 数値で表せる状態。SIDE_*をインデックスとする
 
     def __init__(self):
         """
@@ -114,8 +238,29 @@ class SideStatus:
         self.active = None
         self.reserve_pokes = {}
         self.side_statuses = set()
-        self.total_pokes = 0
-        self.remaining_pokes = 0
+        self.values = [0] * SIDE_VALUES_LEN
+
+    @property
+    def total_pokes(self) -> int:
+        """
+        全手持ちポケモン数
+        """
+        return self.values[SIDE_TOTAL_POKES]
+
+    @total_pokes.setter
+    def total_pokes(self, total_pokes: int):
+        self.values[SIDE_TOTAL_POKES] = total_pokes
+
+    @property
+    def remaining_pokes(self) -> int:
+        """
+        残っているポケモン数
+        """
+        return self.values[SIDE_REMAINING_POKES]
+
+    @remaining_pokes.setter
+    def remaining_pokes(self, remaining_pokes: int):
+        self.values[SIDE_REMAINING_POKES] = remaining_pokes
 
     def switch(self, active: ActivePokeStatus):
         """
@@ -149,8 +294,48 @@ class SideStatus:
         assert self.total_pokes > 0
         return self.remaining_pokes / self.total_pokes
 
+    def snapshot(self) -> SideSnapshot:
+        return SideSnapshot(tuple(self.values), frozenset(self.side_statuses),
+                            self.active.snapshot() if self.active is not None else None,
+                            tuple(self.reserve_pokes.items()))
+
+    @classmethod
+    def from_snapshot(cls, snapshot: SideSnapshot) -> "SideStatus":
+        side = cls.__new__(cls)
+        side.values = list(snapshot.values)
+        side.side_statuses = set(snapshot.side_statuses)
+        side.active = ActivePokeStatus.from_snapshot(snapshot.active) if snapshot.active is not None else None
+        side.reserve_pokes = dict(snapshot.reserve_pokes)
+        return side
+
+    def __getstate__(self) -> dict:
+        return {'active': self.active, 'reserve_pokes': self.reserve_pokes, 'side_statuses': self.side_statuses,
+                'total_pokes': self.total_pokes, 'remaining_pokes': self.remaining_pokes}
+
+    def __setstate__(self, state: dict):
+        self.active = state['active']
+        self.reserve_pokes = state['reserve_pokes']
+        self.side_statuses = state['side_statuses']
+        self.values = [0] * SIDE_VALUES_LEN
+        self.total_pokes = state['total_pokes']
+        self.remaining_pokes = state['remaining_pokes']
+
+
+class BattleStatusSnapshot(NamedTuple):
+    """
+    BattleStatusの不変なコピー。BattleStatus.restoreで何度でも元の状態を復元できる
+    パーティは変更されないため共有する
+    """
+    side_friend: str
+    side_party: Party
+    turn: int
+    weather: str
+    p1: SideSnapshot
+    p2: SideSnapshot
+
 
 class BattleStatus:
+    __slots__ = ('turn', 'side_friend', 'side_opponent', 'side_party', 'weather', 'side_statuses', 'action_cache')
     WEATHER_NONE = 'none'
     turn: int  # ターン番号(最初が0)
     side_friend: str  # 自分側のside ('p1' or 'p2')
@@ -158,6 +343,8 @@ class BattleStatus:
     side_party: Party  # 自分側のパーティ
     weather: str  # 天候（なしの時はWEATHER_NONE='none'）
     side_statuses: Dict[str, SideStatus]  # key: 'p1' or 'p2'
+    # 自分側の行動のキャッシュ(pokeai.ai.common.ActionEncodingCache)。複製・シリアライズの対象外
+    action_cache: Optional[object]
 
     def __init__(self, side_friend: str, side_party: Party):
         assert side_friend in ['p1', 'p2']
@@ -167,6 +354,7 @@ class BattleStatus:
         self.turn = 0
         self.weather = BattleStatus.WEATHER_NONE
         self.side_statuses = {'p1': SideStatus(), 'p2': SideStatus()}
+        self.action_cache = None
 
     def switch(self, pokemon: str, details: str, hp_condition: str):
         side = pokemon[:2]
@@ -178,11 +366,114 @@ class BattleStatus:
     def get_side(self, pokemon: str) -> SideStatus:
         return self.side_statuses[pokemon[:2]]
 
+    def snapshot(self) -> BattleStatusSnapshot:
+        """
+        現在の状態のコピーを作成する
+        先読みなどで状態を分岐させる場合に、pickleによる複製より高速
+        :return:
+        """
+        return BattleStatusSnapshot(self.side_friend, self.side_party, self.turn, self.weather,
+                                    self.side_statuses['p1'].snapshot(), self.side_statuses['p2'].snapshot())
+
+    @classmethod
+    def restore(cls, snapshot: BattleStatusSnapshot) -> "BattleStatus":
+        """
+        snapshotから状態を復元する。復元した状態を変更してもsnapshotには影響しない
+        :param snapshot:
+        :return:
+        """
+        battle_status = cls.__new__(cls)
+        battle_status.side_friend = snapshot.side_friend
+        battle_status.side_opponent = {'p1': 'p2', 'p2': 'p1'}[snapshot.side_friend]
+        battle_status.side_party = snapshot.side_party
+        battle_status.turn = snapshot.turn
+        battle_status.weather = snapshot.weather
+        battle_status.side_statuses = {'p1': SideStatus.from_snapshot(snapshot.p1),
+                                       'p2': SideStatus.from_snapshot(snapshot.p2)}
+        battle_status.action_cache = None
+        return battle_status
+
+    def __getstate__(self) -> dict:
+        return {'side_friend': self.side_friend, 'side_opponent': self.side_opponent, 'side_party': self.side_party,
+                'turn': self.turn, 'weather': self.weather, 'side_statuses': self.side_statuses}
+
+    def __setstate__(self, state: dict):
+        self.action_cache = None
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def json_obj(self) -> dict:
+        """
+        json_dumpsの結果をパースしたものと同じ、jsonで表現可能なオブジェクト
+        """
+        return _to_json_obj(self)
+
     def json_dumps(self) -> str:
         def default(obj):
             if isinstance(obj, set):
                 return list(obj)
             else:
-                return obj.__dict__
+                return obj.__getstate__()
 
         return json.dumps(self, default=default)
+
+
+def _to_json_obj(obj):
+    if isinstance(obj, (BattleStatus, SideStatus, ActivePokeStatus)):
+        obj = obj.__getstate__()
+    if isinstance(obj, dict):
+        return {k: _to_json_obj(v) for k, v in obj.items()}
+    if isinstance(obj, (list, set)):
+        return [_to_json_obj(v) for v in obj]
+    return obj
+
+
+def make_json_delta(prev: dict, current: dict, path: Optional[list] = None) -> list:
+    """
+    同じバトルの連続する状態(BattleStatus.json_obj)の差分を求める
+    辞書は再帰的に比較し、変化した値のみを含む
+    :param prev: 前の状態。{}なら全体が差分となる
+    :param current: 現在の状態
+    :return: 差分。[キーのパス, 新しい値]、削除されたキーについては[キーのパス]のリスト
+    """
+    path = path or []
+    delta = []
+    for key, value in current.items():
+        if key not in prev:
+            delta.append([path + [key], value])
+            continue
+        prev_value = prev[key]
+        if isinstance(value, dict) and isinstance(prev_value, dict):
+            delta.extend(make_json_delta(prev_value, value, path + [key]))
+        elif value != prev_value:
+            delta.append([path + [key], value])
+    for key in prev.keys():
+        if key not in current:
+            delta.append([path + [key]])
+    return delta
+
+
+def apply_json_delta(prev: dict, delta: list) -> dict:
+    """
+    make_json_deltaで求めた差分を適用する
+    変化したキーまでの経路上の辞書のみ複製し、それ以外はprevと共有する
+    :param prev: 前の状態(変更しない)
+    :param delta: 差分
+    :return: 現在の状態
+    """
+    current = dict(prev)
+    copied = set()  # 複製済みの辞書のパス
+    for op in delta:
+        keys = op[0]
+        parent = current
+        for depth, key in enumerate(keys[:-1]):
+            sub_path = tuple(keys[:depth + 1])
+            if sub_path not in copied:
+                parent[key] = dict(parent[key])
+                copied.add(sub_path)
+            parent = parent[key]
+        if len(op) == 2:
+            parent[keys[-1]] = op[1]
+        else:
+            del parent[keys[-1]]
+    return current
@@ -1,7 +1,8 @@
-from typing import List, NamedTuple, Optional
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from pokeai.ai.battle_status import BattleStatus
 from pokeai.ai.dex import dex
+from pokeai.sim.party_generator import Party
 
 
 class PossibleAction(NamedTuple):
@@ -29,13 +30,116 @@ def rename_special_move_id_side(id: str) -> str:
     return id
 
 
+def _get_poke_info(backpokemon: dict) -> Tuple[str, List[str]]:
+    """
+    requestの手持ちのポケモンの情報から、ポケモンのIDと全技のIDを求める
+    """
+    pokemon_name = backpokemon['details'].split(',')[0]  # "Kangaskhan, L50, F" => "Kangaskhan"
+    pokemon_id = dex.get_pokedex_by_name(pokemon_name)['id']  # "Kangaskhan"=>"kangaskhan"
+    return pokemon_id, [rename_special_move_id_side(m) for m in backpokemon['moves']]
+
+
+def _make_move_action(backpokemon: dict, poke_info: Tuple[str, List[str]], move_idx: int,
+                      move: dict) -> PossibleAction:
+    return PossibleAction(simulator_key=f'move {move_idx + 1}',
+                          poke=poke_info[0],
+                          move=rename_special_move_id_active(move['id'], move['move']),
+                          switch=False,
+                          force_switch=False,
+                          allMoves=poke_info[1],
+                          item=backpokemon['item'])
+
+
+def _make_switch_action(backpokemon: dict, poke_info: Tuple[str, List[str]], poke_idx: int,
+                        force_switch: bool) -> PossibleAction:
+    return PossibleAction(simulator_key=f'switch {poke_idx + 1}',
+                          poke=poke_info[0],
+                          move=None,
+                          switch=True,
+                          force_switch=force_switch,
+                          allMoves=poke_info[1],
+                          item=backpokemon['item'])
+
+
+class ActionEncodingCache:
+    """
+    1バトル中のプレイヤー側の行動(PossibleAction)とその特徴量のキャッシュ
+    バトル中はパーティが変わらないため、同じ行動は同じPossibleActionのインスタンスとして使いまわし、
+    方策の特徴抽出の結果もインスタンスごとに記憶する
+    BattleStreamProcessor.start_battleで作成し、BattleStatus.action_cacheに設定する
+    """
+    _poke_infos: Dict[tuple, Tuple[str, List[str]]]
+    _actions: Dict[tuple, PossibleAction]
+    _encodings: Dict[Tuple[str, int], Tuple[PossibleAction, Any]]
+
+    def __init__(self, side_party: Party):
+        # requestの手持ちのポケモンの情報(details, item, moves) -> (ポケモンのID, 全技のID)
+        # 技の表記(return102など)はrequestで初めてわかるため、最初の行動選択時に求める
+        self._poke_infos = {}
+        # ポケモンの情報と行動の番号 -> 行動
+        self._actions = {}
+        # (特徴抽出器の名前, id(行動)) -> (行動, 特徴量)
+        self._encodings = {}
+        # ポケモン名からIDへの変換は、パーティから事前に求めておく
+        self._poke_ids = {dex.get_pokedex_by_id(poke['species'])['name']: poke['species'] for poke in side_party}
+
+    def _get_poke_info(self, poke_key: tuple, backpokemon: dict) -> Tuple[str, List[str]]:
+        poke_info = self._poke_infos.get(poke_key)
+        if poke_info is None:
+            pokemon_name = backpokemon['details'].split(',')[0]
+            pokemon_id = self._poke_ids.get(pokemon_name)
+            if pokemon_id is None:
+                poke_info = _get_poke_info(backpokemon)
+            else:
+                poke_info = pokemon_id, [rename_special_move_id_side(m) for m in backpokemon['moves']]
+            self._poke_infos[poke_key] = poke_info
+        return poke_info
+
+    def move_action(self, backpokemon: dict, move_idx: int, move: dict) -> PossibleAction:
+        poke_key = (backpokemon['details'], backpokemon['item'], tuple(backpokemon['moves']))
+        key = (poke_key, move_idx, move['id'], move['move'])
+        action = self._actions.get(key)
+        if action is None:
+            action = _make_move_action(backpokemon, self._get_poke_info(poke_key, backpokemon), move_idx, move)
+            self._actions[key] = action
+        return action
+
+    def switch_action(self, backpokemon: dict, poke_idx: int, force_switch: bool) -> PossibleAction:
+        poke_key = (backpokemon['details'], backpokemon['item'], tuple(backpokemon['moves']))
+        key = (poke_key, poke_idx, force_switch)
+        action = self._actions.get(key)
+        if action is None:
+            action = _make_switch_action(backpokemon, self._get_poke_info(poke_key, backpokemon), poke_idx,
+                                         force_switch)
+            self._actions[key] = action
+        return action
+
+    def get_encoding(self, name: str, possible_action: PossibleAction, encode: Callable[[PossibleAction], Any]) -> Any:
+        """
+        行動の特徴量を求める。同じ行動について2回目以降は記憶した結果を返す
+        :param name: 特徴抽出の種類
+        :param possible_action: get_possible_actionsが返した行動
+        :param encode: 特徴抽出を行う関数
+        :return: encode(possible_action)の結果(共有されるため変更してはならない)
+        """
+        key = (name, id(possible_action))
+        entry = self._encodings.get(key)
+        # キャッシュが保持している行動のidは変わらないが、キャッシュ外の行動が渡された場合に備えて同一性を確認する
+        if entry is None or entry[0] is not possible_action:
+            entry = possible_action, encode(possible_action)
+            self._encodings[key] = entry
+        return entry[1]
+
+
 def get_possible_actions(battle_status: BattleStatus, request: dict) -> List[PossibleAction]:
     """
     取れる行動を表すオブジェクト列を返す
+    battle_status.action_cacheがある場合は、そのキャッシュにある行動を返す
     :param battle_status: プレイヤー側のバトル状態
     :param request: シミュレータからのrequestオブジェクト
     :return:
     """
+    cache = battle_status.action_cache  # type: Optional[ActionEncodingCache]
 
     force_switch = bool(request.get("forceSwitch"))
     if not force_switch:
@@ -141,22 +245,18 @@ def get_possible_actions(battle_status: BattleStatus, request: dict) -> List[Pos
     # 		},
     possible_actions = []  # type: List[PossibleAction]
     for poke_idx, backpokemon in enumerate(request['side']['pokemon']):  # 手持ちの全ポケモン
-        pokemon_name = backpokemon['details'].split(',')[0]  # "Kangaskhan, L50, F" => "Kangaskhan"
-        pokemon_id = dex.get_pokedex_by_name(pokemon_name)['id']  # "Kangaskhan"=>"kangaskhan"
         if backpokemon['active']:
             # 場に出ているポケモン=技の選択
             if not force_switch:
+                poke_info = None
                 for move_idx, move in enumerate(active[0]['moves']):
                     if not move.get('disabled'):
-                        possible_actions.append(PossibleAction(simulator_key=f'move {move_idx + 1}',
-                                                               poke=pokemon_id,
-                                                               move=rename_special_move_id_active(move['id'],
-                                                                                                  move['move']),
-                                                               switch=False,
-                                                               force_switch=False,
-                                                               allMoves=[rename_special_move_id_side(m) for m in
-                                                                         backpokemon['moves']],
-                                                               item=backpokemon['item']))
+                        if cache is not None:
+                            possible_actions.append(cache.move_action(backpokemon, move_idx, move))
+                            continue
+                        if poke_info is None:
+                            poke_info = _get_poke_info(backpokemon)
+                        possible_actions.append(_make_move_action(backpokemon, poke_info, move_idx, move))
         else:
             # 場に出てないポケモン=交代の選択
             if backpokemon['condition'].endswith(' fnt'):
@@ -164,12 +264,9 @@ def get_possible_actions(battle_status: BattleStatus, request: dict) -> List[Pos
                 continue
             if trapped:
                 continue
-            possible_actions.append(PossibleAction(simulator_key=f'switch {poke_idx + 1}',
-                                                   poke=pokemon_id,
-                                                   move=None,
-                                                   switch=True,
-                                                   force_switch=force_switch,
-                                                   allMoves=[rename_special_move_id_side(m) for m in
-                                                             backpokemon['moves']],
-                                                   item=backpokemon['item']))
+            if cache is not None:
+                possible_actions.append(cache.switch_action(backpokemon, poke_idx, force_switch))
+            else:
+                possible_actions.append(_make_switch_action(backpokemon, _get_poke_info(backpokemon), poke_idx,
+                                                            force_switch))
     return possible_actions
@@ -1,3 +1,5 @@
+from typing import List
+
 from pokeai.util import DATASET_DIR, json_load
 
 
@@ -18,6 +20,21 @@ class Dex:
         """
         return self._pokedex[self._poke2id[name]]
 
+    def get_pokedex_by_id(self, poke_id: str) -> dict:
+        """
+        ポケモンのIDからポケモン情報を得る
+        :param poke_id: ポケモンのID(パーティのspecies)　例：'nidoranf'
+        :return:
+        """
+        return self._pokedex[poke_id]
+
+    def get_all_poke_names(self) -> List[str]:
+        """
+        全ポケモンの名前
+        :return:
+        """
+        return [v['name'] for v in self._pokedex.values()]
+
 
 """
 pokedex.json:
@@ -0,0 +1,197 @@
+"""
+rl_trainの対戦と学習を別プロセスで並行して行う(actor-learner)
+アクタープロセスはそれぞれSimを持ち、ラーナーから受け取ったパーティの組で学習用の対戦を行い、遷移をラーナーに送る
+ラーナー(rl_trainのプロセス)はTrainer・リプレイバッファ・チェックポイントを持ち、一定の対戦数ごとに重みをアクターに配布する
+対戦の組(match_pairs_queue)とレートはラーナーが管理する
+"""
+import multiprocessing
+import queue
+from logging import getLogger
+from typing import Dict, List, Tuple
+
+import torch
+
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer
+from pokeai.ai.generic_move_model.trainer import Trainer
+from pokeai.ai.rl_policy import RLPolicy
+from pokeai.ai.surrogate_reward_config import SurrogateRewardConfig
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import Sim
+from pokeai.util import setup_logging
+
+logger = getLogger(__name__)
+
+# アクターの生存確認の間隔(秒)
+_RESULT_POLL_INTERVAL = 10.0
+
+
+def play_train_battle(sim: Sim, trainer: Trainer, target_parties: List[Party],
+                      surrogate_reward_config: SurrogateRewardConfig) -> Tuple[str, List[ReplayBuffer]]:
+    """
+    学習用エージェント同士で1回対戦する。リプレイバッファ・学習には反映しない
+    :return: 勝者('p1', 'p2', forcetieで引き分けの時は'')、各プレイヤーの遷移
+    """
+    agents = []
+    bsps = []
+    for player in range(2):
+        agent = trainer.get_train_agent()
+        bsp = BattleStreamProcessor()
+        bsp.set_policy(RLPolicy(agent, surrogate_reward_config))
+        agents.append(agent)
+        bsps.append(bsp)
+    sim.set_processor(bsps)
+    sim.set_party(target_parties)
+    with torch.no_grad():
+        battle_result = sim.run()
+    return battle_result["winner"], [agent._replay_buffer for agent in agents]
+
+
+def _actor_main(constructor_params: dict, parties: List[Party], surrogate_reward_config: SurrogateRewardConfig,
+                task_queue, weight_queue, result_queue, loglevel: str):
+    """
+    アクタープロセスの処理
+    task_queueから(タスクID, パーティの組, ラーナーのtotal_steps)を受け取り、対戦結果をresult_queueに送る
+    Noneを受け取ったら終了する
+    """
+    setup_logging(loglevel)
+    # 複数のアクターが同じCPUで動くため、推論はシングルスレッドとする
+    torch.set_num_threads(1)
+    trainer = Trainer(**constructor_params)
+    codec = trainer.replay_buffer.codec
+    sim = Sim()
+    weights = weight_queue.get()
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            # 配布された最新の重みを用いる
+            while True:
+                try:
+                    weights = weight_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if weights is not None:
+                version, state_dict = weights
+                trainer.load_model_state_dict({k: torch.from_numpy(v) for k, v in state_dict.items()})
+                logger.debug(f"actor loaded weights version {version}")
+                weights = None
+            task_id, match_pair, total_steps = task
+            # 探索率はラーナーのステップ数で決まる
+            trainer.total_steps = total_steps
+            winner, buffers = play_train_battle(sim, trainer, [parties[match_pair[0]], parties[match_pair[1]]],
+                                                surrogate_reward_config)
+            if codec is not None:
+                # ラーナーのリプレイバッファと同じ省メモリな表現で送る
+                compact_buffers = []
+                for buffer in buffers:
+                    compact_buffer = ReplayBuffer(None, codec)
+                    compact_buffer.extend_buffer(buffer)
+                    compact_buffers.append(compact_buffer)
+                buffers = compact_buffers
+            result_queue.put((task_id, winner, buffers))
+    finally:
+        sim.close()
+
+
+class ActorPool:
+    """
+    アクタープロセスの集合
+    """
+    n_actors: int
+    max_pending: int  # 同時に割り当てる対戦数の上限
+    pending: Dict[int, Tuple[int, int]]  # 結果を受け取っていないタスクID -> パーティの組(割り当て順)
+
+    def __init__(self, n_actors: int, trainer: Trainer, parties: List[Party],
+                 surrogate_reward_config: SurrogateRewardConfig, loglevel: str, pending_per_actor: int = 2):
+        """
+        :param n_actors:
+        :param trainer: ラーナーのTrainer。constructor_paramsでアクター側のモデルを構築する
+        :param parties:
+        :param surrogate_reward_config:
+        :param loglevel:
+        :param pending_per_actor: アクターごとに先行して割り当てる対戦数
+        """
+        self.n_actors = n_actors
+        self.max_pending = n_actors * pending_per_actor
+        self.pending = {}
+        self._next_task_id = 0
+        self._broadcast_version = None
+        # torch・シミュレータプロセスを含むプロセスのforkを避ける
+        ctx = multiprocessing.get_context("spawn")
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self._weight_queues = [ctx.Queue() for _ in range(n_actors)]
+        self._procs = []
+        for i in range(n_actors):
+            proc = ctx.Process(target=_actor_main,
+                               args=(trainer.constructor_params, parties, surrogate_reward_config, self._task_queue,
+                                     self._weight_queues[i], self._result_queue, loglevel),
+                               daemon=True)
+            proc.start()
+            self._procs.append(proc)
+
+    def broadcast_weights(self, trainer: Trainer):
+        """
+        ラーナーの重みのスナップショット(Trainer.get_snapshot)を全アクターに配布する。アクターは次の対戦から用いる
+        前回配布したものと同じスナップショットであれば配布しない
+        """
+        snapshot = trainer.get_snapshot()
+        if snapshot.version == self._broadcast_version:
+            return
+        state_dict = {k: v.detach().cpu().numpy() for k, v in snapshot.model.state_dict().items()}
+        for weight_queue in self._weight_queues:
+            weight_queue.put((snapshot.version, state_dict))
+        self._broadcast_version = snapshot.version
+
+    def can_submit(self) -> bool:
+        return len(self.pending) < self.max_pending
+
+    def submit(self, match_pair: Tuple[int, int], total_steps: int):
+        """
+        対戦を割り当てる
+        :param match_pair: partiesのインデックスの組
+        :param total_steps: ラーナーのTrainer.total_steps
+        """
+        task_id = self._next_task_id
+        self._next_task_id += 1
+        self.pending[task_id] = match_pair
+        self._task_queue.put((task_id, match_pair, total_steps))
+
+    def get_result(self) -> Tuple[Tuple[int, int], str, List[ReplayBuffer]]:
+        """
+        終了した対戦の結果を1つ受け取る(終了順)
+        :return: パーティの組、勝者、各プレイヤーの遷移
+        """
+        while True:
+            try:
+                task_id, winner, buffers = self._result_queue.get(timeout=_RESULT_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                dead = [proc.pid for proc in self._procs if not proc.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError(f"actor process exited unexpectedly: pid {dead}")
+        return self.pending.pop(task_id), winner, buffers
+
+    def pending_match_pairs(self) -> List[Tuple[int, int]]:
+        """
+        結果を受け取っていない対戦の組(割り当て順)。チェックポイントではこれらを未対戦として扱う
+        """
+        return list(self.pending.values())
+
+    def close(self):
+        """
+        アクタープロセスを終了する。割り当て済みの対戦は、終了を待って結果を捨てる
+        """
+        for _ in self._procs:
+            self._task_queue.put(None)
+        # 結果を読まないとアクターがresult_queueへの書き込みを完了できず、終了しない
+        while any(proc.is_alive() for proc in self._procs):
+            try:
+                self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                pass
+        for proc in self._procs:
+            proc.join()
+        self.pending.clear()
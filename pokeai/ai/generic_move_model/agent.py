@@ -1,38 +1,89 @@
 import json
 import logging
 from logging import getLogger
+from typing import Optional, Union
 import numpy as np
 import torch
 
+from pokeai.ai.generic_move_model.batched_inference import BatchedInferenceServer
 from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+from pokeai.ai.generic_move_model.numpy_model import NumpyMLPModel
 
 logger = getLogger(__name__)
 
 
 class Agent:
-    def __init__(self, model: torch.nn.Module, feature_extractor: FeatureExtractor):
+    def __init__(self, model: Union[torch.nn.Module, NumpyMLPModel], feature_extractor: FeatureExtractor):
         self._model = model
         self._feature_extractor = feature_extractor
+        self._inference_server = None
+
+    def set_inference_server(self, inference_server: BatchedInferenceServer):
+        """
+        act_asyncでのモデル推論を、他のバトルの推論とまとめて行うサーバを設定する
+        :param inference_server:
+        :return:
+        """
+        self._inference_server = inference_server
 
     def act(self, obs: object, reward: float) -> int:
         raise NotImplementedError
 
+    async def act_async(self, obs: object, reward: float) -> int:
+        """
+        actの非同期版。デフォルトではactを呼ぶ。
+        """
+        return self.act(obs, reward)
+
+    def cache_key(self) -> Optional[str]:
+        """
+        バトル結果のキャッシュにおけるエージェントの識別子
+        :return: 識別子。行動が決定的でない、またはモデルが特定できない場合はNone
+        """
+        return None
+
+    def start_episode(self) -> None:
+        """
+        エピソード(バトル)の開始時に呼び出される
+        """
+        pass
+
     def stop_episode(self, reward: float) -> None:
         raise NotImplementedError
 
     def _calc_q_vector(self, obs_vector) -> np.ndarray:
+        if isinstance(self._model, NumpyMLPModel):
+            return self._model(obs_vector[np.newaxis, ...])[0]
         # GPUを使うなら入力を.to(device)し、出力を.cpu().numpy()とする
         q_vector = self._model(torch.from_numpy(obs_vector[np.newaxis, ...])).numpy()[0]
         return q_vector
 
     def _calc_q_vector_batch(self, obs_vector_batch) -> np.ndarray:
+        if isinstance(self._model, NumpyMLPModel):
+            return self._model(obs_vector_batch)
         q_vectors = self._model(torch.from_numpy(obs_vector_batch)).numpy()
         return q_vectors
 
-    def _act_by_model(self, obs_vector, action_mask) -> int:
+    def _act_by_model(self, obs_vector, action_mask, trace: Optional[dict] = None) -> int:
         q_vector = self._calc_q_vector(obs_vector)
+        return self._select_action(q_vector, action_mask, trace)
+
+    async def _act_by_model_async(self, obs_vector, action_mask, trace: Optional[dict] = None) -> int:
+        if self._inference_server is None:
+            return self._act_by_model(obs_vector, action_mask, trace)
+        q_vector = await self._inference_server.calc_q_vector(obs_vector)
+        return self._select_action(q_vector, action_mask, trace)
+
+    def _select_action(self, q_vector, action_mask, trace: Optional[dict] = None) -> int:
+        """
+        q値が最大の行動を選択する
+        :param trace: 行動選択の記録先(RLPolicyObservation.trace)。指定されればq値と行動を書き込む
+        """
         q_vector[action_mask == 0] = -np.inf
         action = int(np.argmax(q_vector))
+        if trace is not None:
+            # -infはnullとする(Infinityはjsonの規格外のため)
+            trace["q_func"] = {"q_func": [float(q) if np.isfinite(q) else None for q in q_vector], "action": action}
         if logger.isEnabledFor(logging.DEBUG):
             # logger.debug(
             #     "obs: " + json.dumps({"obs_vector": obs_vector.tolist(), "action_mask": action_mask.tolist()}))
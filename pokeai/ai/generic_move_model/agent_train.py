@@ -20,6 +20,17 @@ class AgentTrain(Agent):
         self._last_state = None
         self._last_action_mask = None
         self._last_action = 0
+        self._episode_start_len = 0
+
+    def start_episode(self) -> None:
+        if self._last_state is not None:
+            # 前のエピソードが終了せずに中断された(シミュレータの異常終了でやり直す場合など)
+            # 終端のない遷移が残らないよう、そのエピソードで追加した遷移を捨てる
+            self._replay_buffer.truncate(self._episode_start_len)
+            self._last_state = None
+            self._last_action_mask = None
+            self._last_action = 0
+        self._episode_start_len = len(self._replay_buffer)
 
     def act(self, obs: RLPolicyObservation, reward: float) -> int:
         obs_vector, action_mask = self._feature_extractor.transform(obs)
@@ -30,7 +41,7 @@ class AgentTrain(Agent):
         if np.random.random() < self._epsilon:
             action = self._act_random(obs_vector, action_mask)
         else:
-            action = self._act_by_model(obs_vector, action_mask)
+            action = self._act_by_model(obs_vector, action_mask, obs.trace)
         self._last_state = obs_vector
         self._last_action_mask = action_mask
         self._last_action = action
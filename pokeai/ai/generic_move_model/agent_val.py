@@ -1,13 +1,35 @@
+from typing import Optional
+
 from pokeai.ai.generic_move_model.agent import Agent
 
 
 class AgentVal(Agent):
-    def __init__(self, model, feature_extractor):
+    def __init__(self, model, feature_extractor, checkpoint_id: Optional[str] = None):
+        """
+        評価用エージェント
+        :param model:
+        :param feature_extractor:
+        :param checkpoint_id: モデルをロードしたチェックポイントのID。バトル結果のキャッシュに用いる
+        """
         super().__init__(model, feature_extractor)
+        self.checkpoint_id = checkpoint_id
+
+    def cache_key(self) -> Optional[str]:
+        # 行動はモデルから決定的に定まるので、チェックポイントが分かればキャッシュできる
+        return self.checkpoint_id
 
     def act(self, obs: object, reward: float) -> int:
         obs_vector, action_mask = self._feature_extractor.transform(obs)
-        action = self._act_by_model(obs_vector, action_mask)
+        action = self._act_by_model(obs_vector, action_mask, obs.trace)
+        return action
+
+    async def act_async(self, obs: object, reward: float) -> int:
+        if self._inference_server is not None and self._inference_server.feature_extractor is not None:
+            # 特徴量への変換を推論サーバでまとめて行う
+            q_vector = await self._inference_server.calc_q_vector_from_obs(obs)
+            return self._select_action(q_vector, self._feature_extractor.action_mask(obs), obs.trace)
+        obs_vector, action_mask = self._feature_extractor.transform(obs)
+        action = await self._act_by_model_async(obs_vector, action_mask, obs.trace)
         return action
 
     def stop_episode(self, reward: float) -> None:
@@ -0,0 +1,130 @@
+"""
+並行して進行する多数のバトルの行動選択を、まとめて1回のモデル推論で処理するサーバ
+AsyncSimのイベントループ上で使用する
+"""
+import asyncio
+import time
+from typing import List, Optional, Union
+from logging import getLogger
+
+import numpy as np
+import torch
+
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+from pokeai.ai.generic_move_model.numpy_model import NumpyMLPModel
+from pokeai.ai.rl_policy_observation import RLPolicyObservation
+
+logger = getLogger(__name__)
+
+
+class BatchedInferenceServer:
+    """
+    行動選択1回ごとの推論要求を受け付け、バッチサイズか待ち時間が閾値に達したらまとめて推論する
+    """
+    max_batch_size: int
+    max_latency: float
+    total_requests: int
+    total_batches: int
+    feature_extractor: Optional[FeatureExtractor]
+    _pending_obs: list
+    _pending_futures: List[asyncio.Future]
+    _flush_handle: Optional[asyncio.TimerHandle]
+    _input_buffer: Optional[np.ndarray]
+
+    def __init__(self, model: Union[torch.nn.Module, NumpyMLPModel], max_batch_size: int = 256, max_latency: float = 0.002,
+                 feature_extractor: Optional[FeatureExtractor] = None):
+        """
+        :param model: 推論に用いるモデル(評価モードにしておく)またはNumpyMLPModel
+        :param max_batch_size: この数の要求がたまったら直ちに推論する
+        :param max_latency: 最初の要求からこの秒数が経過したら、たまっている要求を推論する
+        :param feature_extractor: 指定した場合、観測(RLPolicyObservation)のまま要求を受け付け(calc_q_vector_from_obs)、
+        推論の直前にまとめて特徴量に変換する
+        """
+        self._model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.feature_extractor = feature_extractor
+        self._input_buffer = None
+        self._pending_obs = []
+        self._pending_futures = []
+        self._flush_handle = None
+        self.total_requests = 0
+        self.total_batches = 0
+
+    async def calc_q_vector(self, obs_vector: np.ndarray) -> np.ndarray:
+        """
+        1つの観測に対するq関数を計算する
+        :param obs_vector: 特徴量(FeatureExtractor.input_shape, float32)
+        :return: q関数((output_dim,), float32)
+        """
+        assert self.feature_extractor is None
+        return await self._request(obs_vector)
+
+    async def calc_q_vector_from_obs(self, obs: RLPolicyObservation) -> np.ndarray:
+        """
+        1つの観測に対するq関数を計算する。特徴量への変換は、他の要求とまとめて行う
+        :param obs:
+        :return: q関数((output_dim,), float32)
+        """
+        assert self.feature_extractor is not None
+        return await self._request(obs)
+
+    async def _request(self, obs) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_obs.append(obs)
+        self._pending_futures.append(future)
+        self.total_requests += 1
+        if len(self._pending_obs) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_latency, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if len(self._pending_obs) == 0:
+            return
+        pending_obs = self._pending_obs
+        futures = self._pending_futures
+        self._pending_obs = []
+        self._pending_futures = []
+        self.total_batches += 1
+        start_time = time.perf_counter()
+        try:
+            if self.feature_extractor is not None:
+                obs_batch, _ = self.feature_extractor.transform_batch(pending_obs, out=self._get_input_buffer(
+                    len(pending_obs)))
+            else:
+                obs_batch = np.stack(pending_obs)
+            if isinstance(self._model, NumpyMLPModel):
+                q_vectors = self._model(obs_batch)
+            else:
+                with torch.no_grad():
+                    q_vectors = self._model(torch.from_numpy(obs_batch)).numpy()
+        except Exception as ex:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        logger.debug(f"batched inference: batch_size={len(futures)}, time={time.perf_counter() - start_time}")
+        for future, q_vector in zip(futures, q_vectors):
+            if not future.done():
+                future.set_result(q_vector.copy())
+
+    def _get_input_buffer(self, batch_size: int) -> np.ndarray:
+        """
+        特徴量の書き込み先。推論ごとに確保せず再利用する
+        """
+        if self._input_buffer is None or len(self._input_buffer) < batch_size:
+            self._input_buffer = np.empty((max(batch_size, self.max_batch_size),) + self.feature_extractor.input_shape,
+                                          dtype=np.float32)
+        return self._input_buffer[:batch_size]
+
+    @property
+    def mean_batch_size(self) -> float:
+        if self.total_batches == 0:
+            return 0.0
+        return self.total_requests / self.total_batches
@@ -0,0 +1,97 @@
+"""
+リプレイバッファの1遷移あたりのメモリ使用量と、サンプル時間のベンチマーク
+特徴量をそのまま格納する場合と、省メモリな表現(CompactObservationCodec)で格納する場合を比較する
+特徴量は、状態部分を一様乱数、選択肢部分をランダムなインデックスのone-hot vectorとして生成する
+
+python -m pokeai.ai.generic_move_model.bench_replay_memory --party_size 3 --replay_buffer_size 100000
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from pokeai.ai.generic_move_model.choice_to_vec import MAX_CHOICE_INDICES
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+from pokeai.ai.generic_move_model.observation_codec import CompactObservationCodec
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer, ReplayBufferItem
+
+
+def generate_items(feature_extractor: FeatureExtractor, n: int, rng: np.random.RandomState):
+    """
+    1エピソード分の遷移を生成する
+    """
+    codec = CompactObservationCodec.from_feature_extractor(feature_extractor)
+    output_dim = feature_extractor.output_dim
+    states = []
+    masks = []
+    for _ in range(n + 1):
+        n_actions = rng.randint(1, output_dim + 1)
+        choice_indices = np.full((1, output_dim, MAX_CHOICE_INDICES), codec.choice_dims, dtype=np.int16)
+        for action in range(n_actions):
+            n_indices = rng.randint(1, MAX_CHOICE_INDICES + 1)
+            choice_indices[0, action, :n_indices] = rng.choice(codec.choice_dims, n_indices, replace=False)
+        state = rng.uniform(size=(1, codec.state_dims)).astype(np.float16)
+        states.append(codec.decode({"state": state, "choice": choice_indices})[0])
+        mask = np.zeros((output_dim,), dtype=np.int32)
+        mask[:n_actions] = 1
+        masks.append(mask)
+    items = []
+    for i in range(n):
+        last = i == n - 1
+        items.append(ReplayBufferItem(states[i], masks[i], int(rng.randint(output_dim)),
+                                      None if last else states[i + 1], None if last else masks[i + 1],
+                                      float(rng.normal())))
+    return items
+
+
+def measure_sample(buffer: ReplayBuffer, batch_size: int, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        buffer.sample_batch(batch_size)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--party_size", type=int, default=3)
+    parser.add_argument("--factorized", action="store_true")
+    parser.add_argument("--sparse_choice", action="store_true")
+    parser.add_argument("--replay_buffer_size", type=int, default=100000)
+    parser.add_argument("--transitions", type=int, default=10000, help="計測用のバッファに格納する遷移数")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+    random.seed(0)
+    rng = np.random.RandomState(0)
+    feature_extractor = FeatureExtractor(args.party_size, factorized=args.factorized, sparse_choice=args.sparse_choice)
+    codec = CompactObservationCodec.from_feature_extractor(feature_extractor)
+    dense_buffer = ReplayBuffer(args.transitions)
+    compact_buffer = ReplayBuffer(args.transitions, codec)
+    while len(dense_buffer) < args.transitions:
+        items = generate_items(feature_extractor, 30, rng)
+        dense_buffer.extend(items)
+        compact_buffer.extend(items)
+    # 状態部分はfloat16で表せる値としているため、復元結果は一致する
+    batch_indices = np.arange(args.transitions)
+    assert all(np.array_equal(d, c) for d, c in zip(dense_buffer._read(batch_indices),
+                                                   compact_buffer._read(batch_indices)))
+    dense_bytes = dense_buffer.nbytes_per_transition()
+    compact_bytes = compact_buffer.nbytes_per_transition()
+    report = {
+        "input_kind": codec.input_kind,
+        "input_shape": feature_extractor.input_shape,
+        "dense_bytes_per_transition": dense_bytes,
+        "compact_bytes_per_transition": compact_bytes,
+        "dense_buffer_gb": dense_bytes * args.replay_buffer_size / 1e9,
+        "compact_buffer_gb": compact_bytes * args.replay_buffer_size / 1e9,
+        "reduction": dense_bytes / compact_bytes,
+        "dense_sample_usec": measure_sample(dense_buffer, args.batch_size, args.repeat) * 1e6,
+        "compact_sample_usec": measure_sample(compact_buffer, args.batch_size, args.repeat) * 1e6,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
-from typing import List
+from typing import Callable, List
 
 from pokeai.ai.battle_status import BattleStatus
 import numpy as np
 
+from pokeai.ai.common import PossibleAction
 from pokeai.ai.rl_policy_observation import RLPolicyObservation
 from pokeai.util import json_load, DATASET_DIR
 
+# 疎な表現で、1つの選択肢が持つ非ゼロ要素数の最大値(switch, force_switch, poke, 技4つ, item)
+MAX_CHOICE_INDICES = 8
+
 
 class ChoiceToVec:
     """
@@ -42,20 +46,67 @@ class ChoiceToVec:
         特徴抽出
         :return: 各選択肢に対応する特徴量、(self.get_dims(), len(obs.possible_actions)) float32
         """
-        feat = np.zeros((self.get_dims(), len(obs.possible_actions)),
-                        dtype=np.float32)  # convolutionにかけることを考えるとchannel, length
+        if len(obs.possible_actions) == 0:
+            return np.zeros((self.get_dims(), 0), dtype=np.float32)
+        # convolutionにかけることを考えるとchannel, length
+        return np.array(self._encode_actions(obs, "choice_to_vec", self._encode_action_dense)).T
+
+    @property
+    def padding_index(self) -> int:
+        """
+        疎な表現で、非ゼロ要素がないことを表すインデックス
+        """
+        return len(self.dims)
+
+    def transform_sparse(self, obs: RLPolicyObservation) -> np.ndarray:
+        """
+        特徴抽出(疎な表現)
+        transformの結果で1となる要素のインデックスを、選択肢ごとに列挙する
+        バトル中の行動のキャッシュ(BattleStatus.action_cache)がある場合、選択肢ごとの結果はキャッシュに記憶する
+        :return: (len(obs.possible_actions), MAX_CHOICE_INDICES) int64。余った要素はself.padding_index
+        """
+        if len(obs.possible_actions) == 0:
+            return np.empty((0, MAX_CHOICE_INDICES), dtype=np.int64)
+        return np.array(self._encode_actions(obs, "choice_to_vec_sparse", self._encode_action))
+
+    @staticmethod
+    def _encode_actions(obs: RLPolicyObservation, name: str,
+                        encode: Callable[[PossibleAction], np.ndarray]) -> List[np.ndarray]:
+        cache = obs.battle_status.action_cache
+        if cache is None:
+            return [encode(possible_action) for possible_action in obs.possible_actions]
+        return [cache.get_encoding(name, possible_action, encode) for possible_action in obs.possible_actions]
+
+    def _encode_action_dense(self, possible_action: PossibleAction) -> np.ndarray:
+        """
+        1つの選択肢の特徴量
+        :return: (self.get_dims(),) float32
+        """
+        feat = np.zeros((self.get_dims() + 1,), dtype=np.float32)
+        feat[self._encode_action(possible_action)] = 1
+        # パディングのインデックスに対応する要素を除く
+        return feat[:-1]
+
+    def _encode_action(self, possible_action: PossibleAction) -> np.ndarray:
+        """
+        1つの選択肢で1となる要素のインデックス
+        :return: (MAX_CHOICE_INDICES,) int64。余った要素はself.padding_index
+        """
         n2d = self.name_to_dim
-        for a_idx, possible_action in enumerate(obs.possible_actions):
-            if possible_action.force_switch:
-                feat[n2d["force_switch"], a_idx] = 1
-            if possible_action.switch:
-                # force_switchのときも該当
-                feat[n2d["switch"], a_idx] = 1
-            feat[n2d["poke/" + possible_action.poke], a_idx] = 1
-            if possible_action.switch:
-                for move in possible_action.allMoves:
-                    feat[n2d["move/" + move], a_idx] = 1
-            else:
-                feat[n2d["move/" + possible_action.move], a_idx] = 1
-            feat[n2d["item/" + possible_action.item], a_idx] = 1
-        return feat
+        action_indices = []
+        if possible_action.force_switch:
+            action_indices.append(n2d["force_switch"])
+        if possible_action.switch:
+            # force_switchのときも該当
+            action_indices.append(n2d["switch"])
+        action_indices.append(n2d["poke/" + possible_action.poke])
+        if possible_action.switch:
+            # 重複した技は1回だけ数える
+            for move in dict.fromkeys(possible_action.allMoves):
+                action_indices.append(n2d["move/" + move])
+        else:
+            action_indices.append(n2d["move/" + possible_action.move])
+        action_indices.append(n2d["item/" + possible_action.item])
+        indices = np.full((MAX_CHOICE_INDICES,), self.padding_index, dtype=np.int64)
+        indices[:len(action_indices)] = action_indices
+        return indices
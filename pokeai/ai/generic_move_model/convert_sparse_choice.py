@@ -0,0 +1,58 @@
+"""
+MLPModelを用いるTrainerのチェックポイントを、選択肢の特徴量を疎な表現とする(SparseMLPModelを用いる)Trainerに変換する
+--dense_choiceを指定すると、選択肢の特徴量は密なまま、1層目を分解したFactorizedMLPModelを用いるTrainerに変換する
+モデルの出力は変換前と同じ(浮動小数点の丸め誤差を除く)
+学習の再開に必要な情報(optimizer, replay buffer)は変換しない
+
+python -m pokeai.ai.generic_move_model.convert_sparse_choice trainer_id[@battles] [--dense_choice]
+"""
+
+import argparse
+import copy
+
+from bson import ObjectId
+from pokeai.ai.generic_move_model.trainer import Trainer
+from pokeai.ai.party_db import col_trainer, fs_checkpoint, pack_obj, unpack_obj
+
+
+def convert_trainer_state(state: dict, sparse_choice: bool = True) -> dict:
+    """
+    Trainer.save_stateで保存した情報を変換する
+    :param state: MLPModelを用いるTrainerの情報
+    :param sparse_choice: Falseの場合、FactorizedMLPModelを用いるTrainerに変換する
+    :return: SparseMLPModelを用いるTrainerの情報(Trainer.save_state(resume=False)の形式)
+    """
+    constructor_params = copy.deepcopy(state["constructor_params"])
+    constructor_params["feature_params"]["factorized"] = True
+    constructor_params["feature_params"]["sparse_choice"] = sparse_choice
+    trainer = Trainer(**constructor_params)
+    trainer.load_initial_model(state["model"])
+    trainer.update_steps = state["update_steps"]
+    trainer.total_battles = state.get("total_battles", 0)
+    return trainer.save_state()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trainer_id", help="変換元(trainer_id@battles形式も可)")
+    parser.add_argument("--dense_choice", action="store_true", help="選択肢の特徴量を密なままとする")
+    args = parser.parse_args()
+    elems = args.trainer_id.split("@")
+    if len(elems) == 1:
+        f = fs_checkpoint.get_last_version(elems[0])
+    else:
+        f = fs_checkpoint.find_one({"filename": elems[0], "metadata": {"battles": int(elems[1])}})
+    state = convert_trainer_state(unpack_obj(f.read()), sparse_choice=not args.dense_choice)
+
+    trainer_id = ObjectId()
+    col_trainer.insert_one({
+        "_id": trainer_id,
+        "train_params": {"converted_from": args.trainer_id},
+        "tags": ["factorized" if args.dense_choice else "sparse_choice"],
+    })
+    fs_checkpoint.put(pack_obj(state), filename=str(trainer_id), metadata={"battles": state["total_battles"]})
+    print("trainer id", trainer_id)
+
+
+if __name__ == '__main__':
+    main()
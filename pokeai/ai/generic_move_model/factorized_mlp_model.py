@@ -0,0 +1,122 @@
+"""
+1層目を状態部分と選択肢部分に分解したモデル(FeatureExtractor(factorized=True)の特徴量を受け取る)
+MLPModelの1層目(kernel size 1のConv1d)は、全選択肢に同じ値が入っている状態部分の射影を選択肢ごとに計算している
+状態部分の射影を1回だけ計算し、選択肢部分の射影に加算することで同じ出力を得る
+2層目以降はMLPModelと同じで、MLPModelの重みはconvert_mlp_state_dictで変換できる
+"""
+import math
+from collections import OrderedDict
+from typing import Dict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class FactorizedMLPModel(nn.Module):
+    def __init__(self, input_shape, output_dim, state_dims, choice_dims, n_layers=2, n_channels=64, bn=False):
+        """
+        :param input_shape: (state_dims + self.choice_input_size(choice_dims, output_dim),)
+        :param output_dim:
+        :param state_dims: 状態の特徴量の次元数
+        :param choice_dims: 選択肢の特徴量の次元数(ChoiceToVec.get_dims())
+        :param n_layers:
+        :param n_channels:
+        :param bn:
+        """
+        super().__init__()
+        assert input_shape[0] == state_dims + self.choice_input_size(choice_dims, output_dim)
+        assert n_layers >= 1
+        self.state_dims = state_dims
+        self.choice_dims = choice_dims
+        self.output_dim = output_dim
+        self.n_layers = n_layers
+        self.n_channels = n_channels
+        self.state_layer = nn.Linear(state_dims, n_channels, bias=not bn)
+        self._construct_choice_layer()
+        layers = []
+        bn_layers = []
+        for i in range(n_layers):
+            if i > 0:
+                layers.append(nn.Conv1d(n_channels, n_channels, 1, bias=not bn))  # in,out,ksize
+            if bn:
+                bn_layers.append(nn.BatchNorm1d(n_channels))
+        self.layers = nn.ModuleList(layers)
+        self.bn_layers = nn.ModuleList(bn_layers)
+        self.output = nn.Conv1d(n_channels, 1, 1)
+        self.bn = bn
+        # MLPModelの1層目(入力次元数state_dims + choice_dimsのConv1d)と同じ範囲で初期化する
+        bound = 1.0 / math.sqrt(state_dims + choice_dims)
+        with torch.no_grad():
+            nn.init.uniform_(self.state_layer.weight, -bound, bound)
+            if self.state_layer.bias is not None:
+                nn.init.uniform_(self.state_layer.bias, -bound, bound)
+            self._reset_choice_layer(bound)
+
+    @staticmethod
+    def choice_input_size(choice_dims: int, output_dim: int) -> int:
+        """
+        入力のうち選択肢部分の要素数
+        """
+        return choice_dims * output_dim
+
+    def _construct_choice_layer(self):
+        self.choice_layer = nn.Linear(self.choice_dims, self.n_channels, bias=False)
+
+    def _reset_choice_layer(self, bound: float):
+        nn.init.uniform_(self.choice_layer.weight, -bound, bound)
+
+    def _project_choice(self, x_choice):
+        """
+        選択肢部分の射影
+        :param x_choice: batch, self.choice_input_size
+        :return: batch, output_dim, n_channels
+        """
+        # 選択肢ごとの特徴量が連続しているため、(batch * output_dim, choice_dims)の1回の行列積となる
+        return self.choice_layer(x_choice.view(x_choice.shape[0], self.output_dim, self.choice_dims))
+
+    def forward(self, x):
+        # x: batch, state_dims + choice_input_size
+        h = self.state_layer(x[:, :self.state_dims]).unsqueeze(1) + self._project_choice(x[:, self.state_dims:])
+        h = h.transpose(1, 2)  # batch, n_channels, 4
+        for i in range(self.n_layers):
+            if i > 0:
+                h = self.layers[i - 1](h)
+            if self.bn:
+                h = self.bn_layers[i](h)
+            h = F.relu(h)
+        h = self.output(h)
+        h = h.view(h.shape[0], -1)  # batch, 4
+        return h
+
+
+def convert_mlp_state_dict(state_dict: Dict[str, torch.Tensor], state_dims: int,
+                           sparse_choice: bool = False) -> Dict[str, torch.Tensor]:
+    """
+    MLPModelの重みを、同じ出力となるFactorizedMLPModel(sparse_choice=TrueならSparseMLPModel)の重みに変換する
+    :param state_dict: MLPModel.state_dict()
+    :param state_dims: 状態の特徴量の次元数。1層目の入力チャンネルのうち先頭state_dims個が状態、残りが選択肢
+    :param sparse_choice:
+    :return: FactorizedMLPModel.state_dict()
+    """
+    converted = OrderedDict()
+    for key, value in state_dict.items():
+        elems = key.split(".")
+        if elems[0] == "layers":
+            layer_idx = int(elems[1])
+            if layer_idx == 0:
+                if elems[2] == "weight":
+                    weight = value[:, :, 0]  # out, in
+                    converted["state_layer.weight"] = weight[:, :state_dims].clone()
+                    if sparse_choice:
+                        # パディングのインデックスに対応する行は0
+                        converted["choice_embedding.weight"] = torch.cat(
+                            [weight[:, state_dims:].t(), weight.new_zeros((1, weight.shape[0]))], dim=0)
+                    else:
+                        converted["choice_layer.weight"] = weight[:, state_dims:].clone()
+                else:
+                    converted["state_layer.bias"] = value.clone()
+                continue
+            elems[1] = str(layer_idx - 1)
+        converted[".".join(elems)] = value.clone()
+    return converted
@@ -1,15 +1,26 @@
-from typing import Tuple
+from typing import Optional, Sequence, Tuple
 
 import numpy as np
 
 from pokeai.ai.state_feature_extractor import StateFeatureExtractor
-from pokeai.ai.generic_move_model.choice_to_vec import ChoiceToVec
+from pokeai.ai.generic_move_model.choice_to_vec import ChoiceToVec, MAX_CHOICE_INDICES
 from pokeai.ai.rl_policy_observation import RLPolicyObservation
 
 
 class FeatureExtractor:
-    def __init__(self, party_size: int):
+    def __init__(self, party_size: int, factorized: bool = False, sparse_choice: bool = False):
+        """
+        :param party_size:
+        :param factorized: 状態の特徴量を選択肢ごとに複製しない。
+        特徴量は(状態の特徴量, 選択肢の特徴量((output_dim, choice_dims)を平坦化したもの))を連結した1次元ベクトルとなり、
+        FactorizedMLPModelで扱う
+        :param sparse_choice: factorizedに加え、選択肢の特徴量を疎な表現(ChoiceToVec.transform_sparseのインデックス)とする。
+        特徴量は(状態の特徴量, 選択肢ごとのインデックスをfloat32で表したもの)を連結した1次元ベクトルとなり、
+        SparseMLPModelで扱う
+        """
         self.party_size = party_size
+        self.factorized = factorized or sparse_choice
+        self.sparse_choice = sparse_choice
         self.state_feature_extractor = StateFeatureExtractor(feature_types=None, party_size=self.party_size)
         self.choice_to_vec = ChoiceToVec()
 
@@ -20,7 +31,11 @@ class FeatureExtractor:
         :return: 次元数のタプル
         """
         state_dims = self.state_feature_extractor.get_dims()
+        if self.sparse_choice:
+            return (state_dims + self.output_dim * MAX_CHOICE_INDICES),
         choice_dims = self.choice_to_vec.get_dims()
+        if self.factorized:
+            return (state_dims + choice_dims * self.output_dim),
         return (state_dims + choice_dims), self.output_dim
 
     def get_dim_meanings(self):
@@ -43,10 +58,68 @@ class FeatureExtractor:
         :param obs:
         :return: 特徴量(self.input_shape, float32)および合法手マスク((self.output_dim,), int32)
         """
-        feat = np.zeros(self.input_shape, dtype=np.float32)
         state_feat = self.state_feature_extractor.transform(obs)
+        if self.sparse_choice:
+            feat = np.full(self.input_shape, self.choice_to_vec.padding_index, dtype=np.float32)
+            feat[:len(state_feat)] = state_feat
+            feat[len(state_feat):].reshape(self.output_dim, MAX_CHOICE_INDICES)[:len(obs.possible_actions)] = \
+                self.choice_to_vec.transform_sparse(obs)
+            return feat, self.action_mask(obs)
+        feat = np.zeros(self.input_shape, dtype=np.float32)
+        if self.factorized:
+            feat[:len(state_feat)] = state_feat
+            feat[len(state_feat):].reshape(self.output_dim, -1)[:len(obs.possible_actions)] = \
+                self.choice_to_vec.transform(obs).T
+            return feat, self.action_mask(obs)
         feat[:len(state_feat), :] = state_feat[:, np.newaxis]
         feat[len(state_feat):, :len(obs.possible_actions)] = self.choice_to_vec.transform(obs)
+        return feat, self.action_mask(obs)
+
+    def action_mask(self, obs: RLPolicyObservation) -> np.ndarray:
+        """
+        合法手マスク
+        :param obs:
+        :return: ((self.output_dim,), int32)
+        """
         choice_vec = np.zeros((self.output_dim,), dtype=np.int32)
         choice_vec[:len(obs.possible_actions)] = 1
-        return feat, choice_vec
+        return choice_vec
+
+    def transform_batch(self, observations: Sequence[RLPolicyObservation],
+                        out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        複数の観測をまとめて特徴量ベクトルに変換
+        :param observations:
+        :param out: 特徴量の書き込み先((len(observations),) + self.input_shape, float32)。Noneなら新たに確保する
+        :return: 特徴量((len(observations),) + self.input_shape, float32)および合法手マスク((len(observations), self.output_dim), int32)
+        """
+        n = len(observations)
+        if out is None:
+            out = np.empty((n,) + self.input_shape, dtype=np.float32)
+        state_dims = self.state_feature_extractor.get_dims()
+        choice_vecs = np.zeros((n, self.output_dim), dtype=np.int32)
+        if self.sparse_choice:
+            self.state_feature_extractor.transform_batch(observations, out=out[:, :state_dims])
+            choice_indices = out[:, state_dims:].reshape(n, self.output_dim, MAX_CHOICE_INDICES)
+            choice_indices[...] = self.choice_to_vec.padding_index
+            for i, obs in enumerate(observations):
+                n_actions = len(obs.possible_actions)
+                choice_indices[i, :n_actions] = self.choice_to_vec.transform_sparse(obs)
+                choice_vecs[i, :n_actions] = 1
+            return out, choice_vecs
+        if self.factorized:
+            self.state_feature_extractor.transform_batch(observations, out=out[:, :state_dims])
+            out[:, state_dims:] = 0.0
+            choice_feats = out[:, state_dims:].reshape(n, self.output_dim, -1)
+            for i, obs in enumerate(observations):
+                n_actions = len(obs.possible_actions)
+                choice_feats[i, :n_actions] = self.choice_to_vec.transform(obs).T
+                choice_vecs[i, :n_actions] = 1
+            return out, choice_vecs
+        out[:, :state_dims, :] = self.state_feature_extractor.transform_batch(observations)[:, :, np.newaxis]
+        out[:, state_dims:, :] = 0.0
+        for i, obs in enumerate(observations):
+            n_actions = len(obs.possible_actions)
+            out[i, state_dims:, :n_actions] = self.choice_to_vec.transform(obs)
+            choice_vecs[i, :n_actions] = 1
+        return out, choice_vecs
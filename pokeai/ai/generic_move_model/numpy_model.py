@@ -0,0 +1,129 @@
+"""
+学習済みモデル(MLPModel, FactorizedMLPModel, SparseMLPModel)の推論をnumpyのみで行うエンジン
+バッチサイズ1の推論では、モデルの計算量に比べてtorchの呼び出しのオーバーヘッドが大きいため、評価用に用いる
+重みは固定で、BatchNormは直前の層の重みに畳み込む
+Trainer.export_numpy_modelで作成する
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pokeai.ai.generic_move_model.choice_to_vec import MAX_CHOICE_INDICES
+
+# torch.nn.BatchNorm1dのデフォルト値
+BN_EPS = 1e-5
+
+
+class NumpyMLPModel:
+    input_kind: str  # 1層目の種類 dense: MLPModel, factorized: FactorizedMLPModel, sparse: SparseMLPModel
+    output_dim: int
+    state_dims: Optional[int]
+    # 1層目の重み dense: (in, out), factorized: 選択肢部分(choice_dims, out), sparse: 埋め込み(choice_dims + 1, out)
+    _first_weight: np.ndarray
+    _state_weight: Optional[np.ndarray]  # 状態部分(state_dims, out)
+    _first_bias: np.ndarray
+    _layers: List[Tuple[np.ndarray, np.ndarray]]  # 2層目以降の(重み(in, out), バイアス)
+    _output_weight: np.ndarray
+    _output_bias: float
+
+    def __init__(self, state_dict: Dict[str, np.ndarray], output_dim: int):
+        """
+        :param state_dict: モデルのstate_dictの各要素をnumpy配列にしたもの
+        :param output_dim:
+        """
+        self.output_dim = output_dim
+        if "choice_embedding.weight" in state_dict:
+            self.input_kind = "sparse"
+        elif "state_layer.weight" in state_dict:
+            self.input_kind = "factorized"
+        else:
+            self.input_kind = "dense"
+
+        if self.input_kind == "dense":
+            self.state_dims = None
+            self._state_weight = None
+            first_weight = state_dict["layers.0.weight"][:, :, 0]  # out, in
+            self._first_weight, self._first_bias = _fuse_bn(state_dict, 0, first_weight,
+                                                            state_dict.get("layers.0.bias"))
+            layer_offset = 1
+        else:
+            state_weight = state_dict["state_layer.weight"]  # out, in
+            self.state_dims = state_weight.shape[1]
+            self._state_weight, self._first_bias = _fuse_bn(state_dict, 0, state_weight,
+                                                            state_dict.get("state_layer.bias"))
+            if self.input_kind == "sparse":
+                # 埋め込みは(choice_dims + 1, out)なので転置して畳み込む。パディングの行は0のまま
+                choice_weight = state_dict["choice_embedding.weight"].T
+            else:
+                choice_weight = state_dict["choice_layer.weight"]
+            self._first_weight, _ = _fuse_bn(state_dict, 0, choice_weight, None)
+            layer_offset = 0
+        self._layers = []
+        i = 0
+        while f"layers.{i}.weight" in state_dict:
+            if i >= layer_offset:
+                weight = state_dict[f"layers.{i}.weight"][:, :, 0]  # out, in
+                self._layers.append(_fuse_bn(state_dict, i + 1 - layer_offset, weight,
+                                             state_dict.get(f"layers.{i}.bias")))
+            i += 1
+        self._output_weight = np.ascontiguousarray(state_dict["output.weight"][0, :, 0], dtype=np.float32)
+        self._output_bias = float(state_dict["output.bias"][0])
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """
+        q関数を計算する
+        :param x: 特徴量のバッチ((batch,) + FeatureExtractor.input_shape, float32)
+        :return: (batch, output_dim) float32
+        """
+        batch_size = x.shape[0]
+        if self.input_kind == "dense":
+            # batch, in, 4 -> batch, 4, out
+            h = np.matmul(x.transpose(0, 2, 1), self._first_weight)
+            h += self._first_bias
+        else:
+            h_state = x[:, :self.state_dims] @ self._state_weight
+            h_state += self._first_bias
+            x_choice = x[:, self.state_dims:]
+            if self.input_kind == "sparse":
+                choice_indices = x_choice.astype(np.int64).reshape(batch_size, self.output_dim, MAX_CHOICE_INDICES)
+                h = self._first_weight[choice_indices].sum(axis=2)
+            else:
+                h = np.matmul(x_choice.reshape(batch_size, self.output_dim, -1), self._first_weight)
+            h += h_state[:, np.newaxis, :]
+        np.maximum(h, 0.0, out=h)
+        for weight, bias in self._layers:
+            h = h @ weight
+            h += bias
+            np.maximum(h, 0.0, out=h)
+        q = h @ self._output_weight
+        q += self._output_bias
+        return q
+
+    def masked_argmax(self, x: np.ndarray, action_mask: np.ndarray) -> np.ndarray:
+        """
+        合法手のうちq値が最大の行動を求める
+        :param x: 特徴量のバッチ
+        :param action_mask: 合法手マスク(batch, output_dim)
+        :return: 行動(batch,) int64
+        """
+        return np.where(action_mask != 0, self(x), -np.inf).argmax(axis=1)
+
+
+def _fuse_bn(state_dict: Dict[str, np.ndarray], bn_idx: int, weight: np.ndarray,
+             bias: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    重みに直後のBatchNorm(評価時の固定の変換)を畳み込む
+    :param state_dict:
+    :param bn_idx: 直後のBatchNormのインデックス。state_dictにBatchNormがなければ畳み込まない
+    :param weight: (out, in)
+    :param bias: (out,) またはNone
+    :return: 行列積の右辺とする重み(in, out)、バイアス(out,)
+    """
+    if bias is None:
+        bias = np.zeros((weight.shape[0],), dtype=np.float32)
+    if f"bn_layers.{bn_idx}.weight" in state_dict:
+        prefix = f"bn_layers.{bn_idx}."
+        scale = state_dict[prefix + "weight"] / np.sqrt(state_dict[prefix + "running_var"] + BN_EPS)
+        weight = weight * scale[:, np.newaxis]
+        bias = (bias - state_dict[prefix + "running_mean"]) * scale + state_dict[prefix + "bias"]
+    return np.ascontiguousarray(weight.T, dtype=np.float32), bias.astype(np.float32)
@@ -0,0 +1,105 @@
+"""
+リプレイバッファに特徴量を省メモリで格納するための変換
+特徴量の大部分は、ChoiceToVecのone-hot vector(ほぼ0)と、その選択肢の数だけの状態の特徴量の複製である
+状態の特徴量はfloat16で1回だけ、選択肢の特徴量は1となる要素のインデックス(ChoiceToVec.transform_sparseと同じ形式)で格納し、
+サンプル時に元の形状の特徴量に戻す
+状態の特徴量のうち比で表すもの(hp_ratio等)はfloat16の精度(相対誤差約5e-4)に丸められる
+"""
+from typing import Dict
+
+import numpy as np
+
+from pokeai.ai.generic_move_model.choice_to_vec import MAX_CHOICE_INDICES
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+
+
+class CompactObservationCodec:
+    """
+    FeatureExtractorの特徴量のバッチと、省メモリな表現({"state": float16, "choice": int16})を相互に変換する
+    """
+    input_kind: str  # 特徴量の形式 dense: MLPModel, factorized: FactorizedMLPModel, sparse: SparseMLPModel
+    state_dims: int
+    choice_dims: int
+    output_dim: int
+
+    def __init__(self, input_kind: str, state_dims: int, choice_dims: int, output_dim: int):
+        assert input_kind in ("dense", "factorized", "sparse")
+        # パディングのインデックス(choice_dims)がint16に収まること
+        assert choice_dims < np.iinfo(np.int16).max
+        self.input_kind = input_kind
+        self.state_dims = state_dims
+        self.choice_dims = choice_dims
+        self.output_dim = output_dim
+
+    @classmethod
+    def from_feature_extractor(cls, feature_extractor: FeatureExtractor) -> "CompactObservationCodec":
+        if feature_extractor.sparse_choice:
+            input_kind = "sparse"
+        elif feature_extractor.factorized:
+            input_kind = "factorized"
+        else:
+            input_kind = "dense"
+        return cls(input_kind, feature_extractor.state_feature_extractor.get_dims(),
+                   feature_extractor.choice_to_vec.get_dims(), feature_extractor.output_dim)
+
+    def encode(self, feats: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        特徴量のバッチを省メモリな表現に変換する
+        :param feats: (batch,) + FeatureExtractor.input_shape, float32
+        :return: {"state": (batch, state_dims) float16, "choice": (batch, output_dim, MAX_CHOICE_INDICES) int16}
+        """
+        n = feats.shape[0]
+        if self.input_kind == "dense":
+            # 状態の特徴量は全選択肢で同じ
+            state = feats[:, :self.state_dims, 0]
+            choice = feats[:, self.state_dims:, :].transpose(0, 2, 1)
+        else:
+            state = feats[:, :self.state_dims]
+            choice = feats[:, self.state_dims:].reshape(n, self.output_dim, -1)
+        if self.input_kind == "sparse":
+            # 選択肢部分はすでにインデックス(エピソード終端の0埋めの特徴量もそのまま格納する)
+            choice_indices = choice.astype(np.int16)
+        else:
+            sample_idx, action_idx, dim_idx = np.nonzero(choice)
+            assert np.all(choice[sample_idx, action_idx, dim_idx] == 1.0), "choice features must be one-hot"
+            # np.nonzeroの結果は(サンプル, 選択肢)の順に並ぶため、同じ選択肢内での順番は先頭からの位置で求まる
+            flat_idx = sample_idx * self.output_dim + action_idx
+            position = np.arange(len(flat_idx)) - np.searchsorted(flat_idx, flat_idx)
+            assert np.all(position < MAX_CHOICE_INDICES)
+            choice_indices = np.full((n * self.output_dim, MAX_CHOICE_INDICES), self.choice_dims, dtype=np.int16)
+            choice_indices[flat_idx, position] = dim_idx
+            choice_indices = choice_indices.reshape(n, self.output_dim, MAX_CHOICE_INDICES)
+        return {"state": state.astype(np.float16), "choice": choice_indices}
+
+    def decode(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+        encodeの結果を特徴量のバッチに戻す
+        :param encoded:
+        :return: (batch,) + FeatureExtractor.input_shape, float32
+        """
+        state = encoded["state"]
+        choice_indices = encoded["choice"]
+        n = state.shape[0]
+        if self.input_kind == "sparse":
+            feats = np.empty((n, self.state_dims + self.output_dim * MAX_CHOICE_INDICES), dtype=np.float32)
+            feats[:, :self.state_dims] = state
+            feats[:, self.state_dims:] = choice_indices.reshape(n, -1)
+            return feats
+        # パディングのインデックスに対応する要素を末尾に追加した配列に1を書き込み、コピー時に除く
+        sample_idx = np.arange(n)[:, np.newaxis, np.newaxis]
+        action_idx = np.arange(self.output_dim)[np.newaxis, :, np.newaxis]
+        if self.input_kind == "factorized":
+            choice = np.zeros((n, self.output_dim, self.choice_dims + 1), dtype=np.float32)
+            choice[sample_idx, action_idx, choice_indices] = 1.0
+            feats = np.empty((n, self.state_dims + self.output_dim * self.choice_dims), dtype=np.float32)
+            feats[:, :self.state_dims] = state
+            feats[:, self.state_dims:].reshape(n, self.output_dim, self.choice_dims)[...] = \
+                choice[:, :, :self.choice_dims]
+            return feats
+        # MLPModelの特徴量は(次元, 選択肢)の順
+        choice = np.zeros((n, self.choice_dims + 1, self.output_dim), dtype=np.float32)
+        choice[sample_idx, choice_indices, action_idx] = 1.0
+        feats = np.empty((n, self.state_dims + self.choice_dims, self.output_dim), dtype=np.float32)
+        feats[:, :self.state_dims, :] = state[:, :, np.newaxis]
+        feats[:, self.state_dims:, :] = choice[:, :self.choice_dims, :]
+        return feats
@@ -0,0 +1,148 @@
+"""
+Prioritized experience replay (Schaul et al., 2015)
+遷移をTD誤差に応じた確率でサンプルし、サンプルの偏りを重要度重み(importance-sampling weight)で補正する
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+from pokeai.ai.generic_move_model.observation_codec import CompactObservationCodec
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer, ReplayBatch
+
+
+class SumTree:
+    """
+    各要素の値(優先度)と、その部分和を二分木で保持する
+    値の更新と、累積和に対応する要素の探索がO(log n)で、いずれもバッチで行う
+    """
+    size: int
+    _n_leaves: int  # size以上の2のべき乗
+    _tree: np.ndarray  # _tree[1]が根、_tree[i]の子が_tree[2i], _tree[2i+1]、葉は_tree[_n_leaves:]
+
+    def __init__(self, size: int):
+        self.size = size
+        self._n_leaves = 1
+        while self._n_leaves < size:
+            self._n_leaves *= 2
+        self._tree = np.zeros((self._n_leaves * 2,), dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return float(self._tree[1])
+
+    def get(self, indices: np.ndarray) -> np.ndarray:
+        return self._tree[indices + self._n_leaves]
+
+    def update(self, indices: np.ndarray, values: np.ndarray):
+        """
+        要素indicesの値をvaluesにする
+        """
+        nodes = np.asarray(indices) + self._n_leaves
+        if len(nodes) == 0:
+            return
+        self._tree[nodes] = values
+        # 親の値は差分の加算ではなく子の和で求め直し、誤差の蓄積を避ける
+        # 重複したノードには同じ値が書き込まれるため、重複を除く必要はない
+        while nodes[0] > 1:
+            nodes = nodes // 2
+            self._tree[nodes] = self._tree[nodes * 2] + self._tree[nodes * 2 + 1]
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        累積和がvaluesを超える最初の要素を求める
+        :param values: [0, total)の値
+        :return: 要素のインデックス
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=np.int64)
+        while nodes[0] < self._n_leaves:
+            left = nodes * 2
+            left_values = self._tree[left]
+            # 丸め誤差で値が0の部分木(未使用の要素)に進まないようにする
+            go_right = (values >= left_values) & (self._tree[left + 1] > 0.0)
+            values -= np.where(go_right, left_values, 0.0)
+            nodes = left + go_right
+        return nodes - self._n_leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    優先度付きのリプレイバッファ
+    遷移iをサンプルする確率は p_i^alpha / sum_j p_j^alpha (p_iはTD誤差の絶対値+epsilon)
+    新しい遷移には、それまでの最大の優先度を与える
+    """
+    alpha: float
+    epsilon: float
+    _sum_tree: SumTree  # 配列上の位置ごとの p_i^alpha
+    _max_priority: float  # p_i^alphaの最大値
+
+    def __init__(self, size: int, codec: Optional[CompactObservationCodec] = None, alpha: float = 0.6,
+                 epsilon: float = 1e-3):
+        assert size is not None
+        super().__init__(size, codec)
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self._sum_tree = SumTree(size)
+        self._max_priority = 1.0
+
+    def _on_write(self, indices: np.ndarray):
+        self._sum_tree.update(indices, self._max_priority)
+
+    def truncate(self, length: int):
+        removed = self._logical_to_physical(np.arange(length, self._len)) if length < self._len else None
+        super().truncate(length)
+        if removed is not None:
+            self._sum_tree.update(removed, 0.0)
+
+    def sample_prioritized(self, size: int, beta: float) -> Tuple[ReplayBatch, np.ndarray, np.ndarray]:
+        """
+        優先度に比例した確率でsize個の遷移をサンプルする(重複あり)
+        全体をsize個の区間に分け、各区間から1つずつサンプルする
+        :param size:
+        :param beta: 重要度重みの指数。1で偏りを完全に補正する
+        :return: バッチ、配列上の位置(update_prioritiesに与える)、重要度重み(最大値で割ったもの) float32
+        """
+        if len(self) < size:
+            raise IndexError
+        total = self._sum_tree.total
+        segment = total / size
+        values = (np.arange(size) + np.random.uniform(size=size)) * segment
+        indices = self._sum_tree.find(np.minimum(values, total))
+        probs = self._sum_tree.get(indices) / total
+        weights = np.power(len(self) * probs, -beta)
+        weights /= weights.max()
+        return self._read(indices), indices, weights.astype(np.float32)
+
+    def update_priorities(self, indices: np.ndarray, td_errors: np.ndarray):
+        """
+        サンプルした遷移の優先度を、学習時のTD誤差で更新する
+        同じ遷移が複数回サンプルされた場合、最後の値とする
+        :param indices: sample_prioritizedが返した位置
+        :param td_errors: TD誤差
+        """
+        priorities = np.power(np.abs(td_errors).astype(np.float64) + self.epsilon, self.alpha)
+        self._sum_tree.update(indices, priorities)
+        self._max_priority = max(self._max_priority, float(priorities.max()))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["priorities"] = self._sum_tree.get(self._logical_to_physical(np.arange(self._len))) \
+            if self._arrays is not None else None
+        state["max_priority"] = self._max_priority
+        return state
+
+    def __setstate__(self, state):
+        params = state.copy()
+        priorities = params.pop("priorities")
+        max_priority = params.pop("max_priority")
+        super().__setstate__(params)
+        # 復元した遷移は古い順に先頭から格納されている
+        if priorities is not None:
+            self._sum_tree.update(np.arange(len(priorities)), priorities)
+        self._max_priority = max_priority
+
+    def _constructor_params(self) -> dict:
+        params = super()._constructor_params()
+        params["alpha"] = self.alpha
+        params["epsilon"] = self.epsilon
+        return params
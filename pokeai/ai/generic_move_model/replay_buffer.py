@@ -1,8 +1,9 @@
-from collections import deque
 import random
-from typing import NamedTuple, Optional, List, Iterable
+from typing import NamedTuple, Optional, Iterable, Dict
 import numpy as np
 
+from pokeai.ai.generic_move_model.observation_codec import CompactObservationCodec
+
 
 class ReplayBufferItem(NamedTuple):
     state: np.ndarray
@@ -13,20 +14,226 @@ class ReplayBufferItem(NamedTuple):
     reward: float
 
 
+class ReplayBatch(NamedTuple):
+    """
+    ReplayBufferからサンプルしたバッチ。各要素の先頭の次元がバッチ
+    """
+    state: np.ndarray
+    action_mask: np.ndarray
+    action: np.ndarray  # int64
+    next_state: np.ndarray  # エピソード終端では0
+    next_action_mask: np.ndarray  # エピソード終端では0
+    reward: np.ndarray  # float32
+    done: np.ndarray  # bool エピソード終端ならTrue
+
+
+# 上限なしのバッファの初期容量
+_INITIAL_CAPACITY = 256
+# codecで変換して格納する要素
+_OBSERVATION_FIELDS = ("state", "next_state")
+
+
 class ReplayBuffer:
-    def __init__(self, size: Optional[int]):
-        self.buffer = deque(maxlen=size)
+    """
+    遷移を、要素ごとに確保済みの連続した配列に格納するリングバッファ
+    配列は最初の遷移の追加時に、その形状に合わせて確保する
+    上限(size)を超えると古い遷移から上書きする。sizeがNoneなら上限なしで、容量が不足したら拡張する
+    codecを指定すると、state, next_stateを省メモリな表現で格納し、サンプル時に元の特徴量に戻す
+    """
+    size: Optional[int]
+    codec: Optional[CompactObservationCodec]
+    _arrays: Optional[Dict[str, np.ndarray]]  # 格納する要素名 -> (容量, ...)の配列
+    _next: int  # 次に書き込む位置
+    _len: int
+
+    def __init__(self, size: Optional[int], codec: Optional[CompactObservationCodec] = None):
+        self.size = size
+        self.codec = codec
+        self._arrays = None
+        self._next = 0
+        self._len = 0
 
     def __len__(self):
-        return len(self.buffer)
+        return self._len
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self._arrays is None else len(self._arrays["reward"])
+
+    def nbytes_per_transition(self) -> int:
+        """
+        1遷移の格納に用いるバイト数。配列の確保前は0
+        """
+        if self._arrays is None:
+            return 0
+        return sum(array[0].nbytes for array in self._arrays.values())
+
+    def _to_storage(self, batch: ReplayBatch) -> Dict[str, np.ndarray]:
+        """
+        遷移のバッチを、格納する要素名 -> 配列のdictに変換する
+        """
+        storage = batch._asdict()
+        if self.codec is not None:
+            for name in _OBSERVATION_FIELDS:
+                for key, value in self.codec.encode(storage.pop(name)).items():
+                    storage[f"{name}/{key}"] = value
+        return storage
+
+    def _from_storage(self, storage: Dict[str, np.ndarray]) -> ReplayBatch:
+        if self.codec is not None:
+            storage = storage.copy()
+            for name in _OBSERVATION_FIELDS:
+                prefix = name + "/"
+                encoded = {key[len(prefix):]: storage.pop(key) for key in list(storage) if key.startswith(prefix)}
+                storage[name] = self.codec.decode(encoded)
+        return ReplayBatch(**storage)
+
+    def _allocate(self, storage: Dict[str, np.ndarray], capacity: int):
+        """
+        storageの各要素(先頭の次元がバッチ)と同じ形状・型の配列を確保する
+        """
+        self._arrays = {}
+        for name, value in storage.items():
+            self._arrays[name] = np.zeros((capacity,) + value.shape[1:], dtype=value.dtype)
+
+    def _reserve(self, storage: Dict[str, np.ndarray], n: int):
+        """
+        n個の遷移を追加できるよう配列を確保・拡張する
+        """
+        if self._arrays is None:
+            if self.size is not None:
+                capacity = self.size
+            else:
+                capacity = max(_INITIAL_CAPACITY, n)
+            self._allocate(storage, capacity)
+        elif self.size is None and self._len + n > self.capacity:
+            # 拡張後の配列には古い順に先頭から詰める
+            capacity = max(self.capacity * 2, self._len + n)
+            old_indices = self._logical_to_physical(np.arange(self._len))
+            old_arrays = self._arrays
+            self._allocate(storage, capacity)
+            for name, array in self._arrays.items():
+                array[:self._len] = old_arrays[name][old_indices]
+            self._next = self._len
+
+    def _write_storage(self, storage: Dict[str, np.ndarray]):
+        """
+        格納する形式に変換済みの遷移のバッチを追加する
+        """
+        n = len(storage["reward"])
+        if n == 0:
+            return
+        if self.size is not None and n > self.size:
+            storage = {name: value[-self.size:] for name, value in storage.items()}
+            n = self.size
+        self._reserve(storage, n)
+        capacity = self.capacity
+        indices = (self._next + np.arange(n)) % capacity
+        self._next = (self._next + n) % capacity
+        self._len = min(self._len + n, capacity)
+        for name, array in self._arrays.items():
+            array[indices] = storage[name]
+        self._on_write(indices)
+
+    def _on_write(self, indices: np.ndarray):
+        """
+        配列上の位置indicesに遷移を書き込んだ後に呼ばれる
+        """
+        pass
+
+    def _read(self, indices: np.ndarray) -> ReplayBatch:
+        """
+        配列上の位置indicesの遷移をバッチとして読み出す
+        """
+        return self._from_storage({name: array[indices] for name, array in self._arrays.items()})
 
     def append(self, item: ReplayBufferItem):
-        self.buffer.append(item)
+        self.extend([item])
 
     def extend(self, items: Iterable[ReplayBufferItem]):
-        self.buffer.extend(items)
+        items = list(items)
+        if len(items) == 0:
+            return
+        # 終端の遷移のnext_stateは0とする
+        zero_state = np.zeros_like(items[0].state)
+        zero_action_mask = np.zeros_like(items[0].action_mask)
+        batch = ReplayBatch(
+            state=np.stack([item.state for item in items]),
+            action_mask=np.stack([item.action_mask for item in items]),
+            action=np.array([item.action for item in items], dtype=np.int64),
+            next_state=np.stack([zero_state if item.next_state is None else item.next_state for item in items]),
+            next_action_mask=np.stack([zero_action_mask if item.next_action_mask is None else item.next_action_mask
+                                       for item in items]),
+            reward=np.array([item.reward for item in items], dtype=np.float32),
+            done=np.array([item.next_state is None for item in items], dtype=np.bool_))
+        self._write_storage(self._to_storage(batch))
+
+    def extend_buffer(self, other: "ReplayBuffer"):
+        """
+        他のバッファの全遷移を、古い順に追加する
+        """
+        n = len(other)
+        if n == 0:
+            return
+        start = 0 if self.size is None else max(0, n - self.size)
+        src_indices = other._logical_to_physical(np.arange(start, n))
+        if self.codec is None and other.codec is None:
+            self._write_storage({name: array[src_indices] for name, array in other._arrays.items()})
+        else:
+            self._write_storage(self._to_storage(other._read(src_indices)))
 
-    def sample(self, size: int) -> List[ReplayBufferItem]:
+    def truncate(self, length: int):
+        """
+        新しい遷移から削除し、長さをlengthにする
+        """
+        assert 0 <= length <= self._len
+        if self._arrays is not None:
+            self._next = (self._next - (self._len - length)) % self.capacity
+        self._len = length
+
+    def _logical_to_physical(self, indices: np.ndarray) -> np.ndarray:
+        """
+        古い順の番号を、配列上の位置に変換する
+        """
+        # 最も古い遷移は、次に書き込む位置の_len個前
+        return (self._next - self._len + indices) % self.capacity
+
+    def sample_batch(self, size: int) -> ReplayBatch:
+        """
+        重複なしで一様にsize個の遷移をサンプルする
+        :param size:
+        :return: バッチ。各要素は新しく確保した配列
+        """
         if len(self) < size:
             raise IndexError
-        return random.sample(self.buffer, size)
+        return self._read(self._logical_to_physical(np.array(random.sample(range(self._len), size), dtype=np.int64)))
+
+    def __getstate__(self):
+        # 格納済みの遷移のみを古い順に保存する
+        if self._arrays is None:
+            arrays = None
+        else:
+            indices = self._logical_to_physical(np.arange(self._len))
+            arrays = {name: array[indices] for name, array in self._arrays.items()}
+        state = self._constructor_params()
+        state["arrays"] = arrays
+        return state
+
+    def __setstate__(self, state):
+        if "buffer" in state:
+            # 旧形式(遷移をdequeで保持)のチェックポイント
+            buffer = state["buffer"]
+            self.__init__(buffer.maxlen)
+            self.extend(buffer)
+            return
+        params = state.copy()
+        arrays = params.pop("arrays")
+        self.__init__(**params)
+        if arrays is not None:
+            self._write_storage(arrays)
+
+    def _constructor_params(self) -> dict:
+        """
+        pickleした状態から復元する際に、コンストラクタに与える引数
+        """
+        return {"size": self.size, "codec": self.codec}
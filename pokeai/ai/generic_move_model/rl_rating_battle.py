@@ -3,29 +3,57 @@
 パーティ数*trainer数のプレイヤーがいると想定して対戦
 """
 import argparse
+import asyncio
 import json
 import logging
 from logging import getLogger
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
 from bson import ObjectId
 
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.ai.generic_move_model.batched_inference import BatchedInferenceServer
 from pokeai.ai.generic_move_model.trainer_loader import load_trainer
 from pokeai.ai.party_db import col_party, col_rate
 from pokeai.ai.random_policy import RandomPolicy
 from pokeai.ai.rl_policy import RLPolicy
 from pokeai.ai.surrogate_reward_config import SurrogateRewardConfigZero
+from pokeai.sim.async_sim import AsyncSim
+from pokeai.sim.battle_result_cache import BattleResultCache
 from pokeai.sim.battle_stream_processor import BattleStreamProcessor
-from pokeai.sim.sim import Sim
+from pokeai.sim.sim import Sim, make_battle_seed
+from pokeai.sim.sim_pool import SimPool
+from pokeai.sim.trace_recorder import TraceRecorder
 from pokeai.util import json_dump, json_load, setup_logging
 
 logger = getLogger(__name__)
 
 
-def match_players(sim, parties, policies):
+def _winner_idx(battle_result: dict) -> int:
+    return {'p1': 0, 'p2': 1, '': -1}[battle_result['winner']]
+
+
+def match_players(sim, parties, policies, seed: Optional[List[int]] = None,
+                  result_cache: Optional[BattleResultCache] = None, agent_infos: Optional[List[dict]] = None):
+    """
+    1回対戦を行う
+    :param sim:
+    :param parties:
+    :param policies:
+    :param seed: バトルの乱数シード。Noneならランダム
+    :param result_cache: 指定した場合、同じ条件のバトル結果がキャッシュにあれば対戦を省略する
+    :param agent_infos: トレースに記録する各プレイヤーの情報
+    :return: 勝者 0/1/-1（引き分け）
+    """
+    cache_key = None
+    if result_cache is not None:
+        cache_key = result_cache.make_key(parties, policies, seed)
+        cached_result = result_cache.get(cache_key)
+        if cached_result is not None:
+            return _winner_idx(cached_result)
     bsps = []
     for i in [0, 1]:
         bsp = BattleStreamProcessor()
@@ -34,8 +62,10 @@ def match_players(sim, parties, policies):
     sim.set_processor(bsps)
     sim.set_party(parties)
     with torch.no_grad():
-        result = sim.run()
-    winner = {'p1': 0, 'p2': 1, '': -1}[result['winner']]
+        result = sim.run(seed, agent_infos)
+    if result_cache is not None:
+        result_cache.put(cache_key, result)
+    winner = _winner_idx(result)
     return winner
 
 
@@ -83,8 +113,9 @@ class MatchAlgorithmRoundRobin:
         
         return self.pool.pop()
 
-def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates: List[float] = None, match_algorithm: str = "near_rate") -> Tuple[
-    List[float], list]:
+def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates: List[float] = None, match_algorithm: str = "near_rate", sim_procs: int = 0, use_async_sim: bool = False,
+                  seed: Optional[int] = None, result_cache: Optional[BattleResultCache] = None,
+                  trace_recorder: Optional[TraceRecorder] = None) -> Tuple[List[float], list]:
     """
     パーティ同士を多数戦わせ、レーティングを算出する。
     :param parties:
@@ -92,11 +123,27 @@ def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates:
     :param match_count: 1エージェント当たりの対戦回数
     :param fixed_rates: 各パーティの固定レート。固定されてないパーティは0。
     :param match_algorithm: 対戦相手を決めるアルゴリズム。"near_rate": レートの近い者同士を対戦させる。 "round_robin": 総当たり。
+    :param sim_procs: 0より大きい場合、その数のシミュレータプロセスを持つSimPoolで、同じ回の対戦を並行して行う。
+    :param use_async_sim: SimPoolの代わりにAsyncSimを用いる。方策の推論をBatchedInferenceServerでまとめる場合に指定する。
+    :param seed: 指定した場合、各対戦の乱数シードを(seed, 回, 対戦するプレイヤー)から決定的に定める
+    :param result_cache: 指定した場合、同じ条件の対戦結果がキャッシュにあれば対戦を省略する(seedの指定が必要)
+    :param trace_recorder: 指定した場合、対戦の経過を記録する。対戦を並行して行う場合(sim_procs, use_async_sim)は非対応
     :return: パーティのレーティングおよび対戦ログ
     """
     assert len(parties) == len(policies)
     assert len(fixed_rates) == len(parties)
-    sim = Sim()
+    loop = None
+    if use_async_sim:
+        loop = asyncio.new_event_loop()
+        sim = AsyncSim(max(sim_procs, 1))
+    elif sim_procs > 0:
+        sim = SimPool(sim_procs)
+    else:
+        sim = Sim()
+    if trace_recorder is not None:
+        # トレースの記録はSimのみ対応するため、1プロセスで順に対戦する場合のみ記録できる
+        assert isinstance(sim, Sim), "trace_recorder is not supported with sim_procs or use_async_sim"
+        sim.set_trace_recorder(trace_recorder)
 
     # レート初期値設定
     rates = np.full((len(parties),), 1500.0)
@@ -117,17 +164,22 @@ def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates:
         # レーティングに乱数を加算し、ソートして隣接パーティ同士を戦わせる
         # rates_with_random = rates + np.random.normal(scale=200., size=rates.shape)
         # ranking = np.argsort(rates_with_random).tolist()  # type: List[int]
-        match_pairs = match_algorithm_generator.get_next_matches(rates)
-        for left, right in match_pairs:
+        match_pairs = []
+        for left, right in match_algorithm_generator.get_next_matches(rates):
             if fixed_rates[left] != 0 and fixed_rates[right] != 0:
                 # どちらもレート固定パーティなので、対戦不要
                 continue
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug(f"match start: " + json.dumps({
-                    "p1": {"player_id": player_ids[left], "party": parties[left]},
-                    "p2": {"player_id": player_ids[right], "party": parties[right]},
-                }))
-            winner = match_players(sim, [parties[left], parties[right]], [policies[left], policies[right]])
+            match_pairs.append((left, right))
+        if seed is not None:
+            seeds = [make_battle_seed(seed, i, left, right) for left, right in match_pairs]
+        else:
+            seeds = [None] * len(match_pairs)
+        if use_async_sim:
+            played = loop.run_until_complete(
+                _play_matches_async(sim, parties, policies, match_pairs, seeds, result_cache))
+        else:
+            played = _play_matches(sim, parties, policies, player_ids, match_pairs, seeds, result_cache)
+        for left, right, winner in played:
             # レートを変動させる
             if winner >= 0:
                 left_winrate = 1.0 / (1.0 + 10.0 ** ((rates[right] - rates[left]) / 400.0))
@@ -148,9 +200,109 @@ def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates:
             }))
         abs_mean_diff = np.mean(np.abs(rates - 1500.0))
         logger.info(f"{i} rate mean diff: {abs_mean_diff}")
+    if use_async_sim:
+        loop.run_until_complete(sim.close())
+        loop.close()
+    else:
+        if isinstance(sim, Sim):
+            logger.info(f"simulator: {sim.supervisor.stats()}")
+        sim.close()
     return rates.tolist(), log
 
 
+def _lookup_cache(parties, policies, match_pairs: List[Tuple[int, int]], seeds: List[Optional[List[int]]],
+                  result_cache: Optional[BattleResultCache]) -> Tuple[List[Tuple[int, int, int]], List[int], List[
+    Optional[str]]]:
+    """
+    キャッシュに結果がある対戦とない対戦を分ける
+    :return: キャッシュにあった対戦の(left, right, winner)のリスト、対戦が必要なmatch_pairsのインデックス、各対戦のキャッシュのキー
+    """
+    cached = []
+    to_play = []
+    cache_keys = []
+    for pair_idx, (left, right) in enumerate(match_pairs):
+        cache_key = None
+        cached_result = None
+        if result_cache is not None:
+            cache_key = result_cache.make_key([parties[left], parties[right]], [policies[left], policies[right]],
+                                              seeds[pair_idx])
+            cached_result = result_cache.get(cache_key)
+        cache_keys.append(cache_key)
+        if cached_result is not None:
+            cached.append((left, right, _winner_idx(cached_result)))
+        else:
+            to_play.append(pair_idx)
+    return cached, to_play, cache_keys
+
+
+def _new_battle_policy(policy: ActionPolicy) -> ActionPolicy:
+    """
+    1回の対戦の1プレイヤーが用いる方策のインスタンスを作る
+    RandomPolicy(RLPolicyも継承している)の乱数生成器やRLPolicyの報酬の計算状態はバトルごとに初期化されるため、
+    並行する対戦間や対戦の両プレイヤー間でインスタンスを共有すると、シードを指定しても対戦の進行が順序に依存する
+    RLPolicyのエージェント(AgentVal)は状態を持たないので共有する
+    """
+    if isinstance(policy, RLPolicy):
+        return RLPolicy(policy.agent, policy.surrogate_reward_config)
+    if isinstance(policy, RandomPolicy):
+        return RandomPolicy(policy.switch_prob)
+    return policy
+
+
+def _play_matches(sim, parties, policies, player_ids, match_pairs: List[Tuple[int, int]],
+                  seeds: List[Optional[List[int]]], result_cache: Optional[BattleResultCache]) -> Iterator[
+    Tuple[int, int, int]]:
+    """
+    対戦を行い、終了したものから(left, right, winner)を返す
+    simがSimPoolの場合は並行して対戦する。
+    方策は対戦・プレイヤーごとに別インスタンスとする(_new_battle_policy)。同じtrainerのプレイヤー同士の対戦もあるため、順に対戦する場合も同様
+    """
+    if isinstance(sim, SimPool):
+        cached, to_play, cache_keys = _lookup_cache(parties, policies, match_pairs, seeds, result_cache)
+        yield from cached
+        matchups = [[parties[match_pairs[pair_idx][0]], parties[match_pairs[pair_idx][1]]] for pair_idx in to_play]
+        match_policies = [[_new_battle_policy(policies[match_pairs[pair_idx][0]]),
+                           _new_battle_policy(policies[match_pairs[pair_idx][1]])] for pair_idx in to_play]
+        with torch.no_grad():
+            for play_idx, result in sim.run_many(matchups, match_policies, [seeds[pair_idx] for pair_idx in to_play]):
+                pair_idx = to_play[play_idx]
+                if result_cache is not None:
+                    result_cache.put(cache_keys[pair_idx], result)
+                left, right = match_pairs[pair_idx]
+                yield left, right, _winner_idx(result)
+        return
+    for (left, right), seed in zip(match_pairs, seeds):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"match start: " + json.dumps({
+                "p1": {"player_id": player_ids[left], "party": parties[left]},
+                "p2": {"player_id": player_ids[right], "party": parties[right]},
+            }))
+        winner = match_players(sim, [parties[left], parties[right]],
+                               [_new_battle_policy(policies[left]), _new_battle_policy(policies[right])], seed,
+                               result_cache, [{"player_id": player_ids[left]}, {"player_id": player_ids[right]}])
+        yield left, right, winner
+
+
+async def _play_matches_async(sim: AsyncSim, parties, policies, match_pairs: List[Tuple[int, int]],
+                              seeds: List[Optional[List[int]]], result_cache: Optional[BattleResultCache]) -> List[
+    Tuple[int, int, int]]:
+    """
+    AsyncSimで対戦を並行して行い、終了順に(left, right, winner)のリストを返す
+    方策は対戦ごとに別インスタンスとする(_new_battle_policy)。BatchedInferenceServerはエージェントに設定されているため共有される
+    """
+    played, to_play, cache_keys = _lookup_cache(parties, policies, match_pairs, seeds, result_cache)
+    matchups = [[parties[match_pairs[pair_idx][0]], parties[match_pairs[pair_idx][1]]] for pair_idx in to_play]
+    match_policies = [[_new_battle_policy(policies[match_pairs[pair_idx][0]]),
+                       _new_battle_policy(policies[match_pairs[pair_idx][1]])] for pair_idx in to_play]
+    async for play_idx, result in sim.run_many(matchups, match_policies,
+                                               seeds=[seeds[pair_idx] for pair_idx in to_play]):
+        pair_idx = to_play[play_idx]
+        if result_cache is not None:
+            result_cache.put(cache_keys[pair_idx], result)
+        left, right = match_pairs[pair_idx]
+        played.append((left, right, _winner_idx(result)))
+    return played
+
 
 def main():
     import logging
@@ -163,10 +315,22 @@ def main():
                         default="INFO")
     parser.add_argument("--log", help="ログファイルパス")
     parser.add_argument("--match_algorithm", help='対戦相手を決めるアルゴリズム。"near_rate": レートの近い者同士を対戦させる。 "round_robin": 総当たり。', choices=["near_rate", "round_robin"], default="near_rate")
+    parser.add_argument("--sim_procs", type=int, default=0, help="シミュレータプロセス数。1以上なら同じ回の対戦を並行して行う")
+    parser.add_argument("--batched_inference", action="store_true",
+                        help="AsyncSimで対戦を並行して行い、各trainerの推論を複数の対戦でまとめてバッチ処理する")
+    parser.add_argument("--numpy_engine", action="store_true", help="モデルの推論をtorchを介さずnumpyで行う")
+    parser.add_argument("--seed", type=int, help="乱数シード。指定すると対戦の組み合わせと各対戦が再現可能になる")
+    parser.add_argument("--result_cache", help="対戦結果のキャッシュ(sqlite)のパス。--seedと併せて指定すると、結果が既知の対戦を省略する")
+    parser.add_argument("--trace", help="対戦の経過の記録先。--sim_procs, --batched_inferenceとは併用できない")
+    parser.add_argument("--trace_every", type=int, default=1, help="Nバトルに1回だけ経過を記録する")
     parser.add_argument("--rate_id")
     parser.add_argument("--match_results_dir", help="各対戦の勝敗リストを保存するディレクトリ(match_results_<rate_id>.json に保存される)")
     args = parser.parse_args()
     setup_logging(args.loglevel, filename=args.log)
+    if args.seed is not None:
+        np.random.seed(args.seed)
+    result_cache = BattleResultCache(args.result_cache) if args.result_cache else None
+    trace_recorder = TraceRecorder(args.trace, args.trace_every) if args.trace else None
     rate_id = ObjectId(args.rate_id)  # Noneならランダム生成
     print(f"rate_id: {rate_id}")
     logger.info(f"rate_id: {rate_id}")
@@ -196,7 +360,11 @@ def main():
             policy = RandomPolicy()
         else:
             trainer = load_trainer(trainer_id)
-            policy = RLPolicy(trainer.get_val_agent(), SurrogateRewardConfigZero)
+            agent = trainer.get_val_agent(numpy_engine=args.numpy_engine)
+            if args.batched_inference:
+                agent.set_inference_server(BatchedInferenceServer(agent._model,
+                                                                  feature_extractor=agent._feature_extractor))
+            policy = RLPolicy(agent, SurrogateRewardConfigZero)
         src_policies[trainer_id] = policy
     parties = []
     policies = []
@@ -205,7 +373,15 @@ def main():
         parties.append(src_parties[party_id])
         policies.append(src_policies[trainer_id])
     fixed_rates = [0.0] * len(parties)  # 未使用
-    rates, log = rating_battle(parties, policies, player_ids, args.match_count, fixed_rates=fixed_rates, match_algorithm=args.match_algorithm)
+    rates, log = rating_battle(parties, policies, player_ids, args.match_count, fixed_rates=fixed_rates, match_algorithm=args.match_algorithm, sim_procs=args.sim_procs,
+                               use_async_sim=args.batched_inference, seed=args.seed, result_cache=result_cache,
+                               trace_recorder=trace_recorder)
+    if result_cache is not None:
+        logger.info(f"result cache: {result_cache.hits} hits, {result_cache.misses} misses")
+        result_cache.close()
+    if trace_recorder is not None:
+        logger.info(f"trace: {trace_recorder.n_recorded} of {trace_recorder.n_battles} battles recorded")
+        trace_recorder.close()
     print(f"rate_id: {rate_id}")
     # logが大きくなりすぎてmongodbのサイズ制限に抵触することがあるため保存を中止
     col_rate.insert_one({
@@ -13,6 +13,8 @@ import torch
 from bson import ObjectId
 from tqdm import tqdm
 
+from pokeai.ai.generic_move_model.actor_learner import ActorPool, play_train_battle
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer
 from pokeai.ai.generic_move_model.trainer import Trainer
 from pokeai.ai.party_db import col_party, col_trainer, fs_checkpoint, pack_obj, unpack_obj
 from pokeai.ai.random_policy import RandomPolicy
@@ -49,23 +51,21 @@ def random_val(sim, trainer: Trainer, parties: List[Party], battles: int) -> flo
 
 
 def train_episode(sim, trainer: Trainer, target_parties: List[Party], surrogate_reward_config: SurrogateRewardConfig):
-    agents = []
-    bsps = []
-    for player in range(2):
-        agent = trainer.get_train_agent()
-        bsp = BattleStreamProcessor()
-        bsp.set_policy(RLPolicy(agent, surrogate_reward_config))
-        agents.append(agent)
-        bsps.append(bsp)
-    sim.set_processor(bsps)
-    sim.set_party(target_parties)
-    with torch.no_grad():
-        battle_result = sim.run()
-    for player in range(2):
-        trainer.extend_replay_buffer(agents[player]._replay_buffer)
+    winner, buffers = play_train_battle(sim, trainer, target_parties, surrogate_reward_config)
+    learn_battle(trainer, buffers)
+    return winner  # 'p1', 'p2', '' (forcetieで引き分けの時)
+
+
+def learn_battle(trainer: Trainer, buffers: List[ReplayBuffer]):
+    """
+    1回の対戦で得た遷移をリプレイバッファに追加し、学習する
+    :param trainer:
+    :param buffers: 各プレイヤーの遷移
+    """
+    for buffer in buffers:
+        trainer.extend_replay_buffer(buffer)
     trainer.total_battles += 1
     trainer.train()
-    return battle_result["winner"]  # 'p1', 'p2', '' (forcetieで引き分けの時)
 
 
 def make_match_pairs(rates: List[float], random_std: float) -> List[Tuple[int, int]]:
@@ -108,6 +108,10 @@ def main():
     parser.add_argument("--resume", action="store_true")
     parser.add_argument("--loglevel", help="ログ出力(stderr)のレベル", choices=["INFO", "WARNING", "DEBUG"],
                         default="INFO")
+    parser.add_argument("--actors", type=int, default=0,
+                        help="対戦を行うアクタープロセス数。0なら対戦と学習を1プロセスで交互に行う")
+    parser.add_argument("--broadcast_per_battles", type=int, default=10,
+                        help="アクターに重みを配布する間隔(対戦数)")
     args = parser.parse_args()
     setup_logging(args.loglevel)
     train_params = yaml_load(args.train_param_file)
@@ -151,6 +155,10 @@ def main():
             "tags": tags,
         })
     sim = Sim()
+    if args.actors > 0:
+        train_actor_learner(sim, trainer, trainer_id, train_params, parties, surrogate_reward_config,
+                            match_pairs_queue, rates, stop_file_path, args)
+        return
     for battle_idx in tqdm(range(trainer.total_battles, train_params["battles"])):
         if len(match_pairs_queue) == 0:
             match_pairs_queue = make_match_pairs(rates, train_params["match_config"]["random_std"])
@@ -159,18 +167,64 @@ def main():
         update_rate(rates, match_pair, winner)
         if battle_idx % 1000 == 0:
             print("mean score", random_val(sim, trainer, parties, 100))
+            print("simulator", sim.supervisor.stats())
         stop_file_exists = os.path.exists(stop_file_path)
         if (battle_idx % train_params["checkpoint_per_battles"] == (
                 train_params["checkpoint_per_battles"] - 1)) or stop_file_exists:
-            save_state_dict = trainer.save_state(resume=True)
-            # trainerに含まれていないが再開に必要な情報を格納
-            save_state_dict["_rl_train"] = {"match_pairs_queue": match_pairs_queue, "rates": rates}
-            fs_checkpoint.put(pack_obj(save_state_dict), filename=str(trainer_id),
-                              metadata={"battles": trainer.total_battles})
-            del save_state_dict
+            save_checkpoint(trainer, trainer_id, match_pairs_queue, rates)
             if stop_file_exists:
                 break
 
 
+def save_checkpoint(trainer: Trainer, trainer_id: ObjectId, match_pairs_queue: List[Tuple[int, int]],
+                    rates: List[float]):
+    save_state_dict = trainer.save_state(resume=True)
+    # trainerに含まれていないが再開に必要な情報を格納
+    save_state_dict["_rl_train"] = {"match_pairs_queue": match_pairs_queue, "rates": rates}
+    fs_checkpoint.put(pack_obj(save_state_dict), filename=str(trainer_id),
+                      metadata={"battles": trainer.total_battles})
+
+
+def train_actor_learner(sim, trainer: Trainer, trainer_id: ObjectId, train_params: dict, parties: List[Party],
+                        surrogate_reward_config: SurrogateRewardConfig, match_pairs_queue: List[Tuple[int, int]],
+                        rates: List[float], stop_file_path: str, args):
+    """
+    対戦をargs.actors個のアクタープロセスで並行して行い、このプロセスでは学習のみを行う
+    対戦の組は割り当て順に、レートの更新・学習は対戦の終了順に行う
+    チェックポイントでは、割り当て済みで結果を受け取っていない対戦の組をmatch_pairs_queueの先頭に戻す
+    """
+    actor_pool = ActorPool(args.actors, trainer, parties, surrogate_reward_config, args.loglevel)
+    actor_pool.broadcast_weights(trainer)
+    last_broadcast_battles = trainer.total_battles
+    n_submitted = trainer.total_battles
+    try:
+        with tqdm(initial=trainer.total_battles, total=train_params["battles"]) as pbar:
+            while trainer.total_battles < train_params["battles"]:
+                while actor_pool.can_submit() and n_submitted < train_params["battles"]:
+                    if len(match_pairs_queue) == 0:
+                        match_pairs_queue = make_match_pairs(rates, train_params["match_config"]["random_std"])
+                    actor_pool.submit(match_pairs_queue.pop(0), trainer.total_steps)
+                    n_submitted += 1
+                match_pair, winner, buffers = actor_pool.get_result()
+                battle_idx = trainer.total_battles
+                learn_battle(trainer, buffers)
+                update_rate(rates, match_pair, winner)
+                pbar.update(1)
+                if trainer.total_battles - last_broadcast_battles >= args.broadcast_per_battles:
+                    actor_pool.broadcast_weights(trainer)
+                    last_broadcast_battles = trainer.total_battles
+                if battle_idx % 1000 == 0:
+                    print("mean score", random_val(sim, trainer, parties, 100))
+                    print("simulator", sim.supervisor.stats())
+                stop_file_exists = os.path.exists(stop_file_path)
+                if (battle_idx % train_params["checkpoint_per_battles"] == (
+                        train_params["checkpoint_per_battles"] - 1)) or stop_file_exists:
+                    save_checkpoint(trainer, trainer_id, actor_pool.pending_match_pairs() + match_pairs_queue, rates)
+                    if stop_file_exists:
+                        break
+    finally:
+        actor_pool.close()
+
+
 if __name__ == '__main__':
     main()
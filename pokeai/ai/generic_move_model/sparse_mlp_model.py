@@ -0,0 +1,34 @@
+"""
+選択肢の特徴量を疎な表現(FeatureExtractor(sparse_choice=True))で受け取るモデル
+FactorizedMLPModelの選択肢部分の射影を、インデックスごとの埋め込みの和としたもの
+埋め込みの和はEmbeddingBag(mode="sum")と同じだが、CPUではEmbeddingと和の組み合わせのほうが高速
+MLPModelの重みはconvert_mlp_state_dict(sparse_choice=True)で変換できる
+"""
+import torch.nn as nn
+
+from pokeai.ai.generic_move_model.choice_to_vec import MAX_CHOICE_INDICES
+from pokeai.ai.generic_move_model.factorized_mlp_model import FactorizedMLPModel
+
+
+class SparseMLPModel(FactorizedMLPModel):
+    """
+    入力: (state_dims + output_dim * MAX_CHOICE_INDICES,)
+    選択肢部分は、インデックスchoice_dimsをパディングとする
+    """
+
+    @staticmethod
+    def choice_input_size(choice_dims: int, output_dim: int) -> int:
+        return output_dim * MAX_CHOICE_INDICES
+
+    def _construct_choice_layer(self):
+        self.choice_embedding = nn.Embedding(self.choice_dims + 1, self.n_channels, padding_idx=self.choice_dims)
+
+    def _reset_choice_layer(self, bound: float):
+        nn.init.uniform_(self.choice_embedding.weight, -bound, bound)
+        self.choice_embedding.weight[self.choice_dims].zero_()
+
+    def _project_choice(self, x_choice):
+        # インデックスはfloat32で正確に表現できる範囲(2^24未満)
+        choice_indices = x_choice.long().view(x_choice.shape[0], self.output_dim, MAX_CHOICE_INDICES)
+        # パディングの埋め込みは0なので、和に影響しない
+        return self.choice_embedding(choice_indices).sum(2)  # batch, 4, n_channels
@@ -1,16 +1,23 @@
 # https://pytorch.org/tutorials/intermediate/reinforcement_q_learning.html#dqn-algorithm
 import math
+from typing import Optional
 
 import numpy as np
 
 import torch
+import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from pokeai.ai.generic_move_model.agent_train import AgentTrain
 from pokeai.ai.generic_move_model.agent_val import AgentVal
 from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
 from pokeai.ai.generic_move_model.mlp_model import MLPModel
+from pokeai.ai.generic_move_model.numpy_model import NumpyMLPModel
+from pokeai.ai.generic_move_model.observation_codec import CompactObservationCodec
+from pokeai.ai.generic_move_model.prioritized_replay_buffer import PrioritizedReplayBuffer
 from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer
+from pokeai.ai.generic_move_model.factorized_mlp_model import FactorizedMLPModel, convert_mlp_state_dict
+from pokeai.ai.generic_move_model.sparse_mlp_model import SparseMLPModel
 
 DQN_DEFAULT_PARAMS = {
     "epsilon": 0.3,
@@ -23,10 +30,36 @@ DQN_DEFAULT_PARAMS = {
     "target_update": 100,
     "double_dqn": True,
     "replay_buffer_size": 100000,
+    "compact_replay_buffer": False,  # 特徴量を省メモリな表現(CompactObservationCodec)で格納する
+    "prioritized_replay": False,  # prioritized experience replay(PrioritizedReplayBuffer)を用いる
+    "per_alpha": 0.6,
+    "per_beta": 0.4,  # 重要度重みの指数の初期値。per_beta_steps回のupdateで1まで線形に増やす
+    "per_beta_steps": 100000,
+    "per_epsilon": 1e-3,
     "lr": 1e-3,
+    # エージェントが用いる重みのスナップショットを公開する間隔(update_steps)。1バトルは数十〜百程度のupdate_steps
+    # 対戦する方策は最大でこの間隔だけ古い重みとなる。DQNはoff-policyなので学習の目標値には影響せず、探索が遅れるのみ
+    # 1にすると、バトルごとに最新の重みを複製する(スナップショット導入前と同じ挙動)
+    "snapshot_interval": 1000,
 }
 
 
+class WeightSnapshot:
+    """
+    公開時点のモデルの重み(評価モード)。複数のエージェントで共有するため、変更してはならない
+    """
+    version: int  # 公開ごとに1増える
+    update_steps: int  # 公開時点のTrainer.update_steps
+    model: nn.Module
+    numpy_model: Optional[NumpyMLPModel]  # get_val_agent(numpy_engine=True)で初めて必要になった時点で生成
+
+    def __init__(self, version: int, update_steps: int, model: nn.Module):
+        self.version = version
+        self.update_steps = update_steps
+        self.model = model
+        self.numpy_model = None
+
+
 class Trainer:
     def __init__(self, model_params: dict, dqn_params: dict, feature_params: dict):
         self.constructor_params = {
@@ -38,6 +71,9 @@ class Trainer:
         self.model_params = model_params.copy()
         self.model_params["input_shape"] = self.feature_extractor.input_shape
         self.model_params["output_dim"] = self.feature_extractor.output_dim
+        if self.feature_extractor.factorized:
+            self.model_params["state_dims"] = self.feature_extractor.state_feature_extractor.get_dims()
+            self.model_params["choice_dims"] = self.feature_extractor.choice_to_vec.get_dims()
         self.model = self._construct_model()
         self.target_model = self._construct_model()
         self.target_model.load_state_dict(self.model.state_dict())
@@ -47,13 +83,27 @@ class Trainer:
         self.total_battles = 0
         # 学習済みステップ数
         self.update_steps = 0
+        # ロード元のチェックポイントのID(trainer_loader.load_trainerで設定)
+        self.checkpoint_id = None
         # DQNの設定
         dqn_params_with_default = DQN_DEFAULT_PARAMS.copy()
         dqn_params_with_default.update(dqn_params)
 
         self.optimizer = optim.Adam(self.model.parameters(), lr=dqn_params_with_default["lr"])
 
-        self.replay_buffer = ReplayBuffer(dqn_params_with_default["replay_buffer_size"])
+        if dqn_params_with_default["compact_replay_buffer"]:
+            replay_codec = CompactObservationCodec.from_feature_extractor(self.feature_extractor)
+        else:
+            replay_codec = None
+        self.prioritized_replay = dqn_params_with_default["prioritized_replay"]
+        if self.prioritized_replay:
+            self.replay_buffer = PrioritizedReplayBuffer(dqn_params_with_default["replay_buffer_size"], replay_codec,
+                                                         dqn_params_with_default["per_alpha"],
+                                                         dqn_params_with_default["per_epsilon"])
+        else:
+            self.replay_buffer = ReplayBuffer(dqn_params_with_default["replay_buffer_size"], replay_codec)
+        self.per_beta = dqn_params_with_default["per_beta"]
+        self.per_beta_steps = dqn_params_with_default["per_beta_steps"]
         self.epsilon = dqn_params_with_default["epsilon"]
         self.epsilon_decay = dqn_params_with_default["epsilon_decay"]
         self.epsilon_min = dqn_params_with_default["epsilon_min"]
@@ -66,8 +116,17 @@ class Trainer:
 
         self.update_loss_history = []
 
+        self.snapshot_interval = dqn_params_with_default["snapshot_interval"]
+        self._snapshot = None  # type: Optional[WeightSnapshot]
+        self._snapshot_version = 0
+        # 最後のスナップショットの公開後にself.modelが学習で更新された
+        self._model_updated = False
+
     def _construct_model(self):
-        # TODO: モデルクラスの選択
+        if self.feature_extractor.sparse_choice:
+            return SparseMLPModel(**self.model_params)
+        if self.feature_extractor.factorized:
+            return FactorizedMLPModel(**self.model_params)
         return MLPModel(**self.model_params)
 
     def save_state(self, resume=False):
@@ -105,7 +164,7 @@ class Trainer:
         :return:
         """
         trainer = cls(**state["constructor_params"])
-        trainer.model.load_state_dict(state["model"])
+        trainer.load_model_state_dict(state["model"])
         trainer.update_steps = state["update_steps"]
         if resume:
             trainer.total_steps = state["total_steps"]
@@ -117,26 +176,88 @@ class Trainer:
         return trainer
 
     def load_initial_model(self, state_dict):
-        self.model.load_state_dict(state_dict)
+        if self.feature_extractor.factorized and "state_layer.weight" not in state_dict:
+            # MLPModelの重みを変換して使う
+            state_dict = convert_mlp_state_dict(state_dict, self.model_params["state_dims"],
+                                                self.feature_extractor.sparse_choice)
+        self.load_model_state_dict(state_dict)
         self.target_model.load_state_dict(state_dict)
 
+    def load_model_state_dict(self, state_dict):
+        """
+        self.modelの重みを置き換える。公開済みのスナップショットは次回のget_snapshotで置き換わる
+        """
+        self.model.load_state_dict(state_dict)
+        self._snapshot = None
+
+    def get_snapshot(self) -> WeightSnapshot:
+        """
+        エージェントが用いる重みのスナップショットを返す
+        学習でself.modelが更新されており、前回の公開からupdate_stepsがsnapshot_intervalの倍数をまたいだ場合のみ、
+        新たなスナップショットを公開する。それ以外は前回と同じインスタンスを返す
+        そのため、返る重みはself.modelより最大でsnapshot_interval回のupdate分古い
+        self.modelを直接変更した場合はload_model_state_dictを用いること
+        :return:
+        """
+        snapshot = self._snapshot
+        if snapshot is None or (self._model_updated and self.update_steps // self.snapshot_interval !=
+                                snapshot.update_steps // self.snapshot_interval):
+            model = self._construct_model()
+            model.load_state_dict(self.model.state_dict())
+            model.eval()
+            for param in model.parameters():
+                param.requires_grad_(False)
+            self._snapshot_version += 1
+            snapshot = WeightSnapshot(self._snapshot_version, self.update_steps, model)
+            self._snapshot = snapshot
+            self._model_updated = False
+        return snapshot
+
     def get_train_agent(self):
-        model = self._construct_model()
-        model.load_state_dict(self.model.state_dict())
-        model.eval()
         epsilon = max(math.pow(1.0 - self.epsilon_decay, self.total_steps) * self.epsilon, self.epsilon_min)
-        return AgentTrain(model, self.feature_extractor, epsilon)
+        return AgentTrain(self.get_snapshot().model, self.feature_extractor, epsilon)
+
+    def get_val_agent(self, numpy_engine: bool = False):
+        """
+        評価用エージェントを生成する
+        :param numpy_engine: モデルの推論をnumpyで行う(export_numpy_model)
+        :return:
+        """
+        snapshot = self.get_snapshot()
+        if numpy_engine:
+            if snapshot.numpy_model is None:
+                snapshot.numpy_model = self.export_numpy_model(snapshot.model)
+            return AgentVal(snapshot.numpy_model, self.feature_extractor, self.checkpoint_id)
+        return AgentVal(snapshot.model, self.feature_extractor, self.checkpoint_id)
 
-    def get_val_agent(self):
-        model = self._construct_model()
-        model.load_state_dict(self.model.state_dict())
-        model.eval()
-        return AgentVal(model, self.feature_extractor)
+    def export_numpy_model(self, model=None) -> NumpyMLPModel:
+        """
+        モデルの推論をnumpyのみで行うエンジンを生成する
+        生成時に、ランダムな入力に対する出力がtorchのモデル(評価モード)と一致することを確認する
+        :param model: 評価モードにした、self.modelと同じ重みのモデル。Noneなら生成する
+        :return:
+        """
+        if model is None:
+            model = self._construct_model()
+            model.load_state_dict(self.model.state_dict())
+            model.eval()
+        state_dict = {k: v.detach().cpu().numpy() for k, v in model.state_dict().items()}
+        numpy_model = NumpyMLPModel(state_dict, self.feature_extractor.output_dim)
+        rng = np.random.RandomState(0)
+        x = rng.uniform(size=(4,) + self.feature_extractor.input_shape).astype(np.float32)
+        if self.feature_extractor.sparse_choice:
+            # 選択肢部分はインデックス
+            state_dims = self.model_params["state_dims"]
+            x[:, state_dims:] = rng.randint(0, self.model_params["choice_dims"] + 1, size=x[:, state_dims:].shape)
+        with torch.no_grad():
+            expected = model(torch.from_numpy(x)).numpy()
+        assert np.allclose(numpy_model(x), expected, rtol=1e-4, atol=1e-5)
+        return numpy_model
 
     def extend_replay_buffer(self, buffer: ReplayBuffer):
         steps = len(buffer)
         self.total_steps += steps
-        self.replay_buffer.extend(buffer.buffer)
+        self.replay_buffer.extend_buffer(buffer)
 
     def train(self):
         while self.update_steps < self.total_steps:
@@ -150,24 +271,24 @@ class Trainer:
             self.update_steps += 1
 
     def _update(self):
-        transitions = self.replay_buffer.sample(self.batch_size)
-        b_state, b_action_mask, b_action, b_next_state, b_next_action_mask, b_reward = zip(*transitions)
-        non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                                b_next_state)), dtype=torch.bool)
-        non_final_next_states = torch.from_numpy(np.stack([s for s in b_next_state
-                                                           if s is not None]))
-
-        state_batch = torch.from_numpy(np.stack(b_state))
-        action_batch = torch.from_numpy(np.array(b_action, dtype=np.int64)[:, np.newaxis])
-        reward_batch = torch.from_numpy(np.array(b_reward, dtype=np.float32))
+        if self.prioritized_replay:
+            beta = min(1.0, self.per_beta + (1.0 - self.per_beta) * self.update_steps / self.per_beta_steps)
+            batch, sample_indices, sample_weights = self.replay_buffer.sample_prioritized(self.batch_size, beta)
+        else:
+            batch = self.replay_buffer.sample_batch(self.batch_size)
+        non_final = ~batch.done
+        non_final_mask = torch.from_numpy(non_final)
+        non_final_next_states = torch.from_numpy(batch.next_state[non_final])
+
+        state_batch = torch.from_numpy(batch.state)
+        action_batch = torch.from_numpy(batch.action[:, np.newaxis])
+        reward_batch = torch.from_numpy(batch.reward)
         state_action_values = self.model(state_batch).gather(1, action_batch)
         next_state_values = torch.zeros(self.batch_size)
         # 次のstateの最大action valueを合法手のみから求める
         # 非合法手に対応するaction valueに-infを加算
-        non_final_next_action_mask = np.stack([s for s in b_next_action_mask
-                                               if s is not None])
         non_final_next_states_bias = torch.from_numpy(
-            np.where(non_final_next_action_mask, 0.0, -np.inf).astype(np.float32))
+            np.where(batch.next_action_mask[non_final], 0.0, -np.inf).astype(np.float32))
         if self.double_dqn:
             # Double DQN
             # next_stateでのmodelが最大Q値をとるactionを求め、そのQ値をtarget_modelで求める
@@ -184,7 +305,15 @@ class Trainer:
         expected_state_action_values = (next_state_values * self.gamma) + reward_batch
 
         # Compute Huber loss
-        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
+        if self.prioritized_replay:
+            # 重要度重みで重み付けし、TD誤差を優先度とする
+            td_errors = state_action_values.detach().squeeze(1) - expected_state_action_values
+            self.replay_buffer.update_priorities(sample_indices, td_errors.numpy())
+            elementwise_loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1),
+                                                reduction="none")
+            loss = (elementwise_loss.squeeze(1) * torch.from_numpy(sample_weights)).mean()
+        else:
+            loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
         self.update_loss_history.append(float(loss))
 
         # Optimize the model
@@ -193,6 +322,7 @@ class Trainer:
         for param in self.model.parameters():
             param.grad.data.clamp_(-1, 1)
         self.optimizer.step()
+        self._model_updated = True
 
     def _target_update(self):
         self.target_model.load_state_dict(self.model.state_dict())
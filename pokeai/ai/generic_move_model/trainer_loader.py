@@ -12,4 +12,5 @@ def load_trainer(trainer_id_with_battles: str) -> Trainer:
     else:
         raise ValueError(f"Invalid trainer_id {trainer_id_with_battles}")
     trainer = Trainer.load_state(unpack_obj(f.read()), resume=False)
+    trainer.checkpoint_id = str(f._id)
     return trainer
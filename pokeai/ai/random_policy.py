@@ -2,6 +2,7 @@ import json
 import random
 import logging
 from logging import getLogger
+from typing import List, Optional
 
 from pokeai.ai.action_policy import ActionPolicy
 from pokeai.ai.battle_status import BattleStatus
@@ -18,6 +19,13 @@ class RandomPolicy(ActionPolicy):
         """
         super().__init__()
         self.switch_prob = switch_prob
+        self._random = random.Random()
+
+    def set_battle_seed(self, seed: List[int], side: str):
+        self._random.seed(json.dumps([seed, side]))
+
+    def cache_key(self) -> Optional[str]:
+        return f"random(switch_prob={self.switch_prob})"
 
     def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
         """
@@ -39,12 +47,12 @@ class RandomPolicy(ActionPolicy):
             else:
                 move_choices.append(ck)
 
-        if len(switch_choices) > 0 and (len(move_choices) == 0 or random.random() < self.switch_prob):
+        if len(switch_choices) > 0 and (len(move_choices) == 0 or self._random.random() < self.switch_prob):
             # 交換しかできない場合か、両方できる場合で一定確率で交換を選ぶ
-            return random.choice(switch_choices).simulator_key
+            return self._random.choice(switch_choices).simulator_key
         else:
             assert len(move_choices) > 0
-            return random.choice(move_choices).simulator_key
+            return self._random.choice(move_choices).simulator_key
 
     def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
         """
@@ -59,6 +67,6 @@ class RandomPolicy(ActionPolicy):
             logger.debug(
                 'policy_choice_force_switch: ' + json.dumps([pa._asdict() for pa in possible_actions]))
         if len(possible_actions) > 1:
-            return random.choice(possible_actions).simulator_key
+            return self._random.choice(possible_actions).simulator_key
         else:
             return possible_actions[0].simulator_key
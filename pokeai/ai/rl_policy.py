@@ -1,15 +1,16 @@
 import json
 import logging
 from logging import getLogger
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from pokeai.ai.generic_move_model.agent import Agent
 from pokeai.ai.battle_status import BattleStatus
-from pokeai.ai.common import get_possible_actions
+from pokeai.ai.common import PossibleAction, get_possible_actions
 from pokeai.ai.state_feature_extractor import StateFeatureExtractor
 from pokeai.ai.random_policy import RandomPolicy
 from pokeai.ai.rl_policy_observation import RLPolicyObservation
 from pokeai.ai.surrogate_reward_config import SurrogateRewardConfig
+from pokeai.sim.trace_recorder import BattleTrace
 
 logger = getLogger(__name__)
 
@@ -22,6 +23,7 @@ class RLPolicy(RandomPolicy):
     agent: Agent
     surrogate_reward_config: SurrogateRewardConfig
     last_reward_potential: Optional[float]
+    trace: Optional[BattleTrace]
 
     def __init__(self, agent: Agent, surrogate_reward_config: SurrogateRewardConfig):
         """
@@ -31,6 +33,7 @@ class RLPolicy(RandomPolicy):
         self.agent = agent
         self.surrogate_reward_config = surrogate_reward_config
         self.last_reward_potential = None
+        self.trace = None
 
     def game_start(self):
         """
@@ -38,6 +41,17 @@ class RLPolicy(RandomPolicy):
         :return:
         """
         self.last_reward_potential = None
+        self.agent.start_episode()
+
+    def set_trace(self, trace: Optional[BattleTrace]):
+        # 並行する複数のバトルで同じインスタンスを共有する場合は、トレースを設定してはならない
+        self.trace = trace
+
+    def cache_key(self) -> Optional[str]:
+        agent_key = self.agent.cache_key()
+        if agent_key is None:
+            return None
+        return f"rl({agent_key})"
 
     def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
         """
@@ -57,6 +71,12 @@ class RLPolicy(RandomPolicy):
         """
         return self._choice_by_model(battle_status, request)
 
+    async def choice_turn_start_async(self, battle_status: BattleStatus, request: dict) -> str:
+        return await self._choice_by_model_async(battle_status, request)
+
+    async def choice_force_switch_async(self, battle_status: BattleStatus, request: dict) -> str:
+        return await self._choice_by_model_async(battle_status, request)
+
     def _calc_reward_potential(self, battle_status: BattleStatus) -> float:
         """
         HP率などから計算した、自分側が有利なら大きな値になるポテンシャル値
@@ -81,6 +101,28 @@ class RLPolicy(RandomPolicy):
         :param choice_keys:
         :return:
         """
+        possible_actions, obs, reward_potential, surrogate_reward = self._observe(battle_status, request)
+        if obs is None:
+            return possible_actions[0].simulator_key
+        action = self.agent.act(obs, surrogate_reward)
+        return self._chosen(possible_actions, action, reward_potential)
+
+    async def _choice_by_model_async(self, battle_status: BattleStatus, request: dict) -> str:
+        """
+        _choice_by_modelの非同期版。エージェントの推論をawaitする
+        """
+        possible_actions, obs, reward_potential, surrogate_reward = self._observe(battle_status, request)
+        if obs is None:
+            return possible_actions[0].simulator_key
+        action = await self.agent.act_async(obs, surrogate_reward)
+        return self._chosen(possible_actions, action, reward_potential)
+
+    def _observe(self, battle_status: BattleStatus, request: dict) -> Tuple[
+        List[PossibleAction], Optional[RLPolicyObservation], float, float]:
+        """
+        行動選択のための観測と補助報酬を求める
+        :return: 可能な行動、観測(選択肢が1つだけの場合None)、報酬ポテンシャル、補助報酬
+        """
         logger.debug(f"choice of player {battle_status.side_friend}")
         reward_potential = self._calc_reward_potential(battle_status)
         possible_actions = get_possible_actions(battle_status, request)
@@ -88,17 +130,23 @@ class RLPolicy(RandomPolicy):
             # 選択肢が１つだけの場合はモデルに与えない
             # 与える場合、action番号を正しく設定する必要あり(get_possible_actions内コメントに注意)
             logger.debug(f"only one choice: {possible_actions[0]}")
-            return possible_actions[0].simulator_key
+            return possible_actions, None, reward_potential, 0.0
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 'possible_actions: ' + json.dumps([pa._asdict() for pa in possible_actions]))
-        obs = RLPolicyObservation(battle_status, request, possible_actions)
+        trace = None
+        if self.trace is not None:
+            trace = self.trace.pending_choice(battle_status.side_friend)
+            trace["possible_actions"] = [pa._asdict() for pa in possible_actions]
+        obs = RLPolicyObservation(battle_status, request, possible_actions, trace)
         if self.last_reward_potential is not None:
             surrogate_reward = reward_potential - self.last_reward_potential
         else:
             surrogate_reward = 0.0
         logger.debug(f"surrogate_reward: {surrogate_reward}")
-        action = self.agent.act(obs, surrogate_reward)
+        return possible_actions, obs, reward_potential, surrogate_reward
+
+    def _chosen(self, possible_actions: List[PossibleAction], action: int, reward_potential: float) -> str:
         self.last_reward_potential = reward_potential
         chosen = possible_actions[action]
         logger.debug(f"chosen: {chosen}")
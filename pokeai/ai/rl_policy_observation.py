@@ -1,4 +1,4 @@
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Optional
 
 from pokeai.ai.battle_status import BattleStatus
 from pokeai.ai.common import PossibleAction
@@ -8,3 +8,4 @@ class RLPolicyObservation(NamedTuple):
     battle_status: BattleStatus
     request: dict
     possible_actions: List[PossibleAction]
+    trace: Optional[dict] = None  # 行動選択の記録先(BattleTrace.pending_choice)。エージェントがq値を書き込む
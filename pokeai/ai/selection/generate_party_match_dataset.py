@@ -4,11 +4,15 @@
 
 import argparse
 import json
+import random
 from tqdm import tqdm
 from pokeai.ai.generic_move_model.rl_rating_battle import match_players
 from pokeai.ai.random_policy import RandomPolicy
+from pokeai.sim.battle_result_cache import BattleResultCache
+from pokeai.sim.multiplex_sim import MultiplexSim
 from pokeai.sim.random_party_generator import RandomPartyGenerator
-from pokeai.sim.sim import Sim
+from pokeai.sim.sim import Sim, make_battle_seed
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -17,22 +21,78 @@ def main():
     parser.add_argument("-m", type=int, default=1, help="1つの組み合わせに対して何回対戦を行うか")
     parser.add_argument("-r", default="default", help="regulation")
     parser.add_argument("--move_count_variation", action="store_true", help="技の数をランダムに変化させる")
+    parser.add_argument("--concurrent", type=int, default=0, help="1つのシミュレータプロセスで並行して行うバトル数(0なら並行しない)")
+    parser.add_argument("--seed", type=int, help="乱数シード。指定するとパーティの生成と対戦結果が再現可能になる")
+    parser.add_argument("--result_cache", help="対戦結果のキャッシュ(sqlite)のパス。--seedと併せて指定すると、結果が既知の対戦を省略する")
     args = parser.parse_args()
 
+    if args.seed is not None:
+        random.seed(args.seed)
+    result_cache = BattleResultCache(args.result_cache) if args.result_cache else None
     policies = [RandomPolicy() for _ in range(2)]
     gen = RandomPartyGenerator(regulation=args.r, move_count_probability=[0.1, 0.2, 0.3, 0.4] if args.move_count_variation else None)
+    if args.concurrent > 0:
+        generate_concurrent(args, gen, policies, result_cache)
+    else:
+        generate_sequential(args, gen, policies, result_cache)
+    if result_cache is not None:
+        print(f"result cache: {result_cache.hits} hits, {result_cache.misses} misses")
+        result_cache.close()
+
+
+def battle_seed(args, matchup_idx: int, repeat_idx: int):
+    if args.seed is None:
+        return None
+    return make_battle_seed(args.seed, matchup_idx, repeat_idx)
+
+
+def generate_sequential(args, gen: RandomPartyGenerator, policies, result_cache):
     sim = Sim()
 
     with open(args.output, "w") as f:
         for i in tqdm(range(args.n)):
             parties = [gen.generate() for _ in range(2)]
             wincounts = [0, 0, 0]
-            for _ in range(args.m):
+            for j in range(args.m):
                 # 0/1/-1
-                winner = match_players(sim, parties, policies)
+                winner = match_players(sim, parties, policies, battle_seed(args, i, j), result_cache)
                 # -1（引き分け）ならwincounts[2]がインクリメント
                 wincounts[winner] += 1
             f.write(json.dumps({"parties": parties, "wincounts": wincounts}) + "\n")
+    sim.close()
+
+
+def generate_concurrent(args, gen: RandomPartyGenerator, policies, result_cache):
+    # RandomPolicyの乱数生成器はバトルごとにシードで初期化されるため、再現性のためバトルごとに別インスタンスとする
+    sim = MultiplexSim(max_concurrent=args.concurrent)
+    parties_list = [[gen.generate() for _ in range(2)] for _ in range(args.n)]
+    wincounts_list = [[0, 0, 0] for _ in range(args.n)]
+    battle_idxs = [(i, j) for i in range(args.n) for j in range(args.m)]
+    seeds = [battle_seed(args, i, j) for i, j in battle_idxs]
+    cache_keys = [None] * len(battle_idxs)
+    to_play = []
+    for battle_idx, (i, j) in enumerate(battle_idxs):
+        if result_cache is not None:
+            cache_keys[battle_idx] = result_cache.make_key(parties_list[i], policies, seeds[battle_idx])
+            cached_result = result_cache.get(cache_keys[battle_idx])
+            if cached_result is not None:
+                wincounts_list[i][{'p1': 0, 'p2': 1, '': -1}[cached_result['winner']]] += 1
+                continue
+        to_play.append(battle_idx)
+    matchups = [parties_list[battle_idxs[battle_idx][0]] for battle_idx in to_play]
+    battle_policies = [[RandomPolicy() for _ in range(2)] for _ in to_play]
+    for play_idx, result in tqdm(sim.run_many(matchups, battle_policies,
+                                              [seeds[battle_idx] for battle_idx in to_play]), total=len(matchups)):
+        battle_idx = to_play[play_idx]
+        if result_cache is not None:
+            result_cache.put(cache_keys[battle_idx], result)
+        winner = {'p1': 0, 'p2': 1, '': -1}[result['winner']]
+        wincounts_list[battle_idxs[battle_idx][0]][winner] += 1
+    sim.close()
+    with open(args.output, "w") as f:
+        for parties, wincounts in zip(parties_list, wincounts_list):
+            f.write(json.dumps({"parties": parties, "wincounts": wincounts}) + "\n")
+
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,10 @@
-from typing import List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 
-from pokeai.ai.battle_status import BattleStatus
+from pokeai.ai.battle_status import POKE_HP_CURRENT, POKE_HP_MAX, POKE_STATUS, POKE_VALUES_LEN, RANK2IDX, \
+    SIDE_REMAINING_POKES, SIDE_TOTAL_POKES, SIDE_VALUES_LEN, STATUS2CODE
 from pokeai.ai.dex import dex
 from pokeai.ai.rl_policy_observation import RLPolicyObservation
 
@@ -32,6 +34,10 @@ NV_CONDITIONS = ["psn", "tox", "par", "brn", "slp", "frz"]
 RANKS = ['atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion']
 WEATHERS = ["SunnyDay", "RainDance", "Sandstorm"]
 
+WEATHER2NUM = {w: i for i, w in enumerate(WEATHERS)}
+# 天候を表すベクトル。最後の行は天候なし
+_weather_table = np.vstack([np.eye(len(WEATHERS), dtype=np.float32), np.zeros((1, len(WEATHERS)), dtype=np.float32)])
+
 
 class StateFeatureExtractor:
     """
@@ -50,6 +56,8 @@ class StateFeatureExtractor:
     def __init__(self, party_size: int, feature_types: Optional[List[str]] = None):
         self.feature_types = feature_types or StateFeatureExtractor.ALL_FEATURE_TYPES
         self.party_size = party_size
+        self._dims = self.get_dims()
+        self._build_index_map()
 
     def get_dims(self) -> int:
         """
@@ -89,109 +97,140 @@ class StateFeatureExtractor:
             ms += [f"weather/{weather}" for weather in WEATHERS]
         return ms
 
-    def transform(self, obs: RLPolicyObservation) -> np.ndarray:
-        feats = []
-        battle_status = obs.battle_status
+    def _build_index_map(self):
+        """
+        transformで用いる、数値で表せる状態(SideStatus.values, ActivePokeStatus.values)から特徴量への対応を作る
+        状態は、自分側・相手側のSideStatus.values、自分側・相手側のActivePokeStatus.valuesの順に連結して読み出す
+        """
+        side_offsets = [0, SIDE_VALUES_LEN]
+        poke_offsets = [SIDE_VALUES_LEN * 2, SIDE_VALUES_LEN * 2 + POKE_VALUES_LEN]
+        const_rank_scale = SIDE_VALUES_LEN * 2 + POKE_VALUES_LEN * 2  # 状態の後ろに定数12を付加する
+        # 比で表す特徴量: feats[ratio_pos] = (values[ratio_num] + ratio_add) / values[ratio_den]
+        ratio_pos, ratio_num, ratio_add, ratio_den = [], [], [], []
+        # 状態異常: feats[nv_pos] = values[nv_idx] == nv_code
+        nv_pos, nv_idx, nv_code = [], [], []
+        self._poke_type_pos = None
+        self._weather_pos = None
+        self._use_active = False
+        pos = 0
         if "remaining_count" in self.feature_types:
-            feats.append(self._transform_remaining_count(battle_status, battle_status.side_friend))
-            feats.append(self._transform_remaining_count(battle_status, battle_status.side_opponent))
+            for offset in side_offsets:
+                ratio_pos.append(pos)
+                ratio_num.append(offset + SIDE_REMAINING_POKES)
+                ratio_add.append(0.0)
+                ratio_den.append(offset + SIDE_TOTAL_POKES)
+                pos += 1
         if "poke_type" in self.feature_types:
-            feats.append(self._transform_poke_type(battle_status, battle_status.side_opponent))
+            self._poke_type_pos = pos
+            self._use_active = True
+            pos += len(POKE_TYPES)
         if "hp_ratio" in self.feature_types:
-            feats.append(self._transform_hp_ratio(battle_status, battle_status.side_friend))
-            feats.append(self._transform_hp_ratio(battle_status, battle_status.side_opponent))
+            for offset in poke_offsets:
+                ratio_pos.append(pos)
+                ratio_num.append(offset + POKE_HP_CURRENT)
+                ratio_add.append(0.0)
+                ratio_den.append(offset + POKE_HP_MAX)
+                pos += 1
+            self._use_active = True
         if "nv_condition" in self.feature_types:
-            feats.append(self._transform_nv_condition(battle_status, battle_status.side_friend))
-            feats.append(self._transform_nv_condition(battle_status, battle_status.side_opponent))
+            for offset in poke_offsets:
+                for cond in NV_CONDITIONS:
+                    nv_pos.append(pos)
+                    nv_idx.append(offset + POKE_STATUS)
+                    nv_code.append(STATUS2CODE[cond])
+                    pos += 1
+            self._use_active = True
         if "rank" in self.feature_types:
-            feats.append(self._transform_rank(battle_status, battle_status.side_friend))
-            feats.append(self._transform_rank(battle_status, battle_status.side_opponent))
+            for offset in poke_offsets:
+                for rank in RANKS:
+                    # (rank + 6) / 12で0~1
+                    ratio_pos.append(pos)
+                    ratio_num.append(offset + RANK2IDX[rank])
+                    ratio_add.append(6.0)
+                    ratio_den.append(const_rank_scale)
+                    pos += 1
+            self._use_active = True
         if "weather" in self.feature_types:
-            feats.append(self._transform_weather(battle_status, battle_status.side_friend))
-        return np.concatenate(feats)
-
-    def _transform_remaining_count(self, battle_status: BattleStatus, side: str) -> np.ndarray:
-        """
-        ポケモンの残り数/パーティサイズ
-        :param battle_status:
-        :param side:
-        :return:
-        """
-        side_status = battle_status.side_statuses[side]
-        feat = np.zeros((1,), dtype=np.float32)
-        feat[0] = side_status.remaining_pokes / side_status.total_pokes
-        return feat
+            self._weather_pos = pos
+            pos += len(WEATHERS)
+        assert pos == self._dims
+        self._ratio_pos = np.array(ratio_pos, dtype=np.int64)
+        self._ratio_num = np.array(ratio_num, dtype=np.int64)
+        self._ratio_add = np.array(ratio_add, dtype=np.float64)
+        self._ratio_den = np.array(ratio_den, dtype=np.int64)
+        self._nv_pos = np.array(nv_pos, dtype=np.int64)
+        self._nv_idx = np.array(nv_idx, dtype=np.int64)
+        self._nv_code = np.array(nv_code, dtype=np.float64)
 
-    def _transform_poke_type(self, battle_status: BattleStatus, side: str) -> np.ndarray:
-        """
-        相手のタイプを表すベクトル
-        :param battle_status:
-        :param side:
-        :return:
-        """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        dex_poke_info = dex.get_pokedex_by_name(active.species)
-        feat = np.zeros((len(POKE_TYPES),), dtype=np.float32)
-        for poke_type in dex_poke_info["types"]:
-            feat[POKE_TYPE2NUM[poke_type]] = 1.0
-        return feat
-
-    def _transform_hp_ratio(self, battle_status: BattleStatus, side: str) -> np.ndarray:
-        """
-        ポケモンの残りHP/最大HP
-        :param battle_status:
-        :param side:
-        :return:
-        """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        feat = np.zeros((1,), dtype=np.float32)
-        feat[0] = active.hp_current / active.hp_max
-        return feat
-
-    def _transform_nv_condition(self, battle_status: BattleStatus, side: str) -> np.ndarray:
-        """
-        状態異常
-        :param battle_status:
-        :param side:
-        :return:
-        """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        feat = np.zeros((len(NV_CONDITIONS),), dtype=np.float32)
-        for i, cond in enumerate(NV_CONDITIONS):
-            if cond == active.status:
-                feat[i] = 1.0
-                break
-        return feat
-
-    def _transform_rank(self, battle_status: BattleStatus, side: str) -> np.ndarray:
-        """
-        ランク補正
-        :param battle_status:
-        :param side:
-        :return:
-        """
-        active = battle_status.side_statuses[side].active
-        assert active is not None
-        feat = np.zeros((len(RANKS),), dtype=np.float32)
-        for i, cond in enumerate(RANKS):
-            rank = active.ranks[cond]
-            feat[i] = (rank + 6.0) / 12.0  # 0~1
-        return feat
-
-    def _transform_weather(self, battle_status: BattleStatus, side: str) -> np.ndarray:
+    def transform(self, obs: RLPolicyObservation) -> np.ndarray:
+        # 1つの観測では、transform_batchの2次元配列の処理のオーバーヘッドが大きいため、1次元で処理する
+        battle_status = obs.battle_status
+        friend = battle_status.side_statuses[battle_status.side_friend]
+        opponent = battle_status.side_statuses[battle_status.side_opponent]
+        if self._use_active:
+            assert friend.active is not None and opponent.active is not None
+            values = np.array(friend.values + opponent.values + friend.active.values + opponent.active.values + [12],
+                              dtype=np.float64)
+        else:
+            values = np.array(friend.values + opponent.values, dtype=np.float64)
+        feats = np.empty((self._dims,), dtype=np.float32)
+        feats[self._ratio_pos] = (values[self._ratio_num] + self._ratio_add) / values[self._ratio_den]
+        feats[self._nv_pos] = values[self._nv_idx] == self._nv_code
+        if self._poke_type_pos is not None:
+            species2row, type_table = _poke_type_table()
+            feats[self._poke_type_pos:self._poke_type_pos + len(POKE_TYPES)] = type_table[
+                species2row[opponent.active.species]]
+        if self._weather_pos is not None:
+            feats[self._weather_pos:self._weather_pos + len(WEATHERS)] = _weather_table[
+                WEATHER2NUM.get(battle_status.weather, len(WEATHERS))]
+        return feats
+
+    def transform_batch(self, observations: Sequence[RLPolicyObservation],
+                        out: Optional[np.ndarray] = None) -> np.ndarray:
         """
-        天候
-        :param battle_status:
-        :param side:
-        :return:
+        複数の観測をまとめて特徴量に変換する
+        :param observations:
+        :param out: 書き込み先((len(observations), get_dims()), float32)。Noneなら新たに確保する
+        :return: 特徴量((len(observations), get_dims()), float32)
         """
-        weather = battle_status.weather
-        feat = np.zeros((len(WEATHERS),), dtype=np.float32)
-        for i, w in enumerate(WEATHERS):
-            if w == weather:
-                feat[i] = 1.0
-                break
-        return feat
+        n = len(observations)
+        if out is None:
+            out = np.empty((n, self._dims), dtype=np.float32)
+        rows = []
+        opponent_species = []
+        weathers = []
+        for obs in observations:
+            battle_status = obs.battle_status
+            friend = battle_status.side_statuses[battle_status.side_friend]
+            opponent = battle_status.side_statuses[battle_status.side_opponent]
+            if self._use_active:
+                assert friend.active is not None and opponent.active is not None
+                rows.append(friend.values + opponent.values + friend.active.values + opponent.active.values + [12])
+                opponent_species.append(opponent.active.species)
+            else:
+                rows.append(friend.values + opponent.values)
+            weathers.append(WEATHER2NUM.get(battle_status.weather, len(WEATHERS)))
+        values = np.array(rows, dtype=np.float64)
+        out[:, self._ratio_pos] = (values[:, self._ratio_num] + self._ratio_add) / values[:, self._ratio_den]
+        out[:, self._nv_pos] = values[:, self._nv_idx] == self._nv_code
+        if self._poke_type_pos is not None:
+            species2row, type_table = _poke_type_table()
+            out[:, self._poke_type_pos:self._poke_type_pos + len(POKE_TYPES)] = type_table[
+                [species2row[species] for species in opponent_species]]
+        if self._weather_pos is not None:
+            out[:, self._weather_pos:self._weather_pos + len(WEATHERS)] = _weather_table[weathers]
+        return out
+
+
+@lru_cache(maxsize=None)
+def _poke_type_table() -> Tuple[Dict[str, int], np.ndarray]:
+    """
+    全ポケモンのタイプを表すベクトルの表
+    :return: ポケモン名から行への対応、表((ポケモン数, len(POKE_TYPES)), float32)
+    """
+    names = dex.get_all_poke_names()
+    table = np.zeros((len(names), len(POKE_TYPES)), dtype=np.float32)
+    for i, name in enumerate(names):
+        for poke_type in dex.get_pokedex_by_name(name)["types"]:
+            table[i, POKE_TYPE2NUM[poke_type]] = 1.0
+    return {name: i for i, name in enumerate(names)}, table
@@ -0,0 +1,217 @@
+"""
+asyncioによるシミュレータラッパー
+1つのイベントループで多数のバトルを並行して進行させる
+方策の行動選択(ActionPolicy.choice_turn_start_async等)をawaitするため、
+複数のバトルの判断要求をまとめて処理する方策を実装できる
+"""
+import asyncio
+import itertools
+import json
+import logging
+import struct
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from logging import getLogger
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.framing import FRAMING_BINARY, FRAMING_JSON, SimProcessError, encode_discard_frame, encode_frame, \
+    simpipe_args
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import BattleSession
+from pokeai.util import ROOT_DIR
+
+logger = getLogger(__name__)
+
+# endメッセージはバトルのログ全体を含み長くなるため、1行の長さの上限を大きくとる
+READ_LIMIT = 2 ** 24
+
+
+class AsyncSimProcess:
+    """
+    --multiplexモードのシミュレータプロセス1つ
+    標準出力を読むタスクが、バトルIDごとのキューにchunkを振り分ける
+    """
+    proc: asyncio.subprocess.Process
+    queues: Dict[int, asyncio.Queue]
+
+    def __init__(self, proc: asyncio.subprocess.Process, framing: str):
+        self.proc = proc
+        self.framing = framing
+        self.queues = {}
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    @classmethod
+    async def spawn(cls, framing: str = FRAMING_JSON, split_updates: bool = False) -> "AsyncSimProcess":
+        proc = await asyncio.create_subprocess_exec(*simpipe_args(True, framing, split_updates), stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE, cwd=str(ROOT_DIR),
+                                                    limit=READ_LIMIT)
+        return cls(proc, framing)
+
+    async def close(self):
+        self._reader_task.cancel()
+        self.proc.stdin.close()
+        self.proc.terminate()
+        await self.proc.wait()
+
+    async def write_chunk(self, battle_id: int, commands: List[str]):
+        data = '\n'.join(commands)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("writeChunk " + json.dumps([battle_id, data]))
+        self.proc.stdin.write(encode_frame(self.framing, data, battle_id))
+        await self.proc.stdin.drain()
+
+    def discard(self, battle_id: int):
+        """
+        終了していないバトルをシミュレータ側で破棄する
+        プロセスが異常終了している場合は何もしない
+        """
+        if self.proc.stdin.is_closing():
+            return
+        try:
+            self.proc.stdin.write(encode_discard_frame(self.framing, battle_id))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def is_alive(self) -> bool:
+        """
+        標準出力を読むタスクが動作している(chunkを振り分けられる)か
+        """
+        return not self._reader_task.done()
+
+    async def _read_frame(self) -> Tuple[int, str]:
+        if self.framing == FRAMING_BINARY:
+            length, battle_id = struct.unpack('>II', await self.proc.stdout.readexactly(8))
+            return battle_id, (await self.proc.stdout.readexactly(length)).decode('utf-8')
+        line = await self.proc.stdout.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        battle_id, rawstr = json.loads(line)
+        return battle_id, rawstr
+
+    async def _read_loop(self):
+        try:
+            while True:
+                battle_id, rawstr = await self._read_frame()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("readChunk " + json.dumps([battle_id, rawstr]))
+                queue = self.queues.get(battle_id)
+                if queue is None:
+                    # 破棄したバトルの、破棄が届く前に出力されたchunk
+                    continue
+                queue.put_nowait(rawstr.split('\n', 1))  # 最初の1要素(update, endなど)のみ分離
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception:
+            logger.exception("failed to read simulator output")
+        finally:
+            # 進行中のバトルに異常終了を知らせる
+            for queue in self.queues.values():
+                queue.put_nowait(None)
+
+
+class AsyncSim:
+    """
+    非同期シミュレータ
+    run()を多数同時にawaitすることで、n_procs個のシミュレータプロセス上でバトルを並行して進行させる
+    """
+    n_procs: int
+    procs: List[AsyncSimProcess]
+    framing: str
+    split_updates: bool
+
+    def __init__(self, n_procs: int = 1, framing: str = FRAMING_JSON, split_updates: bool = False):
+        """
+        :param n_procs: シミュレータプロセス数
+        :param framing: シミュレータとの通信方式 'json' or 'binary'
+        :param split_updates: updateのプレイヤーごとの分割をシミュレータ側で行う
+        """
+        self.n_procs = n_procs
+        self.framing = framing
+        self.split_updates = split_updates
+        self.procs = []
+        self._next_battle_id = 0
+
+    async def start(self):
+        if len(self.procs) == 0:
+            self.procs = [await AsyncSimProcess.spawn(self.framing, self.split_updates) for _ in range(self.n_procs)]
+
+    async def close(self):
+        for sim_proc in self.procs:
+            await sim_proc.close()
+        self.procs = []
+
+    async def run(self, parties: List[Party], policies: List[ActionPolicy], seed: Optional[List[int]] = None) -> dict:
+        """
+        バトルを１回行う
+        状態を持つ方策（学習用エージェントなど）のインスタンスを、同時に進行する複数のバトルで共有してはならない
+        :param parties: [p1のパーティ, p2のパーティ]
+        :param policies: [p1の方策, p2の方策]
+        :param seed: 乱数シード。Noneならシミュレータ側で決める
+        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, ...}
+        """
+        await self.start()
+        processors = []
+        for policy in policies:
+            processor = BattleStreamProcessor()
+            processor.set_policy(policy)
+            processors.append(processor)
+        battle_id = self._next_battle_id
+        self._next_battle_id += 1
+        # 進行中のバトルが最も少ないプロセスに割り当てる
+        sim_proc = min(self.procs, key=lambda p: len(p.queues))
+        queue = asyncio.Queue()
+        sim_proc.queues[battle_id] = queue
+        finished = False
+        try:
+            if not sim_proc.is_alive():
+                raise SimProcessError("simulator process exited unexpectedly")
+            session = BattleSession(parties, processors, seed)
+            for commands in session.start():
+                await sim_proc.write_chunk(battle_id, commands)
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    finished = True
+                    raise SimProcessError("simulator process exited unexpectedly")
+                chunk_type, chunk_data = chunk
+                write_chunks, battle_result = await session.process_chunk_async(chunk_type, chunk_data)
+                for commands in write_chunks:
+                    await sim_proc.write_chunk(battle_id, commands)
+                if battle_result is not None:
+                    finished = True
+                    return battle_result
+        finally:
+            del sim_proc.queues[battle_id]
+            if not finished:
+                # 方策の例外やキャンセルで中断したバトルは、シミュレータ側に残さない
+                sim_proc.discard(battle_id)
+
+    async def run_many(self, matchups: Iterable[List[Party]], policies: Iterable[List[ActionPolicy]],
+                       max_concurrent: int = 256, seeds: Optional[Iterable[Optional[List[int]]]] = None) -> \
+            AsyncIterator[Tuple[int, dict]]:
+        """
+        複数のバトルを並行して行い、終了したものから結果を返す
+        :param matchups: 各バトルのパーティ [p1のパーティ, p2のパーティ] の列
+        :param policies: 各バトルの方策 [p1の方策, p2の方策] の列。matchupsと同じ長さ
+        :param max_concurrent: 同時に進行させるバトル数の上限
+        :param seeds: 各バトルの乱数シードの列。Noneならシミュレータ側で決める
+        :return: (matchupsにおけるインデックス, endメッセージの内容) をバトル終了順に返す非同期イテレータ
+        """
+        await self.start()
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        async def run_one(matchup_idx: int, parties: List[Party], battle_policies: List[ActionPolicy],
+                          seed: Optional[List[int]]):
+            async with semaphore:
+                return matchup_idx, await self.run(parties, battle_policies, seed)
+
+        if seeds is None:
+            seeds = itertools.repeat(None)
+        tasks = [asyncio.create_task(run_one(matchup_idx, parties, battle_policies, seed))
+                 for matchup_idx, (parties, battle_policies, seed) in enumerate(zip(matchups, policies, seeds))]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
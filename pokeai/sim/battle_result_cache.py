@@ -0,0 +1,81 @@
+"""
+バトル結果のキャッシュ
+(パーティ, 方策, 乱数シード)が同じバトルは結果も同じなので、再実行を省略する
+sqliteのファイルに保存し、複数回の実験で共有できる
+"""
+import hashlib
+import json
+import sqlite3
+from typing import List, Optional
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.sim.party_generator import Party
+
+# endメッセージのうちキャッシュに保存する項目(バトルログ全体は大きいため保存しない)
+_cached_result_keys = ['winner', 'turns', 'seed']
+
+
+def party_hash(party: Party) -> str:
+    """
+    パーティの内容から定まるハッシュ値
+    """
+    return hashlib.sha1(json.dumps(party, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BattleResultCache:
+    def __init__(self, path: str):
+        """
+        :param path: sqliteファイルのパス。存在しなければ作成する
+        """
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS battle_result (key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def make_key(parties: List[Party], policies: List[ActionPolicy], seed: Optional[List[int]]) -> Optional[str]:
+        """
+        キャッシュのキーを生成する
+        :param parties: [p1のパーティ, p2のパーティ]
+        :param policies: [p1の方策, p2の方策]
+        :param seed: バトルの乱数シード
+        :return: キー。乱数シードがないか、キャッシュできない方策を含む場合はNone
+        """
+        if seed is None:
+            return None
+        policy_keys = [policy.cache_key() for policy in policies]
+        if None in policy_keys:
+            return None
+        return json.dumps([[party_hash(party) for party in parties], policy_keys, seed])
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        """
+        キャッシュされたバトル結果を取得する
+        :param key: make_keyで生成したキー
+        :return: {'winner': 'p1', 'turns': 34, 'seed': [...]}。キャッシュされていなければNone
+        """
+        if key is None:
+            return None
+        row = self.conn.execute('SELECT result FROM battle_result WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: Optional[str], battle_result: dict):
+        """
+        バトル結果を保存する
+        :param key: make_keyで生成したキー
+        :param battle_result: endメッセージの内容
+        """
+        if key is None:
+            return
+        result = {k: battle_result[k] for k in _cached_result_keys if k in battle_result}
+        self.conn.execute('INSERT OR REPLACE INTO battle_result (key, result) VALUES (?, ?)',
+                          (key, json.dumps(result)))
+        self.conn.commit()
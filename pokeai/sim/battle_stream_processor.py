@@ -9,7 +9,10 @@ from typing import Optional, List, Tuple
 from logging import getLogger
 
 from pokeai.ai.battle_status import BattleStatus, parse_hp_condition
+from pokeai.ai.common import ActionEncodingCache
 from pokeai.sim.party_generator import Party
+from pokeai.sim.protocol_tokenizer import ProtocolTokenizer
+from pokeai.sim.trace_recorder import BattleTrace
 from pokeai.util import pickle_base64_dumps
 
 logger = getLogger(__name__)
@@ -63,10 +66,14 @@ class BattleStreamProcessor:
                    't:',  # timestamp
                    ]
 
+    # 全インスタンスで共有する(ハンドラの対象となるメッセージの種類は共通)
+    _tokenizer = None  # type: Optional[ProtocolTokenizer]
+
     def __init__(self):
         self.side = None
         self.side_party = None
         self.policy = None
+        self.trace = None
         self._handlers = {
             'request': self._handle_request,
             'switch': self._handle_switch,
@@ -91,10 +98,23 @@ class BattleStreamProcessor:
             'faint': self._handle_faint,
             '-weather': self._handle_weather,
         }
+        # opcode(ProtocolTokenizerの出力)をインデックスとするハンドラの配列
+        self._handler_list = list(self._handlers.values())
+        if BattleStreamProcessor._tokenizer is None:
+            BattleStreamProcessor._tokenizer = ProtocolTokenizer(self._handlers.keys(),
+                                                                 BattleStreamProcessor.ignore_msgs)
 
     def set_policy(self, policy: "ActionPolicy"):
         self.policy = policy
 
+    def set_trace(self, trace: Optional[BattleTrace]):
+        """
+        バトルの経過を記録するトレースを設定する。start_battleの後で呼ぶ
+        :param trace: Noneなら記録しない
+        """
+        self.trace = trace
+        self.policy.set_trace(trace)
+
     def start_battle(self, side: str, side_party: Party):
         """
         バトルの開始。バトルの状態を初期化する。
@@ -106,8 +126,10 @@ class BattleStreamProcessor:
         self.side_party = side_party
         self.last_request = None
         self.last_request_my_action = 'none'
+        self.trace = None
         # FIXME: BattleStatusと責任境界が分かれてない
         self.battle_status = BattleStatus(side, side_party)
+        self.battle_status.action_cache = ActionEncodingCache(side_party)
         self.policy.game_start()
 
     def process_chunk(self, chunk_type: str, data: str) -> Optional[str]:
@@ -117,35 +139,58 @@ class BattleStreamProcessor:
         :param data:
         :return: "move 2"や"switch 1"のような行動
         """
+        self._process_messages(data)
         choice = None
-        for line in data.splitlines():
-            # |request|xxx
-            lineparts = line.split('|')
-            msg = lineparts[1]
-            msgargs = lineparts[2:]
-            handler = self._handlers.get(msg)
-            if handler is not None:
-                handler(msgargs)
-            elif msg in BattleStreamProcessor.ignore_msgs:
-                # 安全に無視できるメッセージ
-                pass
-            else:
-                raise NotImplementedError(f"unknown message {msg} in {data}")
         if chunk_type == "update":
+            if self.trace is not None:
+                self.trace.add_update(self.side, data)
             if self.last_request_my_action == 'turn_start':
                 choice = self.policy.choice_turn_start(self.battle_status, self.last_request)
             elif self.last_request_my_action == 'force_switch':
                 choice = self.policy.choice_force_switch(self.battle_status, self.last_request)
-            if choice is not None and logger.isEnabledFor(logging.DEBUG):
-                logger.debug(
-                    f'choice_{self.last_request_my_action}: ' + json.dumps(
-                        {"battle_status": pickle_base64_dumps(self.battle_status),
-                         "battle_status_json": self.battle_status.json_dumps(),
-                         "request": self.last_request,
-                         "choice": choice}))
+            self._log_choice(choice)
             self.last_request_my_action = 'none'
         return choice
 
+    async def process_chunk_async(self, chunk_type: str, data: str) -> Optional[str]:
+        """
+        process_chunkの非同期版。方策の行動選択をawaitする
+        :param chunk_type:
+        :param data:
+        :return: "move 2"や"switch 1"のような行動
+        """
+        self._process_messages(data)
+        choice = None
+        if chunk_type == "update":
+            if self.trace is not None:
+                self.trace.add_update(self.side, data)
+            if self.last_request_my_action == 'turn_start':
+                choice = await self.policy.choice_turn_start_async(self.battle_status, self.last_request)
+            elif self.last_request_my_action == 'force_switch':
+                choice = await self.policy.choice_force_switch_async(self.battle_status, self.last_request)
+            self._log_choice(choice)
+            self.last_request_my_action = 'none'
+        return choice
+
+    def _process_messages(self, data: str):
+        """
+        chunkに含まれるメッセージを解釈し、バトルの状態を更新する
+        :param data:
+        :return:
+        """
+        self._tokenizer.dispatch(data, self._handler_list)
+
+    def _log_choice(self, choice: Optional[str]):
+        if choice is not None and self.trace is not None:
+            self.trace.add_choice(self.side, self.battle_status, self.last_request, choice)
+        if choice is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f'choice_{self.last_request_my_action}: ' + json.dumps(
+                    {"battle_status": pickle_base64_dumps(self.battle_status),
+                     "battle_status_json": self.battle_status.json_dumps(),
+                     "request": self.last_request,
+                     "choice": choice}))
+
     def _handle_request(self, msgargs: List[str]) -> Optional[str]:
         """
         |request|{"active":[{"moves":[{"move":"Toxic", ...
@@ -318,7 +363,7 @@ class BattleStreamProcessor:
         # じこあんじをしたのはNatuなのでNatuが変化する側
         source = self.battle_status.get_side(msgargs[1]).active
         target = self.battle_status.get_side(msgargs[0]).active
-        target.ranks = source.ranks.copy()
+        target.rank_copy(source)
         return None
 
     def _handle_clearallboost(self, msgargs: List[str]) -> Optional[str]:
@@ -0,0 +1,194 @@
+"""
+シミュレータのスループットのベンチマーク
+固定シードでRandomPolicy同士・RLPolicy同士の対戦を各レギュレーションで行い、
+1秒あたりのバトル数・ターン数と、処理段階ごとの所要時間をjsonで出力する
+
+python -m pokeai.sim.bench --battles 100 --output bench.json
+
+処理段階(時間は入れ子になっている段階を含む)
+node_cpu: シミュレータプロセスのCPU時間
+ipc_read_wait: シミュレータからのchunkの受信(シミュレータの処理を待つ時間を含む)
+ipc_write: シミュレータへのchunkの送信
+extract_update: updateのプレイヤーごとの分割(Python側で行う場合のみ)
+process_chunk: BattleStreamProcessor.process_chunk(policyを含む)
+policy: 方策の行動選択(feature_extraction, model_inferenceを含む)
+feature_extraction: FeatureExtractor.transform
+model_inference: Q関数の計算
+"""
+import argparse
+import json
+import random
+import resource
+import subprocess
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+import torch
+
+import pokeai.sim.sim
+from pokeai.ai.generic_move_model.agent import Agent
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+from pokeai.ai.generic_move_model.trainer import Trainer
+from pokeai.ai.random_policy import RandomPolicy
+from pokeai.ai.rl_policy import RLPolicy
+from pokeai.ai.surrogate_reward_config import SurrogateRewardConfigZero
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.random_party_generator import RandomPartyGenerator
+from pokeai.sim.sim import Sim, make_battle_seed
+from pokeai.util import DATASET_DIR, ROOT_DIR
+
+MATCHUPS = ['random', 'rl']
+
+
+class StageTimer:
+    """
+    関数を計測用のラッパーに差し替え、処理段階ごとの所要時間と呼び出し回数を集計する
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._patches = []
+
+    def wrap(self, owner: object, attr: str, stage: str):
+        orig = getattr(owner, attr)
+        seconds = self.seconds
+        calls = self.calls
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                seconds[stage] += time.perf_counter() - start
+                calls[stage] += 1
+
+        setattr(owner, attr, timed)
+        self._patches.append((owner, attr, orig))
+
+    def restore(self):
+        for owner, attr, orig in reversed(self._patches):
+            setattr(owner, attr, orig)
+        self._patches = []
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+
+
+def install_stage_timer() -> StageTimer:
+    timer = StageTimer()
+    timer.wrap(Sim, '_readChunk', 'ipc_read_wait')
+    timer.wrap(Sim, '_writeChunk', 'ipc_write')
+    timer.wrap(pokeai.sim.sim, 'extract_update_for_side', 'extract_update')
+    timer.wrap(BattleStreamProcessor, 'process_chunk', 'process_chunk')
+    for policy_class in [RandomPolicy, RLPolicy]:
+        timer.wrap(policy_class, 'choice_turn_start', 'policy')
+        timer.wrap(policy_class, 'choice_force_switch', 'policy')
+    timer.wrap(FeatureExtractor, 'transform', 'feature_extraction')
+    timer.wrap(Agent, '_calc_q_vector', 'model_inference')
+    return timer
+
+
+def make_policy_factory(matchup: str, party_size: int) -> Callable[[], RandomPolicy]:
+    if matchup == 'random':
+        return RandomPolicy
+    # 学習していないモデルだが、推論のコストは学習済みモデルと同じ
+    trainer = Trainer(model_params={"n_layers": 3, "n_channels": 64, "bn": False}, dqn_params={},
+                      feature_params={"party_size": party_size})
+    return lambda: RLPolicy(trainer.get_val_agent(), SurrogateRewardConfigZero)
+
+
+def children_cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_one(regulation: str, matchup: str, battles: int, seed: int, split_updates: bool,
+              timer: StageTimer) -> dict:
+    random.seed(seed)
+    torch.manual_seed(seed)
+    gen = RandomPartyGenerator(regulation=regulation)
+    parties_list = [[gen.generate() for _ in range(2)] for _ in range(battles)]
+    policy_factory = make_policy_factory(matchup, gen.party_size)
+    sim = Sim(split_updates=split_updates)
+    timer.reset()
+    total_turns = 0
+    child_start = children_cpu_time()
+    wall_start = time.perf_counter()
+    with torch.no_grad():
+        for i, parties in enumerate(parties_list):
+            bsps = []
+            for _ in range(2):
+                bsp = BattleStreamProcessor()
+                bsp.set_policy(policy_factory())
+                bsps.append(bsp)
+            sim.set_processor(bsps)
+            sim.set_party(parties)
+            battle_result = sim.run(make_battle_seed(seed, regulation, matchup, i))
+            total_turns += battle_result['turns']
+    wall_time = time.perf_counter() - wall_start
+    # RUSAGE_CHILDRENは終了した子プロセスのみ集計されるため、プロセスを終了してから計測する
+    sim.close()
+    stages = {'node_cpu': {'seconds': children_cpu_time() - child_start, 'calls': 0}}
+    for stage, seconds in timer.seconds.items():
+        stages[stage] = {'seconds': seconds, 'calls': timer.calls[stage]}
+    for stage_result in stages.values():
+        stage_result['seconds_per_battle'] = stage_result['seconds'] / battles
+    return {
+        'regulation': regulation,
+        'matchup': matchup,
+        'battles': battles,
+        'turns': total_turns,
+        'wall_seconds': wall_time,
+        'battles_per_sec': battles / wall_time,
+        'turns_per_sec': total_turns / wall_time,
+        'stages': stages,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(ROOT_DIR),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--battles", type=int, default=100, help="レギュレーション・対戦の組み合わせごとのバトル数")
+    parser.add_argument("--regulations", help="対象のレギュレーション(カンマ区切り)。省略時は全て")
+    parser.add_argument("--matchups", default=",".join(MATCHUPS), help="対象の対戦(random,rl)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--split", action="store_true", help="updateのプレイヤーごとの分割をシミュレータ側で行う")
+    parser.add_argument("--output", help="結果の出力先(json)。省略時は標準出力")
+    args = parser.parse_args()
+    if args.regulations:
+        regulations = args.regulations.split(",")
+    else:
+        regulations = sorted(p.name for p in DATASET_DIR.joinpath('regulations').iterdir() if p.is_dir())
+    timer = install_stage_timer()
+    results = []  # type: List[Dict]
+    try:
+        for regulation in regulations:
+            for matchup in args.matchups.split(","):
+                assert matchup in MATCHUPS
+                results.append(bench_one(regulation, matchup, args.battles, args.seed, args.split, timer))
+    finally:
+        timer.restore()
+    report = {
+        'commit': get_commit(),
+        'config': {'battles': args.battles, 'seed': args.seed, 'split_updates': args.split},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
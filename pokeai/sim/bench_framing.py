@@ -0,0 +1,130 @@
+"""
+シミュレータとの通信方式(framing)のマイクロベンチマーク
+
+Simのログ(pokeai.sim.simのDEBUGログ)に記録されたchunkを各方式でエンコード・デコードし、
+1バトルあたりの通信バイト数とPython側のCPU時間を比較する
+--live を指定すると、実際にシミュレータを起動してランダム方策同士のバトルを行い、
+Python側・シミュレータ側それぞれのCPU時間を計測する
+"""
+import argparse
+import io
+import json
+import resource
+import time
+from typing import List, Tuple
+
+from pokeai.sim.framing import FRAMINGS, FrameDecoder, encode_frame, read_frame
+
+
+def load_chunks(log_path: str) -> Tuple[List[str], List[str], int]:
+    """
+    ログからchunkを抽出する
+    :return: Python→シミュレータのchunk, シミュレータ→Pythonのchunk, バトル数(endの数)
+    """
+    writes = []
+    reads = []
+    n_battles = 0
+    with open(log_path) as f:
+        for line in f:
+            for marker, dst in (("writeChunk ", writes), ("readChunk ", reads)):
+                pos = line.find(marker)
+                if pos < 0:
+                    continue
+                data = json.loads(line[pos + len(marker):])
+                if isinstance(data, list):
+                    data = data[1]  # 多重化モードのログ [battle_id, chunk]
+                dst.append(data)
+                if dst is reads and data.startswith("end\n"):
+                    n_battles += 1
+                break
+    return writes, reads, n_battles
+
+
+def bench_framing(framing: str, writes: List[str], reads: List[str], multiplex: bool, repeat: int) -> dict:
+    battle_id = 0 if multiplex else None
+    encoded_reads = b''.join(encode_frame(framing, data, battle_id) for data in reads)
+    write_bytes = sum(len(encode_frame(framing, data, battle_id)) for data in writes)
+
+    start = time.process_time()
+    for _ in range(repeat):
+        for data in writes:
+            encode_frame(framing, data, battle_id)
+    encode_time = (time.process_time() - start) / repeat
+
+    start = time.process_time()
+    for _ in range(repeat):
+        if multiplex:
+            decoder = FrameDecoder(framing)
+            # パイプからの読み込み単位を模擬して64KiBずつ与える
+            for pos in range(0, len(encoded_reads), 65536):
+                decoder.feed(encoded_reads[pos:pos + 65536])
+        else:
+            stream = io.BytesIO(encoded_reads)
+            for _ in range(len(reads)):
+                read_frame(framing, stream, False)
+    decode_time = (time.process_time() - start) / repeat
+
+    return {"write_bytes": write_bytes, "read_bytes": len(encoded_reads),
+            "encode_sec": encode_time, "decode_sec": decode_time}
+
+
+def bench_live(framing: str, n_battles: int) -> dict:
+    from pokeai.ai.random_policy import RandomPolicy
+    from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+    from pokeai.sim.random_party_generator import RandomPartyGenerator
+    from pokeai.sim.sim import Sim
+
+    gen = RandomPartyGenerator()
+    policies = [RandomPolicy() for _ in range(2)]
+    sim = Sim(framing=framing)
+
+    def run_battle():
+        bsps = []
+        for policy in policies:
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(policy)
+            bsps.append(bsp)
+        sim.set_processor(bsps)
+        sim.set_party([gen.generate() for _ in range(2)])
+        sim.run()
+
+    run_battle()  # シミュレータの起動時間を除外する
+    self_start = time.process_time()
+    child_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_start = time.perf_counter()
+    for _ in range(n_battles):
+        run_battle()
+    wall_time = time.perf_counter() - wall_start
+    self_time = time.process_time() - self_start
+    sim.close()
+    # RUSAGE_CHILDRENは終了した子プロセスのみ集計されるため、シミュレータ側の時間は起動時間を含む
+    child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    child_time = (child_end.ru_utime + child_end.ru_stime) - (child_start.ru_utime + child_start.ru_stime)
+    return {"python_cpu_sec": self_time / n_battles, "simulator_cpu_sec": child_time / n_battles,
+            "wall_sec": wall_time / n_battles}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", help="pokeai.sim.simのDEBUGログ(readChunk/writeChunkを含む)")
+    parser.add_argument("--multiplex", action="store_true", help="多重化モードのフレームで計測する")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--live", type=int, default=0, help="実際にシミュレータで行うバトル数")
+    args = parser.parse_args()
+    report = {}
+    if args.log:
+        writes, reads, n_battles = load_chunks(args.log)
+        n_battles = max(n_battles, 1)
+        report["n_battles"] = n_battles
+        for framing in FRAMINGS:
+            result = bench_framing(framing, writes, reads, args.multiplex, args.repeat)
+            report[framing] = {k: v / n_battles for k, v in result.items()}
+        json_result, binary_result = report["json"], report["binary"]
+        report["saved_per_battle"] = {k: json_result[k] - binary_result[k] for k in json_result}
+    if args.live > 0:
+        report["live"] = {framing: bench_live(framing, args.live) for framing in FRAMINGS}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+HP・ポケモンの情報を表す文字列のパース処理のベンチマーク
+Simのログ(pokeai.sim.simのDEBUGログ)に記録されたchunkから、BattleStatusがパースする文字列を抽出し、
+従来の毎回re.matchを行う方式、正規表現をコンパイル済みの方式、結果をキャッシュする方式の処理時間を比較する
+結果は1000バトルあたりの秒数で出力する
+
+python -m pokeai.sim.bench_parse --log sim_debug.log
+"""
+import argparse
+import json
+import re
+import time
+from typing import Callable, List, Tuple
+
+from pokeai.ai.battle_status import _parse_details, _parse_details_uncached, _parse_hp_condition_uncached, \
+    parse_hp_condition
+from pokeai.sim.bench_framing import load_chunks
+from pokeai.sim.bench_tokenizer import player_chunks
+
+# HPを含むメッセージ(引数中の位置)
+_hp_messages = {'-damage': 1, '-heal': 1, '-sethp': 1, 'switch': 2, 'drag': 2}
+# ポケモンの情報を含むメッセージ
+_details_messages = {'switch': 1, 'drag': 1}
+
+
+def extract_strings(datas: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    chunkから、パースされるHPの文字列とポケモンの情報の文字列を出現順に抽出する
+    """
+    hp_conditions = []
+    details = []
+    for data in datas:
+        for line in data.splitlines():
+            lineparts = line.split('|')
+            msg = lineparts[1]
+            if msg in _hp_messages:
+                hp_conditions.append(lineparts[2 + _hp_messages[msg]])
+            if msg in _details_messages:
+                details.append(lineparts[2 + _details_messages[msg]])
+    return hp_conditions, details
+
+
+def parse_hp_condition_legacy(hp_condition: str) -> Tuple[int, int, str]:
+    if hp_condition == '0 fnt':
+        return 0, 100, 'fnt'
+    m = re.match('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$', hp_condition)
+    assert m is not None
+    return int(m[1]), int(m[2]), m[3] or ''
+
+
+def parse_details_legacy(details: str) -> Tuple[str, int, str]:
+    m = re.match('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch’d), L(\\d+)(?:, (M|F|N))?$', details)
+    assert m is not None
+    return m[1], int(m[2]), m[3] or 'N'
+
+
+def measure(hp_func: Callable[[str], tuple], details_func: Callable[[str], tuple], hp_conditions: List[str],
+            details: List[str], repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        for hp_condition in hp_conditions:
+            hp_func(hp_condition)
+        for d in details:
+            details_func(d)
+    return (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", required=True, help="pokeai.sim.simのDEBUGログ(readChunkを含む)")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    _, reads, n_battles = load_chunks(args.log)
+    hp_conditions, details = extract_strings(player_chunks(reads))
+    n_battles = max(n_battles, 1)
+    legacy = measure(parse_hp_condition_legacy, parse_details_legacy, hp_conditions, details, args.repeat)
+    compiled = measure(_parse_hp_condition_uncached, _parse_details_uncached, hp_conditions, details, args.repeat)
+    # キャッシュは1回目の計測で温まった状態となる(多数のバトルを行う場合と同様)
+    parse_hp_condition.cache_clear()
+    _parse_details.cache_clear()
+    cached = measure(parse_hp_condition, _parse_details, hp_conditions, details, args.repeat)
+    report = {
+        "battles": n_battles,
+        "hp_conditions": len(hp_conditions),
+        "distinct_hp_conditions": len(set(hp_conditions)),
+        "details": len(details),
+        "distinct_details": len(set(details)),
+        "legacy_sec_per_1k_battles": legacy / n_battles * 1000,
+        "compiled_sec_per_1k_battles": compiled / n_battles * 1000,
+        "cached_sec_per_1k_battles": cached / n_battles * 1000,
+        "speedup": legacy / cached,
+        "hp_cache": parse_hp_condition.cache_info()._asdict(),
+        "details_cache": _parse_details.cache_info()._asdict(),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+プロトコル文字列の解析処理のベンチマーク
+Simのログ(pokeai.sim.simのDEBUGログ)に記録されたchunkについて、
+従来の1行ずつsplitしてdict・listを引く方式と、ProtocolTokenizerの処理時間を比較する
+ハンドラは何もしない関数とし、解析処理のみを計測する
+
+python -m pokeai.sim.bench_tokenizer --log sim_debug.log
+"""
+import argparse
+import json
+import time
+from typing import Callable, List
+
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.bench_framing import load_chunks
+from pokeai.sim.protocol_tokenizer import ProtocolTokenizer
+from pokeai.sim.sim import extract_update_for_side
+
+
+def player_chunks(reads: List[str]) -> List[str]:
+    """
+    シミュレータからのchunkを、BattleStreamProcessor.process_chunkに渡される形式に変換する
+    """
+    datas = []
+    for rawstr in reads:
+        chunk_type, chunk_data = rawstr.split('\n', 1)
+        if chunk_type in ('sideupdate', 'playerupdate'):
+            side, side_data = chunk_data.split('\n', 1)
+            if side != 'omniscient':
+                datas.append(side_data)
+        elif chunk_type == 'update':
+            for side in ['p1', 'p2']:
+                datas.append(extract_update_for_side(side, chunk_data))
+    return datas
+
+
+class EventCounter:
+    """
+    何もしないハンドラ。呼ばれた回数のみ数える
+    """
+
+    def __init__(self):
+        self.n_events = 0
+
+    def __call__(self, msgargs: List[str]):
+        self.n_events += 1
+
+
+def parse_legacy(datas: List[str], handlers: dict, ignore_msgs: List[str]):
+    for data in datas:
+        for line in data.splitlines():
+            lineparts = line.split('|')
+            msg = lineparts[1]
+            msgargs = lineparts[2:]
+            handler = handlers.get(msg)
+            if handler is not None:
+                handler(msgargs)
+            elif msg in ignore_msgs:
+                pass
+            else:
+                raise NotImplementedError(f"unknown message {msg} in {data}")
+
+
+def parse_tokenizer(datas: List[str], handler_list: list, tokenizer: ProtocolTokenizer):
+    for data in datas:
+        tokenizer.dispatch(data, handler_list)
+
+
+def measure(func: Callable[[EventCounter], None], repeat: int) -> dict:
+    counter = EventCounter()
+    func(counter)
+    n_events = counter.n_events
+    start = time.process_time()
+    for _ in range(repeat):
+        func(counter)
+    return {"events": n_events, "sec": (time.process_time() - start) / repeat}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", required=True, help="pokeai.sim.simのDEBUGログ(readChunkを含む)")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    _, reads, n_battles = load_chunks(args.log)
+    datas = player_chunks(reads)
+    bsp = BattleStreamProcessor()
+
+    n_handlers = len(bsp._handler_list)
+    n_lines = sum(len(data.splitlines()) for data in datas)
+    legacy = measure(lambda counter: parse_legacy(datas, {msg: counter for msg in bsp._handlers},
+                                                  BattleStreamProcessor.ignore_msgs), args.repeat)
+    tokenizer = measure(lambda counter: parse_tokenizer(datas, [counter] * n_handlers, bsp._tokenizer), args.repeat)
+    assert legacy["events"] == tokenizer["events"]
+    n_battles = max(n_battles, 1)
+    report = {
+        "battles": n_battles,
+        "chunks": len(datas),
+        "lines": n_lines,
+        "handled_events": legacy["events"],
+        "legacy_sec_per_battle": legacy["sec"] / n_battles,
+        "tokenizer_sec_per_battle": tokenizer["sec"] / n_battles,
+        "speedup": legacy["sec"] / tokenizer["sec"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
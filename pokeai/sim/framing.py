@@ -0,0 +1,143 @@
+"""
+シミュレータプロセスとの通信における、メッセージの区切り方(フレーミング)
+
+json: chunk文字列をjsonシリアライズして1行で送受信する(従来方式)
+binary: 長さを前置したUTF-8バイト列で送受信する。エスケープやjsonのデコードが不要
+  単一バトルモード: [ペイロード長 uint32 big endian][ペイロード]
+  多重化モード: [ペイロード長 uint32][battle_id uint32][ペイロード] (ペイロード長0はバトルの破棄)
+"""
+import json
+import struct
+from typing import BinaryIO, List, Optional, Tuple
+
+FRAMING_JSON = 'json'
+FRAMING_BINARY = 'binary'
+FRAMINGS = [FRAMING_JSON, FRAMING_BINARY]
+
+
+class SimProcessError(ValueError):
+    """
+    シミュレータプロセスが異常終了した
+    方策の例外などと区別し、プロセスを再起動してバトルをやり直せるようにする
+    """
+    pass
+
+
+_header_single = struct.Struct('>I')
+_header_multiplex = struct.Struct('>II')
+
+
+def simpipe_args(multiplex: bool, framing: str, split_updates: bool = False) -> List[str]:
+    """
+    js/simpipe.js の起動引数
+    :param multiplex: 1プロセスで複数のバトルを扱う
+    :param framing:
+    :param split_updates: updateをシミュレータ側でプレイヤーごとに分割し、playerupdateとして受け取る
+    """
+    assert framing in FRAMINGS
+    args = ['node', 'js/simpipe']
+    if multiplex:
+        args.append('--multiplex')
+    if framing == FRAMING_BINARY:
+        args.append('--binary')
+    if split_updates:
+        args.append('--split')
+    return args
+
+
+def encode_frame(framing: str, data: str, battle_id: Optional[int] = None) -> bytes:
+    """
+    1つのchunkを送信用のバイト列に変換する
+    :param framing:
+    :param data: chunk文字列
+    :param battle_id: 多重化モードの場合のバトルID
+    :return:
+    """
+    if framing == FRAMING_JSON:
+        if battle_id is None:
+            return (json.dumps(data) + '\n').encode('utf-8')
+        return (json.dumps([battle_id, data]) + '\n').encode('utf-8')
+    payload = data.encode('utf-8')
+    if battle_id is None:
+        return _header_single.pack(len(payload)) + payload
+    return _header_multiplex.pack(len(payload), battle_id) + payload
+
+
+def encode_discard_frame(framing: str, battle_id: int) -> bytes:
+    """
+    多重化モードで、バトルを破棄する(シミュレータ側のストリームを閉じる)ための送信用のバイト列
+    jsonではchunkがnull、binaryではペイロード長0
+    :param framing:
+    :param battle_id:
+    :return:
+    """
+    if framing == FRAMING_JSON:
+        return (json.dumps([battle_id, None]) + '\n').encode('utf-8')
+    return _header_multiplex.pack(0, battle_id)
+
+
+def read_frame(framing: str, stream: BinaryIO, multiplex: bool) -> Tuple[Optional[int], str]:
+    """
+    ストリームから1つのchunkを読む(ブロックする)
+    :return: バトルID(単一バトルモードではNone)、chunk文字列
+    """
+    if framing == FRAMING_JSON:
+        line = stream.readline()
+        if not line:
+            raise SimProcessError("simulator process exited unexpectedly")
+        if multiplex:
+            battle_id, data = json.loads(line)
+            return battle_id, data
+        return None, json.loads(line)
+    header_struct = _header_multiplex if multiplex else _header_single
+    header = stream.read(header_struct.size)
+    if len(header) < header_struct.size:
+        raise SimProcessError("simulator process exited unexpectedly")
+    if multiplex:
+        length, battle_id = header_struct.unpack(header)
+    else:
+        length, = header_struct.unpack(header)
+        battle_id = None
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise SimProcessError("simulator process exited unexpectedly")
+    return battle_id, payload.decode('utf-8')
+
+
+class FrameDecoder:
+    """
+    多重化モードで、任意の位置で区切られて届くバイト列からchunkを取り出す(selectors等の非ブロッキング読み込み用)
+    """
+
+    def __init__(self, framing: str):
+        assert framing in FRAMINGS
+        self.framing = framing
+        self._buffer = b''
+
+    def feed(self, data: bytes) -> List[Tuple[int, str]]:
+        """
+        受信したバイト列を追加し、完結したchunkを返す
+        :param data:
+        :return: (battle_id, chunk文字列) のリスト
+        """
+        self._buffer += data
+        frames = []
+        if self.framing == FRAMING_JSON:
+            lines = self._buffer.split(b'\n')
+            self._buffer = lines.pop()  # 末尾は改行で終わっていない行(または空)
+            for line in lines:
+                battle_id, chunk = json.loads(line)
+                frames.append((battle_id, chunk))
+            return frames
+        buf = self._buffer
+        pos = 0
+        header_size = _header_multiplex.size
+        while len(buf) - pos >= header_size:
+            length, battle_id = _header_multiplex.unpack_from(buf, pos)
+            if len(buf) - pos - header_size < length:
+                break
+            start = pos + header_size
+            frames.append((battle_id, buf[start:start + length].decode('utf-8')))
+            pos = start + length
+        self._buffer = buf[pos:]
+        return frames
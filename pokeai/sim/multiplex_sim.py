@@ -0,0 +1,23 @@
+"""
+1つのシミュレータプロセスで複数のバトルを並行して行うシミュレータラッパー
+js/simpipe.js の --multiplex モードを利用する
+"""
+from pokeai.sim.framing import FRAMING_JSON
+from pokeai.sim.sim_pool import SimPool
+
+
+class MultiplexSim(SimPool):
+    """
+    複数バトル並行シミュレータ
+    各バトルにIDを割り当て、シミュレータとの入出力をバトルIDで振り分ける
+    1つのバトルでAIが行動を考えている間も、他のバトルはシミュレータ側で進行する
+    シミュレータプロセス1つのSimPoolと等価
+    """
+
+    def __init__(self, max_concurrent: int = 32, framing: str = FRAMING_JSON, split_updates: bool = False):
+        """
+        :param max_concurrent: 同時に進行させるバトル数の上限
+        :param framing: シミュレータとの通信方式 'json' or 'binary'
+        :param split_updates: updateのプレイヤーごとの分割をシミュレータ側で行う
+        """
+        super().__init__(n_procs=1, battles_per_proc=max_concurrent, framing=framing, split_updates=split_updates)
@@ -0,0 +1,78 @@
+"""
+シミュレータのプロトコル文字列(chunk)を、(opcode, 引数)のイベント列に変換する
+opcodeはメッセージの種類(|switch|...のswitch)に対応する整数で、ハンドラの配列のインデックスとして使う
+無視するメッセージは、引数の分割を行う前に読み飛ばす
+空行は読み飛ばし、不正なchunkの調査のためDEBUGログに記録する
+"""
+import json
+import logging
+import sys
+from logging import getLogger
+from typing import Callable, Iterable, List, Tuple
+
+logger = getLogger(__name__)
+
+_IGNORED = -1
+
+
+def _log_empty_line(data: str):
+    if data and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("skipped empty line in chunk " + json.dumps(data))
+
+
+class ProtocolTokenizer:
+    opcodes: List[str]
+
+    def __init__(self, opcodes: Iterable[str], ignored: Iterable[str]):
+        """
+        :param opcodes: 処理するメッセージの種類。リスト中のインデックスがopcodeとなる
+        :param ignored: 読み飛ばすメッセージの種類
+        """
+        self.opcodes = [sys.intern(opcode) for opcode in opcodes]
+        table = {sys.intern(msg): _IGNORED for msg in ignored}
+        for i, opcode in enumerate(self.opcodes):
+            table[opcode] = i
+        self._table = table
+
+    def tokenize(self, data: str) -> List[Tuple[int, List[str]]]:
+        """
+        chunkをイベント列に変換する
+        :param data: "|switch|p1a: Ninetales|Ninetales, L50, M|179/179\\n|turn|1" のような複数行の文字列
+        :return: (opcode, 引数のリスト) のリスト。引数は'|'で区切られた、メッセージの種類より後ろの要素
+        """
+        table_get = self._table.get
+        events = []
+        append = events.append
+        for line in data.split('\n'):
+            if not line:
+                _log_empty_line(data)
+                continue
+            # 行の形式は |msg|arg1|arg2... 引数の分割は処理するメッセージのみ行う
+            parts = line.split('|', 2)
+            opcode = table_get(parts[1])
+            if opcode is None:
+                raise NotImplementedError(f"unknown message {parts[1]} in {data}")
+            if opcode == _IGNORED:
+                # 安全に無視できるメッセージ
+                continue
+            append((opcode, parts[2].split('|') if len(parts) == 3 else []))
+        return events
+
+    def dispatch(self, data: str, handler_list: List[Callable[[List[str]], None]]):
+        """
+        chunkを解析し、イベントごとにopcodeに対応するハンドラを呼び出す
+        tokenizeと同じ処理だが、イベント列を生成しない
+        :param data: chunk
+        :param handler_list: opcodeをインデックスとするハンドラの配列
+        """
+        table_get = self._table.get
+        for line in data.split('\n'):
+            if not line:
+                _log_empty_line(data)
+                continue
+            parts = line.split('|', 2)
+            opcode = table_get(parts[1])
+            if opcode is None:
+                raise NotImplementedError(f"unknown message {parts[1]} in {data}")
+            if opcode != _IGNORED:
+                handler_list[opcode](parts[2].split('|') if len(parts) == 3 else [])
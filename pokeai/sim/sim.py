@@ -5,148 +5,326 @@ import os
 import random
 import subprocess
 import json
+import time
+import logging
 import re
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from logging import getLogger
 
 from pokeai.ai.action_policy import ActionPolicy
 from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.framing import FRAMING_JSON, FRAMINGS, SimProcessError, encode_frame, read_frame, simpipe_args
 from pokeai.sim.party_generator import Party
-from pokeai.sim.simutil import sim_util
+from pokeai.sim.supervisor import SimSupervisor
+from pokeai.sim.team_packer import pack_team_cached
+from pokeai.sim.trace_recorder import BattleTrace, TraceRecorder
 from pokeai.util import ROOT_DIR, side2idx, idx2side
 
 logger = getLogger(__name__)
 
 
-class Sim:
+_split_omniscient_re = re.compile('\n\\|split\\|p[1234]\n([^\n]*)\n(?:[^\n]*)')
+_split_side_res = {side: re.compile('\n\\|split\\|' + side + '\n([^\n]*)\n(?:[^\n]*)') for side in ['p1', 'p2', 'p3', 'p4']}
+_split_others_re = re.compile('\n\\|split\\|(?:[^\n]*)\n(?:[^\n]*)\n\n?')
+
+
+def extract_update_for_side(side: str, chunk_data: str) -> str:
+    # Pokemon-Showdown/sim/battle.ts の移植
+    # シミュレータを--splitモードで起動した場合は、シミュレータ側で分割されるためこの処理は不要
+    if side == 'omniscient':
+        # 全データ取得
+        return _split_omniscient_re.sub('\n\\1', chunk_data)
+    # 各プレイヤーごとの秘密情報を、他のプレイヤー向けには削除する
+    # '|split|p1'の次の行は、p1にのみ送る（他のプレイヤーの場合削除）
+    if side.startswith('p'):
+        chunk_data = _split_side_res[side].sub('\n\\1', chunk_data)
+    return _split_others_re.sub('\n', chunk_data)  # 対象でない秘密データ削除
+
+
+def make_battle_seed(*keys) -> List[int]:
     """
-    シミュレータ
+    シミュレータの乱数シード(16bit整数4つ)を生成する
+    :param keys: 指定した場合、その値から決定的にシードを生成する(実験の基準シード、バトル番号など)。
+    指定しない場合はランダムに生成する。
+    :return:
     """
-    parties: List[Party]
-    processors: List[BattleStreamProcessor]
-    policies: List[ActionPolicy]
-    proc: subprocess.Popen
-    n_battle: int
-
-    def __init__(self):
-        self.n_battle = 0
-        self.proc = None
-        self.parties = None
-        self.processors = None
+    rng = random.Random(json.dumps(keys)) if len(keys) > 0 else random
+    return [rng.randrange(0x10000) for _ in range(4)]
 
-    def set_party(self, parites: List[Party]):
-        self.parties = parites
 
-    def set_processor(self, processors: List[BattleStreamProcessor]):
-        self.processors = processors
+def make_party_spec(name: str, party: Party) -> dict:
+    # シミュレータのpackTeamと同じ変換をPython側で行い、キャッシュする
+    return {'name': name, 'team': pack_team_cached(party)}
 
-    def _writeChunk(self, commands: List[str]):
-        logger.debug("writeChunk " + json.dumps('\n'.join(commands)))
-        self.proc.stdin.write(json.dumps('\n'.join(commands)) + '\n')
-        self.proc.stdin.flush()
 
-    def _readChunk(self) -> List[str]:
-        line = self.proc.stdout.readline() # 末尾に改行コードが入る
-        logger.debug("readChunk " + line.rstrip())
-        rawstr = json.loads(line)
-        return rawstr.split('\n', 1)  # 最初の1要素(update, endなど)のみ分離
+class BattleSession:
+    """
+    1回のバトルの進行状態
+    シミュレータからのchunkを各プレイヤーのプロセッサに振り分け、シミュレータに送るべきchunkを返す
+    シミュレータとの入出力は行わないため、1プロセスで1バトルの場合も複数バトルを並行する場合も共通で使える
+    """
+    parties: List[Party]
+    processors: List[BattleStreamProcessor]
+    seed: Optional[List[int]]
+    trace: Optional[BattleTrace]
+    sent_forcetie: bool
 
-    def run(self):
+    def __init__(self, parties: List[Party], processors: List[BattleStreamProcessor],
+                 seed: Optional[List[int]] = None, trace: Optional[BattleTrace] = None):
         """
-        バトルを１回行う
-        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, ...}
+        :param parties:
+        :param processors:
+        :param seed: シミュレータの乱数シード(16bit整数4つ)。Noneならシミュレータ側で決める
+        :param trace: バトルの経過の記録先。Noneなら記録しない
         """
-        # シミュレータプログラムの実行。長く運用するとクラッシュすることがあるので定期的に再起動
-        if self.n_battle >= 1000:
-            self.proc.stdin.close()
-            self.proc.terminate()
-            self.proc = None
-            self.n_battle = 0
-        if self.proc is None:
-            self.proc = subprocess.Popen(['node', 'js/simpipe'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                         encoding='utf-8', cwd=str(ROOT_DIR))
-        self.n_battle += 1
+        self.parties = parties
+        self.processors = processors
+        self.seed = seed
+        self.trace = trace
+        self.sent_forcetie = False
 
+    def start(self) -> List[List[str]]:
+        """
+        バトルの状態を初期化し、バトル開始のために送るchunkを返す
+        :return: シミュレータに送るchunkのリスト
+        """
+        if self.parties is None:
+            raise Exception('parties not set')
         for i in [0, 1]:
             self.processors[i].start_battle(idx2side(i), self.parties[i])
+            if self.seed is not None:
+                self.processors[i].policy.set_battle_seed(self.seed, idx2side(i))
+            self.processors[i].set_trace(self.trace)
+        spec = {'formatid': 'gen2customgame'}
+        if self.seed is not None:
+            spec['seed'] = self.seed
+        return [[
+            f'>start {json.dumps(spec)}',
+            f'>player p1 {json.dumps(make_party_spec("p1", self.parties[0]))}',
+            f'>player p2 {json.dumps(make_party_spec("p2", self.parties[1]))}',
+        ]]
 
-        self._writeStart()
-        sent_forcetie = False
-        while True:
-            chunk_type, chunk_data = self._readChunk()
-            battle_result = None
-            if chunk_data.find('|turn|100') >= 0 and not sent_forcetie:
-                # 長すぎるバトルをカット
-                logger.warning(f"battle reached to 100 turns, exiting as tie")
-                self._writeChunk([
-                    f'>forcetie'
-                ])
-                sent_forcetie = True
-                # この後はendメッセージを待つだけ。エージェントにchoiceを送らせてはいけない
-                # (|error|[Invalid choice] Can't do anything: The game is over)というエラーになる
-                continue
-            try:
-                battle_result = self._processChunk(chunk_type, chunk_data, sent_forcetie)
-            except Exception as ex:
-                raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
-            if battle_result is not None:
-                # FIXME: ここで呼ぶべきか、processorにメソッドを設けるべきか
-                winner = battle_result['winner']  # 'p1', 'p2', '' (forcetieで引き分けの時)
-                reward_p1 = {'p1': 1.0, 'p2': -1.0, '': 0.0}[winner]
-                for side, sign in [('p1', 1.0), ('p2', -1.0)]:
-                    self.processors[side2idx(side)].policy.game_end(reward=reward_p1 * sign)
+    def process_chunk(self, chunk_type: str, chunk_data: str) -> Tuple[List[List[str]], Optional[dict]]:
+        """
+        シミュレータから受け取ったchunkを処理する
+        :param chunk_type: update, playerupdate, sideupdate, end
+        :param chunk_data:
+        :return: シミュレータに送るchunkのリスト、バトル終了の場合はendメッセージの内容 {'winner': 'p1', 'turns': 34, ...}
+        """
+        if self._check_forcetie(chunk_data):
+            return [[f'>forcetie']], None
+        write_chunks = []
+        try:
+            deliveries, battle_result = self._routeChunk(chunk_type, chunk_data)
+            for side, side_chunk_type, side_data in deliveries:
+                choice = self.processors[side2idx(side)].process_chunk(side_chunk_type, side_data)
+                if choice is not None:
+                    write_chunks.append([f'>{side} {choice}'])
+        except Exception as ex:
+            raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
+        self._finish(battle_result)
+        return write_chunks, battle_result
 
-                return battle_result
+    async def process_chunk_async(self, chunk_type: str, chunk_data: str) -> Tuple[List[List[str]], Optional[dict]]:
+        """
+        process_chunkの非同期版。方策の行動選択をawaitする
+        :param chunk_type: update, playerupdate, sideupdate, end
+        :param chunk_data:
+        :return: シミュレータに送るchunkのリスト、バトル終了の場合はendメッセージの内容
+        """
+        if self._check_forcetie(chunk_data):
+            return [[f'>forcetie']], None
+        write_chunks = []
+        try:
+            deliveries, battle_result = self._routeChunk(chunk_type, chunk_data)
+            for side, side_chunk_type, side_data in deliveries:
+                choice = await self.processors[side2idx(side)].process_chunk_async(side_chunk_type, side_data)
+                if choice is not None:
+                    write_chunks.append([f'>{side} {choice}'])
+        except Exception as ex:
+            raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
+        self._finish(battle_result)
+        return write_chunks, battle_result
+
+    def _check_forcetie(self, chunk_data: str) -> bool:
+        """
+        長すぎるバトルをカットする必要があるか判定する
+        :param chunk_data:
+        :return: forcetieを送るべき場合True
+        """
+        if chunk_data.find('|turn|100') >= 0 and not self.sent_forcetie:
+            logger.warning(f"battle reached to 100 turns, exiting as tie")
+            self.sent_forcetie = True
+            # この後はendメッセージを待つだけ。エージェントにchoiceを送らせてはいけない
+            # (|error|[Invalid choice] Can't do anything: The game is over)というエラーになる
+            return True
+        return False
 
-    def _extractUpdateForSide(self, side: str, chunk_data: str):
-        # Pokemon-Showdown/sim/battle.ts の移植
-        if side == 'omniscient':
-            # 全データ取得
-            return re.sub('\n\\|split\\|p[1234]\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-        # 各プレイヤーごとの秘密情報を、他のプレイヤー向けには削除する
-        # '|split|p1'の次の行は、p1にのみ送る（他のプレイヤーの場合削除）
-        if side.startswith('p'):
-            chunk_data = re.sub('\n\\|split\\|' + side + '\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-        return re.sub('\n\\|split\\|(?:[^\n]*)\n(?:[^\n]*)\n\n?', '\n', chunk_data)  # 対象でない秘密データ削除
+    def _finish(self, battle_result: Optional[dict]):
+        if battle_result is not None:
+            # FIXME: ここで呼ぶべきか、processorにメソッドを設けるべきか
+            winner = battle_result['winner']  # 'p1', 'p2', '' (forcetieで引き分けの時)
+            reward_p1 = {'p1': 1.0, 'p2': -1.0, '': 0.0}[winner]
+            for side, sign in [('p1', 1.0), ('p2', -1.0)]:
+                self.processors[side2idx(side)].policy.game_end(reward=reward_p1 * sign)
 
-    def _processChunk(self, chunk_type: str, chunk_data: str, sent_forcetie: bool) -> Optional[object]:
+    def _routeChunk(self, chunk_type: str, chunk_data: str) -> Tuple[List[Tuple[str, str, str]], Optional[dict]]:
         """
         chunkの種類ごとに適切なプロセッサに振り分ける。バトル終了の場合はendメッセージの内容を返す
         :param chunk_type:
         :param chunk_data:
-        :return:
+        :return: プロセッサに渡す(side, chunk_type, data)のリスト、endメッセージの内容
         """
         # 振り分けについては
         # battle-stream.ts を参考にする
         if chunk_type == 'end':
             # バトル終了
-            return json.loads(chunk_data)  # バトルの結果を返す
-        if sent_forcetie:
+            battle_result = json.loads(chunk_data)
+            if self.seed is not None:
+                battle_result.setdefault('seed', self.seed)  # 再現のため、指定したシードを結果に記録する
+            return [], battle_result  # バトルの結果を返す
+        if self.sent_forcetie:
             # forcetieを送った後は、endメッセージ以外無視
-            return None
+            return [], None
         if chunk_type == 'sideupdate':
             side, side_data = chunk_data.split('\n')
-            choice = self.processors[side2idx(side)].process_chunk(chunk_type, side_data)
-            if choice is not None:
-                self._writeChunk([f'>{side} {choice}'])
+            return [(side, chunk_type, side_data)], None
+        elif chunk_type == 'playerupdate':
+            # シミュレータ側でプレイヤーごとに分割済みのupdate
+            side, side_data = chunk_data.split('\n', 1)
+            if side == 'omniscient':
+                return [], None
+            return [(side, 'update', side_data)], None
         elif chunk_type == 'update':
-            for side in ['p1', 'p2']:
-                choice = self.processors[side2idx(side)].process_chunk(chunk_type,
-                                                                       self._extractUpdateForSide(side, chunk_data))
-                if choice is not None:
-                    self._writeChunk([f'>{side} {choice}'])
+            return [(side, chunk_type, extract_update_for_side(side, chunk_data)) for side in ['p1', 'p2']], None
         else:
             raise NotImplementedError(f"Unknown chunk type {chunk_type}")
 
-    def _makePartySpec(self, name, party):
-        return {'name': name, 'team': sim_util.call('packTeam', {'party': party})}
 
-    def _writeStart(self):
-        if self.parties is None:
-            raise Exception('parties not set')
-        spec = {'formatid': 'gen2customgame'}
-        self._writeChunk([
-            f'>start {json.dumps(spec)}',
-            f'>player p1 {json.dumps(self._makePartySpec("p1", self.parties[0]))}',
-            f'>player p2 {json.dumps(self._makePartySpec("p2", self.parties[1]))}',
-        ])
+class Sim:
+    """
+    シミュレータ
+    """
+    parties: List[Party]
+    processors: List[BattleStreamProcessor]
+    policies: List[ActionPolicy]
+    proc: subprocess.Popen
+    framing: str
+    split_updates: bool
+    supervisor: SimSupervisor
+    trace_recorder: Optional[TraceRecorder]
+
+    def __init__(self, framing: str = FRAMING_JSON, split_updates: bool = False,
+                 supervisor: Optional[SimSupervisor] = None):
+        """
+        :param framing: シミュレータとの通信方式 'json'(jsonを1行で送受信) or 'binary'(長さを前置したフレームで送受信)
+        :param split_updates: updateのプレイヤーごとの分割をシミュレータ側で行う。
+        有効にするとDEBUGログのreadChunkがプレイヤーごとのplayerupdateのみとなり、format_battle_logで解析できない
+        :param supervisor: シミュレータプロセスの再起動条件。Noneならデフォルトのしきい値
+        """
+        assert framing in FRAMINGS
+        self.framing = framing
+        self.split_updates = split_updates
+        self.supervisor = supervisor or SimSupervisor()
+        self.proc = None
+        self.parties = None
+        self.processors = None
+        self.trace_recorder = None
+
+    def set_party(self, parites: List[Party]):
+        self.parties = parites
+
+    def set_processor(self, processors: List[BattleStreamProcessor]):
+        self.processors = processors
+
+    def set_trace_recorder(self, trace_recorder: Optional[TraceRecorder]):
+        """
+        バトルの経過を記録する。記録するバトルはtrace_recorderのサンプリング設定に従う
+        :param trace_recorder: Noneなら記録しない
+        """
+        self.trace_recorder = trace_recorder
+
+    def _writeChunk(self, commands: List[str]):
+        data = '\n'.join(commands)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("writeChunk " + json.dumps(data))
+        self.proc.stdin.write(encode_frame(self.framing, data))
+        self.proc.stdin.flush()
+
+    def _readChunk(self) -> List[str]:
+        start = time.perf_counter()
+        _, rawstr = read_frame(self.framing, self.proc.stdout, multiplex=False)
+        self.supervisor.observe_latency(time.perf_counter() - start)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("readChunk " + json.dumps(rawstr))
+        return rawstr.split('\n', 1)  # 最初の1要素(update, endなど)のみ分離
+
+    def _start_proc(self):
+        self.proc = subprocess.Popen(simpipe_args(False, self.framing, self.split_updates), stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, cwd=str(ROOT_DIR))
+        self.supervisor.process_started()
+
+    def _stop_proc(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.terminate()
+        self.proc.wait()
+        self.proc = None
+
+    def close(self):
+        """
+        シミュレータプロセスを終了する
+        """
+        if self.proc is not None:
+            self._stop_proc()
+
+    def run(self, seed: Optional[List[int]] = None, agent_infos: Optional[List[dict]] = None):
+        """
+        バトルを１回行う
+        シミュレータプロセスが途中で異常終了した場合、プロセスを再起動して同じパーティ・乱数シードでバトルをやり直す
+        :param seed: 乱数シード(16bit整数4つ、make_battle_seedで生成)。Noneならランダムに生成する
+        :param agent_infos: トレースに記録する各プレイヤーの情報({"player_id": ...}など)
+        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, 'seed': [...], ...}
+        """
+        # 長く運用するとメモリ使用量の増大や応答の遅延が起こることがあるので、しきい値を超えたら再起動
+        if self.proc is not None:
+            recycle_reason = self.supervisor.recycle_reason(self.proc.pid)
+            if recycle_reason is not None:
+                logger.info(f"restarting simulator: {recycle_reason}")
+                self.supervisor.n_restarts += 1
+                self._stop_proc()
+        if seed is None:
+            seed = make_battle_seed()
+        retry = 0
+        while True:
+            if self.proc is None:
+                self._start_proc()
+            try:
+                return self._run_session(seed, agent_infos)
+            except (SimProcessError, BrokenPipeError) as ex:
+                if retry >= self.supervisor.max_retries:
+                    raise
+                retry += 1
+                self.supervisor.n_retries += 1
+                logger.warning(f"simulator process died during battle, retrying ({retry}): {ex}")
+                self._stop_proc()
+
+    def _run_session(self, seed: List[int], agent_infos: Optional[List[dict]]) -> dict:
+        self.supervisor.n_battles += 1
+        trace = None
+        if self.trace_recorder is not None:
+            trace = self.trace_recorder.start_battle(self.parties, agent_infos)
+        session = BattleSession(self.parties, self.processors, seed, trace)
+        for commands in session.start():
+            self._writeChunk(commands)
+        while True:
+            chunk_type, chunk_data = self._readChunk()
+            write_chunks, battle_result = session.process_chunk(chunk_type, chunk_data)
+            for commands in write_chunks:
+                self._writeChunk(commands)
+            if battle_result is not None:
+                if trace is not None:
+                    self.trace_recorder.finish_battle(trace, battle_result)
+                return battle_result
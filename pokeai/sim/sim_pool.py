@@ -0,0 +1,207 @@
+"""
+複数のシミュレータプロセスを1つのPythonプロセスから駆動するシミュレータプール
+各プロセスは js/simpipe.js の --multiplex モードで起動し、複数のバトルを並行して扱う
+プロセスの標準出力はselectorsで多重化して読む
+"""
+import itertools
+import json
+import logging
+import os
+import selectors
+import subprocess
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from logging import getLogger
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.framing import FRAMING_JSON, FrameDecoder, SimProcessError, encode_discard_frame, encode_frame, \
+    simpipe_args
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import BattleSession
+from pokeai.util import ROOT_DIR
+
+logger = getLogger(__name__)
+
+
+class SimProcess:
+    """
+    --multiplexモードのシミュレータプロセス1つと、そこで進行中のバトル
+    """
+    proc: subprocess.Popen
+    sessions: Dict[int, BattleSession]
+    failed: bool  # プロセスとの通信に失敗した(再起動が必要)
+
+    def __init__(self, framing: str = FRAMING_JSON, split_updates: bool = False):
+        # selectorsで読み込み可能になった分だけ読むため、バイナリモードかつバッファなしで開く
+        self.proc = subprocess.Popen(simpipe_args(True, framing, split_updates), stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, bufsize=0, cwd=str(ROOT_DIR))
+        self.framing = framing
+        self.split_updates = split_updates
+        self.sessions = {}
+        self.failed = False
+        self._decoder = FrameDecoder(framing)
+
+    def fileno(self) -> int:
+        return self.proc.stdout.fileno()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.terminate()
+        self.proc.wait()
+
+    def write_chunk(self, battle_id: int, commands: List[str]):
+        data = '\n'.join(commands)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("writeChunk " + json.dumps([battle_id, data]))
+        self._write(encode_frame(self.framing, data, battle_id))
+
+    def discard_sessions(self):
+        """
+        進行中のバトルをすべてシミュレータ側で破棄する
+        """
+        for battle_id in list(self.sessions.keys()):
+            del self.sessions[battle_id]
+            if not self.failed:
+                try:
+                    self._write(encode_discard_frame(self.framing, battle_id))
+                except BrokenPipeError:
+                    pass
+
+    def _write(self, data: bytes):
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            self.failed = True
+            raise
+
+    def read_chunks(self) -> List[Tuple[int, List[str]]]:
+        """
+        読み込み可能な分を読み、完結したchunkを返す(ブロックしない前提で呼ぶ)
+        :return: (battle_id, [chunkの種類, chunkの内容]) のリスト
+        """
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            self.failed = True
+            raise SimProcessError("simulator process exited unexpectedly")
+        chunks = []
+        for battle_id, rawstr in self._decoder.feed(data):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("readChunk " + json.dumps([battle_id, rawstr]))
+            chunks.append((battle_id, rawstr.split('\n', 1)))  # 最初の1要素(update, endなど)のみ分離
+        return chunks
+
+
+class SimPool:
+    """
+    シミュレータプール
+    n_procs個のシミュレータプロセスにそれぞれ最大battles_per_proc個のバトルを割り当て、並行して進行させる
+    """
+    n_procs: int
+    battles_per_proc: int
+    procs: List[SimProcess]
+    framing: str
+    split_updates: bool
+
+    def __init__(self, n_procs: int, battles_per_proc: int = 16, framing: str = FRAMING_JSON,
+                 split_updates: bool = False):
+        """
+        :param n_procs: シミュレータプロセス数
+        :param battles_per_proc: 1プロセスで同時に進行させるバトル数の上限
+        :param framing: シミュレータとの通信方式 'json' or 'binary'
+        :param split_updates: updateのプレイヤーごとの分割をシミュレータ側で行う
+        """
+        self.n_procs = n_procs
+        self.framing = framing
+        self.split_updates = split_updates
+        self.battles_per_proc = battles_per_proc
+        self.procs = []
+        self._next_battle_id = 0
+
+    def _start_procs(self):
+        self.procs = [SimProcess(self.framing, self.split_updates) for _ in range(self.n_procs)]
+
+    def close(self):
+        for sim_proc in self.procs:
+            sim_proc.close()
+        self.procs = []
+
+    def _cleanup(self):
+        """
+        run_manyの終了時に呼ぶ。例外や呼び出し元の中断で残ったバトルを破棄し、通信に失敗したプロセスを再起動する
+        """
+        for i, sim_proc in enumerate(self.procs):
+            sim_proc.discard_sessions()
+            if sim_proc.failed or sim_proc.proc.poll() is not None:
+                logger.warning("restarting simulator process")
+                sim_proc.close()
+                self.procs[i] = SimProcess(self.framing, self.split_updates)
+
+    def _start_battle(self, sim_proc: SimProcess, parties: List[Party], policies: List[ActionPolicy],
+                      seed: Optional[List[int]]) -> int:
+        processors = []
+        for policy in policies:
+            processor = BattleStreamProcessor()
+            processor.set_policy(policy)
+            processors.append(processor)
+        battle_id = self._next_battle_id
+        self._next_battle_id += 1
+        session = BattleSession(parties, processors, seed)
+        sim_proc.sessions[battle_id] = session
+        for commands in session.start():
+            sim_proc.write_chunk(battle_id, commands)
+        return battle_id
+
+    def run_many(self, matchups: Iterable[List[Party]], policies: Iterable[List[ActionPolicy]],
+                 seeds: Optional[Iterable[Optional[List[int]]]] = None) -> Iterator[Tuple[int, dict]]:
+        """
+        複数のバトルを並行して行い、終了したものから結果を返す
+        状態を持つ方策（学習用エージェントなど）のインスタンスを、同時に進行する複数のバトルで共有してはならない
+        :param matchups: 各バトルのパーティ [p1のパーティ, p2のパーティ] の列
+        :param policies: 各バトルの方策 [p1の方策, p2の方策] の列。matchupsと同じ長さ
+        :param seeds: 各バトルの乱数シードの列。Noneならシミュレータ側で決める
+        :return: (matchupsにおけるインデックス, endメッセージの内容) をバトル終了順に返すイテレータ
+        """
+        if len(self.procs) == 0:
+            self._start_procs()
+        if seeds is None:
+            seeds = itertools.repeat(None)
+        pending = enumerate(zip(matchups, policies, seeds))
+        battle_idxs = {}  # battle_id => matchupsにおけるインデックス
+        exhausted = False
+        try:
+            with selectors.DefaultSelector() as selector:
+                for sim_proc in self.procs:
+                    selector.register(sim_proc, selectors.EVENT_READ)
+                while True:
+                    while not exhausted:
+                        # 進行中のバトルが最も少ないプロセスに割り当てる
+                        sim_proc = min(self.procs, key=lambda p: len(p.sessions))
+                        if len(sim_proc.sessions) >= self.battles_per_proc:
+                            break
+                        try:
+                            matchup_idx, (parties, battle_policies, seed) = next(pending)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        battle_idxs[self._start_battle(sim_proc, parties, battle_policies, seed)] = matchup_idx
+                    if len(battle_idxs) == 0:
+                        break
+                    for key, _ in selector.select():
+                        sim_proc = key.fileobj  # type: SimProcess
+                        for battle_id, (chunk_type, chunk_data) in sim_proc.read_chunks():
+                            session = sim_proc.sessions.get(battle_id)
+                            if session is None:
+                                # 以前のrun_manyで破棄したバトルの、破棄が届く前に出力されたchunk
+                                continue
+                            write_chunks, battle_result = session.process_chunk(chunk_type, chunk_data)
+                            for commands in write_chunks:
+                                sim_proc.write_chunk(battle_id, commands)
+                            if battle_result is not None:
+                                del sim_proc.sessions[battle_id]
+                                yield battle_idxs.pop(battle_id), battle_result
+        finally:
+            # 例外・呼び出し元の中断(GeneratorExit)で残ったバトルを破棄する
+            self._cleanup()
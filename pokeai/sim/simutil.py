@@ -1,5 +1,6 @@
 import subprocess
 import json
+from pokeai.sim.framing import FRAMING_BINARY, FRAMING_JSON, FRAMINGS, encode_frame, read_frame
 from pokeai.util import ROOT_DIR
 
 
@@ -13,14 +14,28 @@ class SimUtil:
     シミュレータの付属機能呼び出し
     """
 
-    def __init__(self):
-        self.proc = subprocess.Popen(['node', 'js/simutil'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                     encoding='utf-8', cwd=str(ROOT_DIR))
+    def __init__(self, framing: str = FRAMING_JSON):
+        """
+        :param framing: 通信方式 'json'(jsonを1行で送受信) or 'binary'(長さを前置したフレームで送受信)
+        """
+        assert framing in FRAMINGS
+        self.framing = framing
+        args = ['node', 'js/simutil']
+        if framing == FRAMING_BINARY:
+            args.append('--binary')
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=str(ROOT_DIR))
 
     def call(self, method: str, params):
-        self.proc.stdin.write(json.dumps({'method': method, 'params': params}) + '\n')
-        self.proc.stdin.flush()
-        result = json.loads(self.proc.stdout.readline())
+        request = json.dumps({'method': method, 'params': params})
+        if self.framing == FRAMING_BINARY:
+            self.proc.stdin.write(encode_frame(FRAMING_BINARY, request))
+            self.proc.stdin.flush()
+            _, response = read_frame(FRAMING_BINARY, self.proc.stdout, multiplex=False)
+        else:
+            self.proc.stdin.write((request + '\n').encode('utf-8'))
+            self.proc.stdin.flush()
+            response = self.proc.stdout.readline()
+        result = json.loads(response)
         if result['error'] is not None:
             raise SimUtilError(result['error'])
         return result['result']
@@ -0,0 +1,87 @@
+"""
+シミュレータプロセスの健全性の監視
+メモリ使用量(RSS)とchunkの応答時間がしきい値を超えた場合のみプロセスの再起動を要求する
+"""
+from typing import Optional
+
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    """
+    プロセスの常駐メモリ量(MB)を取得する
+    /proc が使えない環境ではNone
+    :param pid:
+    :return:
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    # VmRSS:    123456 kB
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class SimSupervisor:
+    """
+    シミュレータプロセスの監視
+    バトルの合間にrecycle_reasonを呼び、Noneでなければプロセスを再起動する
+    """
+    max_rss_mb: float
+    max_chunk_latency: float
+    max_retries: int
+    n_restarts: int  # しきい値超過による再起動の回数
+    n_retries: int  # プロセスの異常終了によりバトルをやり直した回数
+    n_battles: int  # 現在のプロセスで行ったバトル数
+    max_latency: float  # 現在のプロセスで観測したchunk応答時間の最大値
+    _first_chunk: bool  # プロセスの起動後、まだchunkを受け取っていない
+
+    def __init__(self, max_rss_mb: float = 1024.0, max_chunk_latency: float = 5.0, max_retries: int = 3):
+        """
+        :param max_rss_mb: シミュレータプロセスのメモリ使用量の上限(MB)
+        :param max_chunk_latency: chunk1つを受け取るまでの待ち時間の上限(秒)
+        :param max_retries: プロセスの異常終了時に、同じバトルをやり直す回数の上限
+        """
+        self.max_rss_mb = max_rss_mb
+        self.max_chunk_latency = max_chunk_latency
+        self.max_retries = max_retries
+        self.n_restarts = 0
+        self.n_retries = 0
+        self.process_started()
+
+    def process_started(self):
+        """
+        プロセスの起動(再起動)時に呼ぶ
+        """
+        self.n_battles = 0
+        self.max_latency = 0.0
+        self._first_chunk = True
+
+    def observe_latency(self, latency: float):
+        """
+        chunk1つを受け取るまでの待ち時間を記録する
+        起動後最初のchunkの待ち時間はnodeの起動時間を含むため、記録しない
+        :param latency: 秒
+        """
+        if self._first_chunk:
+            self._first_chunk = False
+            return
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    def recycle_reason(self, pid: int) -> Optional[str]:
+        """
+        プロセスを再起動すべきか判定する
+        :param pid: シミュレータのプロセスID
+        :return: 再起動すべき場合その理由、そうでなければNone
+        """
+        if self.max_latency > self.max_chunk_latency:
+            return f"chunk latency {self.max_latency:.2f}s exceeded {self.max_chunk_latency}s"
+        rss = read_rss_mb(pid)
+        if rss is not None and rss > self.max_rss_mb:
+            return f"RSS {rss:.0f}MB exceeded {self.max_rss_mb}MB"
+        return None
+
+    def stats(self) -> dict:
+        return {'restarts': self.n_restarts, 'retries': self.n_retries, 'battles_on_process': self.n_battles}
@@ -0,0 +1,110 @@
+"""
+パーティをシミュレータに渡す文字列形式(packed team)に変換する
+Pokemon-Showdown/sim/teams.ts の Teams.pack の移植(第2世代のPartyPokeに含まれる項目のみ)
+シミュレータの付属機能(js/simutil.js)を呼び出すプロセス間通信が不要
+"""
+import json
+import re
+from functools import lru_cache
+from typing import Optional
+
+from pokeai.sim.party_generator import Party, PartyPoke, PokeEvIv
+
+_pack_name_re = re.compile('[^A-Za-z0-9]+')
+_stat_names = ['hp', 'atk', 'def', 'spa', 'spd', 'spe']
+
+
+def _pack_name(name: Optional[str]) -> str:
+    if not name:
+        return ''
+    return _pack_name_re.sub('', name)
+
+
+def _pack_evs(evs: Optional[PokeEvIv]) -> str:
+    if not evs:
+        return ''
+    # 0は空欄
+    return ','.join(str(evs[s]) if evs.get(s) else '' for s in _stat_names)
+
+
+def _pack_ivs(ivs: Optional[PokeEvIv]) -> str:
+    if not ivs:
+        return ''
+    # 31(最大値)は空欄
+    return ','.join('' if ivs.get(s) is None or ivs[s] == 31 else str(ivs[s]) for s in _stat_names)
+
+
+def _pack_poke(poke: PartyPoke) -> str:
+    name = poke.get('name') or poke['species']
+    species_id = _pack_name(poke.get('species') or poke.get('name'))
+    evs = _pack_evs(poke.get('evs'))
+    ivs = _pack_ivs(poke.get('ivs'))
+    level = poke.get('level')
+    happiness = poke.get('happiness')
+    fields = [
+        name,
+        '' if _pack_name(name) == species_id else species_id,
+        _pack_name(poke.get('item')),
+        _pack_name(poke.get('ability')),
+        ','.join(_pack_name(move) for move in poke['moves']),
+        poke.get('nature') or '',
+        '' if evs == ',,,,,' else evs,
+        poke.get('gender') or '',
+        '' if ivs == ',,,,,' else ivs,
+        'S' if poke.get('shiny') else '',
+        str(level) if level and level != 100 else '',
+        str(happiness) if happiness is not None and happiness != 255 else '',
+    ]
+    return '|'.join(fields)
+
+
+def pack_team(party: Party) -> str:
+    """
+    パーティをpacked team形式の文字列に変換する
+    sim_util.call('packTeam', {'party': party}) と同じ結果を返す
+    :param party:
+    :return:
+    """
+    return ']'.join(_pack_poke(poke) for poke in party)
+
+
+@lru_cache(maxsize=65536)
+def _pack_team_by_key(party_key: str) -> str:
+    return pack_team(json.loads(party_key))
+
+
+def pack_team_cached(party: Party) -> str:
+    """
+    pack_teamの結果をキャッシュする版
+    同じパーティが何度も対戦する学習・レーティングバトルで、変換処理を省略する
+    キーはパーティの内容を正規化したjson文字列のため、同じ内容であれば別のオブジェクトでもキャッシュが使われる
+    :param party:
+    :return:
+    """
+    return _pack_team_by_key(json.dumps(party, sort_keys=True))
+
+
+def verify(n: int = 1000):
+    # ランダムなパーティについて、シミュレータの変換結果と一致するか確認
+    from pokeai.sim.random_party_generator import RandomPartyGenerator
+    from pokeai.sim.simutil import sim_util
+    gen = RandomPartyGenerator()
+    n_mismatch = 0
+    for i in range(n):
+        party = gen.generate()
+        if i % 2 == 1:
+            # ニックネーム・努力値0・個体値最大など、空欄になる項目を含める
+            party[0] = {**party[0], 'name': 'Nick-name ' + str(i), 'level': 100, 'shiny': True, 'gender': '',
+                        'evs': {**party[0]['evs'], 'atk': 0}, 'ivs': {**party[0]['ivs'], 'spe': 31}}
+        expected = sim_util.call('packTeam', {'party': party})
+        actual = pack_team(party)
+        if expected != actual:
+            n_mismatch += 1
+            print("mismatch", party)
+            print("expected", expected)
+            print("actual  ", actual)
+    print(f"{n_mismatch} / {n} mismatch")
+
+
+if __name__ == '__main__':
+    verify()
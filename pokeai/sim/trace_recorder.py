@@ -0,0 +1,138 @@
+"""
+バトルの経過(トレース)の記録
+DEBUGログを解析する代わりに、Sim・RLPolicy・Agentが直接記録する
+1バトルを1レコードとし、[圧縮後の長さ uint32 big endian][zlib圧縮したjson] の形式でファイルに追記する
+
+レコードの形式(pokeai.ai.analysis.format_battle_log --trace で、DEBUGログから抽出した場合と同じ形式に変換できる)
+{"agents": {"p1": {"party": [...], ...}, "p2": {...}},
+ "events": [{"type": "update", "side": "p1", "update": ["|", "|move|p1a: Zapdos|Thunderbolt|p2a: Flareon", ...]},
+            {"type": "choice", "choice": {"player": "p1", "possible_actions": [...], "q_func": {...},
+                                          "battle_status_delta": [...], "request": {...}, "choice": "move 1"}},
+            ...],
+ "end": {"winner": "p1", "turns": 34, ...}}
+possible_actions, q_funcはRLPolicyの場合のみ記録される
+battle_status_deltaは、同じプレイヤーの前回の行動選択時のBattleStatus.json_objからの差分(make_json_delta)
+"""
+import json
+import struct
+import zlib
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+from pokeai.ai.battle_status import BattleStatus, make_json_delta
+from pokeai.sim.party_generator import Party
+
+_header = struct.Struct('>I')
+
+
+class BattleTrace:
+    """
+    1バトル分のトレース
+    """
+    record: dict
+
+    def __init__(self, agents: dict):
+        self.record = {"agents": agents, "events": [], "end": None}
+        self._pending_choices = {}  # type: Dict[str, dict]
+        self._last_battle_status = {}  # type: Dict[str, dict]  # プレイヤーごとの前回の行動選択時の状態
+
+    def add_update(self, side: str, data: str):
+        """
+        プレイヤーに届いたupdateを記録する
+        """
+        self.record["events"].append({"type": "update", "side": side, "update": data.split('\n')})
+
+    def pending_choice(self, side: str) -> dict:
+        """
+        記録中の行動選択の情報。方策・エージェントが選択肢やq値を書き込む
+        :param side: 行動選択するプレイヤー
+        :return:
+        """
+        choice_info = self._pending_choices.get(side)
+        if choice_info is None:
+            choice_info = {"player": side}
+            self._pending_choices[side] = choice_info
+        return choice_info
+
+    def add_choice(self, side: str, battle_status: BattleStatus, request: dict, choice: str):
+        """
+        行動選択の記録を確定する
+        :param side: 行動選択したプレイヤー
+        :param battle_status: 行動選択時の状態。前回からの差分を記録する
+        :param request:
+        :param choice: シミュレータに送った行動
+        """
+        choice_info = self._pending_choices.pop(side, None) or {"player": side}
+        battle_status_obj = battle_status.json_obj()
+        choice_info["battle_status_delta"] = make_json_delta(self._last_battle_status.get(side, {}), battle_status_obj)
+        self._last_battle_status[side] = battle_status_obj
+        choice_info["request"] = request
+        choice_info["choice"] = choice
+        self.record["events"].append({"type": "choice", "choice": choice_info})
+
+
+class TraceRecorder:
+    """
+    トレースをファイルに書き込む
+    sample_everyバトルに1回だけ記録することで、常時有効にしても負荷を小さくできる
+    """
+    sample_every: int
+    n_battles: int  # start_battleが呼ばれた回数
+    n_recorded: int  # 記録したバトル数
+
+    def __init__(self, path: str, sample_every: int = 1):
+        """
+        :param path: 出力先。既存のファイルには追記する
+        :param sample_every: Nバトルに1回記録する
+        """
+        assert sample_every >= 1
+        self.sample_every = sample_every
+        self.n_battles = 0
+        self.n_recorded = 0
+        self._file = open(path, 'ab')  # type: BinaryIO
+
+    def close(self):
+        self._file.close()
+
+    def start_battle(self, parties: List[Party], agent_infos: Optional[List[dict]] = None) -> Optional[BattleTrace]:
+        """
+        バトルの開始時に呼ぶ
+        :param parties: [p1のパーティ, p2のパーティ]
+        :param agent_infos: 各プレイヤーについてagentsに追加で記録する情報({"player_id": ...}など)
+        :return: このバトルを記録する場合はトレース、記録しない場合はNone
+        """
+        sampled = self.n_battles % self.sample_every == 0
+        self.n_battles += 1
+        if not sampled:
+            return None
+        agents = {}
+        for i, side in enumerate(['p1', 'p2']):
+            agent = {"party": parties[i]}
+            if agent_infos is not None:
+                agent.update(agent_infos[i])
+            agents[side] = agent
+        return BattleTrace(agents)
+
+    def finish_battle(self, trace: BattleTrace, battle_result: dict):
+        """
+        バトルの終了時に呼び、レコードを書き込む
+        :param trace: start_battleが返したトレース
+        :param battle_result: endメッセージの内容
+        """
+        trace.record["end"] = battle_result
+        payload = zlib.compress(json.dumps(trace.record).encode('utf-8'))
+        self._file.write(_header.pack(len(payload)) + payload)
+        self._file.flush()
+        self.n_recorded += 1
+
+
+def read_traces(path: str) -> Iterator[dict]:
+    """
+    TraceRecorderで記録したファイルを読み、1バトルずつレコードを返す
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_header.size)
+            if len(header) < _header.size:
+                break
+            length, = _header.unpack(header)
+            yield json.loads(zlib.decompress(f.read(length)).decode('utf-8'))